@@ -0,0 +1,704 @@
+"""服务器端的材质分配智能体：并行调用 LLM，为模型的每个部件选择方块。
+
+任务 (AgentJob) 的部件分成若干批次，每批一次请求：逐个部件模式下每批一个部件；批量模式下
+pack_batches() 在 token 预算内把尽可能多的部件放进同一个结构化输出请求，省去重复发送的整体分析
+和方块列表。批次由若干条"通道"处理：通道每次领取一个批次，处理完后把自己重新排到共享线程池
+队列的末尾，因此多个任务按轮转方式公平地共享有界的线程池；暂停时通道不再重新排队，不占用线程，
+恢复时重新提交。
+
+assign_batch 抛出 ValueError 表示回复无法解析或不符合要求，其他异常（网络错误、限流、上游 5xx）
+视为暂时性错误。多个部件的批次回复无法解析时拆成两半重新排队，回复中缺少的部件单独组成新批次；
+遇到暂时性错误时按指数退避原样重试同一个批次，拆分只会增加请求数。单个部件的批次和暂时性错误
+都最多重试 AGENT_MAX_RETRIES_PER_PART 次，之后批次中的部件计入失败。已经领取批次的通道在每次请求前
+检查任务是否暂停，暂停期间等待恢复（或取消），不再调用上游。
+
+任务的进度以事件列表保存（每个事件有递增的 seq），可以从任意位置继续读取，用于 SSE 推送。
+
+提供 JobStore 时，事件和任务摘要（不含逐个部件的结果，结果从 part / part_failed 事件重建）写入
+SQLite，其他工作进程可以读取任务状态和事件。事件在持有任务锁时放入待写队列，释放锁之后再按顺序
+写入，控制操作和快照读取不等待磁盘。其他进程的暂停、恢复、取消请求写入 JobStore，由运行任务的进程
+轮询执行。运行任务的进程定期写入心跳，心跳超过 ORPHAN_TIMEOUT 秒未更新（进程已退出）的任务被标记为失败。
+"""
+import collections
+import contextlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from block_defs import DEFAULT_BLOCK_ID_LIST, get_texture_key_for_voxel
+from rate_limiter import estimate_tokens
+from shared_state import transaction
+
+AGENT_MAX_RETRIES_PER_PART = 2
+DEFAULT_AGENT_WORKERS = 16
+DEFAULT_JOB_CONCURRENCY = 8
+RETRY_BACKOFF = 0.5
+# 结束的任务保留这么多秒后从内存中删除
+JOB_RETENTION = 3600.0
+EVENT_WAIT_TIMEOUT = 15.0
+# JobStore：运行任务的进程每隔这么多秒处理其他进程的控制请求并写入心跳
+CONTROL_POLL_INTERVAL = 0.5
+ORPHAN_TIMEOUT = 30.0
+# 批量模式：每个请求的 token 预算（提示词加上预计的回复）和部件数上限
+DEFAULT_BATCH_TOKEN_BUDGET = 8000
+MAX_BATCH_PARTS = 50
+# 回复中每个部件大约占用的 token 数
+OUTPUT_TOKENS_PER_PART = 40
+
+RUNNING_STATES = ("running", "paused")
+CONTROL_ACTIONS = ("pause", "resume", "cancel")
+
+
+class AgentJobError(Exception):
+    """不应重试的错误（例如 API 密钥无效），发生时整个任务失败。"""
+
+
+# --- 提示词与回复解析 ---
+
+def block_choices(block_defs=None):
+    """返回可选方块 {"blockId:metaData": 材质名}，材质相同的方块只保留第一个（例如不同朝向的原木）。"""
+    block_defs = block_defs or DEFAULT_BLOCK_ID_LIST
+    choices, seen = {}, set()
+    for block_id, block_entry in block_defs.items():
+        for meta_data in block_entry:
+            texture_key = get_texture_key_for_voxel(block_id, meta_data, block_defs)
+            if texture_key not in seen:
+                seen.add(texture_key)
+                choices[f"{block_id}:{meta_data}"] = texture_key
+    return choices
+
+
+def _block_schema(choices):
+    return {"type": "STRING", "enum": list(choices)}
+
+
+def part_response_schema(choices):
+    """单个部件的结构化输出 schema。"""
+    return {
+        "type": "OBJECT",
+        "properties": {"block": _block_schema(choices), "reason": {"type": "STRING"}},
+        "required": ["block"],
+    }
+
+
+def _describe_part(part):
+    return json.dumps({key: value for key, value in part.items() if key != "id"}, ensure_ascii=False)
+
+
+def batch_response_schema(choices, part_ids):
+    """多个部件的结构化输出 schema：每个部件一项，partId 限定为本批次的部件 id。"""
+    return {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "partId": {"type": "STRING", "enum": list(part_ids)},
+                "block": _block_schema(choices),
+                "reason": {"type": "STRING"},
+            },
+            "required": ["partId", "block"],
+        },
+    }
+
+
+def _choice_lines(choices):
+    return ["可选方块（blockId:metaData = 材质名）:", ", ".join(f"{key} = {name}" for key, name in choices.items())]
+
+
+def build_part_prompt(overall_analysis, part, choices):
+    lines = [
+        "你是 Minecraft 建筑的材质助手，需要为 3D 模型的一个部件选择最合适的方块。",
+        f"模型整体分析: {overall_analysis or '（无）'}",
+        f"部件: {_describe_part(part)}",
+        *_choice_lines(choices),
+        '回复 JSON: {"block": "blockId:metaData", "reason": "简短理由"}',
+    ]
+    return "\n".join(lines)
+
+
+def _batch_part_line(part):
+    return f"{part['id']}: {_describe_part(part)}"
+
+
+def build_batch_prompt(overall_analysis, parts, choices):
+    lines = [
+        "你是 Minecraft 建筑的材质助手，需要为 3D 模型的每个部件分别选择最合适的方块。",
+        f"模型整体分析: {overall_analysis or '（无）'}",
+        *_choice_lines(choices),
+        "部件（每行一个，部件 id: 描述）:",
+        *(_batch_part_line(part) for part in parts),
+        '回复 JSON 数组，每个部件一项: [{"partId": "部件 id", "block": "blockId:metaData", "reason": "简短理由"}]',
+    ]
+    return "\n".join(lines)
+
+
+def pack_batches(parts, overall_analysis, choices, token_budget=DEFAULT_BATCH_TOKEN_BUDGET,
+                 max_parts=MAX_BATCH_PARTS):
+    """按顺序把部件装入批次，使每批的提示词加上预计的回复不超过 token_budget（每批至少一个部件）。"""
+    base = estimate_tokens(build_batch_prompt(overall_analysis, [], choices))
+    batches, batch, used = [], [], base
+    for part in parts:
+        cost = estimate_tokens(_batch_part_line(part)) + OUTPUT_TOKENS_PER_PART
+        if batch and (used + cost > token_budget or len(batch) >= max_parts):
+            batches.append(batch)
+            batch, used = [], base
+        batch.append(part)
+        used += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _extract_json(text):
+    """从回复中取出 JSON（允许被 ```json 代码块包围）。"""
+    match = re.search(r"```(?:json)?\s*(.*?)```", text, re.S)
+    return json.loads(match.group(1) if match else text)
+
+
+def parse_block(value, choices):
+    """把 "blockId:metaData" 解析为 {"blockId", "metaData"}，不在可选列表中时抛出 ValueError。"""
+    if value not in choices:
+        raise ValueError(f"不可用的方块: {value!r}")
+    block_id, meta_data = value.split(':')
+    return {"blockId": int(block_id), "metaData": int(meta_data), "texture": choices[value]}
+
+
+def parse_part_assignment(text, choices):
+    """解析单个部件的回复，返回 {"blockId", "metaData", "texture", "reason"}；格式不对时抛出 ValueError。"""
+    data = _extract_json(text)
+    if not isinstance(data, dict):
+        raise ValueError("回复不是 JSON 对象。")
+    return dict(parse_block(data.get("block"), choices), reason=str(data.get("reason", "")))
+
+
+def parse_batch_assignment(text, choices, part_ids):
+    """解析批次的回复，返回 {部件 id: 结果}。回复不是 JSON 数组时抛出 ValueError；
+    未知的部件 id、重复项和不可用的方块被忽略（这些部件视为缺失，由调用方重新请求）。"""
+    data = _extract_json(text)
+    if not isinstance(data, list):
+        raise ValueError("回复不是 JSON 数组。")
+    wanted, results = set(part_ids), {}
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        part_id = str(item.get("partId", ""))
+        if part_id not in wanted or part_id in results:
+            continue
+        try:
+            results[part_id] = dict(parse_block(item.get("block"), choices), reason=str(item.get("reason", "")))
+        except (ValueError, AttributeError):
+            continue
+    return results
+
+
+def single_part_assigner(assign_part):
+    """把 assign_part(部件) → 结果 包装为批次接口 assign_batch(部件列表) → {部件 id: 结果}（逐个部件模式）。"""
+    def assign_batch(parts):
+        return {str(part["id"]): assign_part(part) for part in parts}
+    return assign_batch
+
+
+# --- 任务 ---
+
+class AgentJob:
+    """一个材质分配任务。所有状态由 _cond 保护。"""
+
+    def __init__(self, session_id, parts, overall_analysis, model_name, assign_batch, concurrency, batches, store=None):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.parts = parts
+        self.overall_analysis = overall_analysis
+        self.model_name = model_name
+        self.assign_batch = assign_batch
+        self.concurrency = max(1, min(concurrency, len(batches)))
+        self.status = "running"
+        self.results = {}
+        self.failures = {}
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.requests = 0
+        self._pending = collections.deque(batches)
+        self._active = 0
+        self._parked = 0
+        self._events = []
+        self._store = store
+        self._outbox = []  # 等待写入 JobStore 的 (事件, 任务摘要)
+        self._write_lock = threading.Lock()
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """持有 _cond 执行，释放之后把期间产生的事件写入 JobStore。"""
+        with self._cond:
+            yield
+        self._flush()
+
+    def _flush(self):
+        if self._store is None:
+            return
+        # 写入按顺序进行：先取出的事件先写入
+        with self._write_lock:
+            with self._cond:
+                rows, self._outbox = self._outbox, []
+            if not rows:
+                return
+            try:
+                self._store.record_events(self.id, [event for event, _ in rows], rows[-1][1])
+            except sqlite3.Error as e:
+                logging.warning(f"无法保存智能体任务 {self.id} 的事件: {e}")
+
+    # 以下方法调用时需持有 _cond；产生事件的调用方使用 _locked()
+    def _emit(self, event_type, **data):
+        event = dict(data, seq=len(self._events) + 1, type=event_type, time=time.time())
+        self._events.append(event)
+        if self._store is not None:
+            self._outbox.append((event, self._summary()))
+        self._cond.notify_all()
+        return event
+
+    def _progress(self):
+        return {"total": len(self.parts), "completed": len(self.results), "failed": len(self.failures)}
+
+    def _summary(self):
+        """不含逐个部件结果的快照（JobStore 中保存的部分）。"""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "modelName": self.model_name,
+            "progress": self._progress(),
+            "error": self.error,
+            "requests": self.requests,
+            "created": self.created,
+            "finished": self.finished,
+            "events": len(self._events),
+        }
+
+    def _snapshot(self):
+        return dict(self._summary(), results=dict(self.results), failures=dict(self.failures))
+
+    def snapshot(self):
+        with self._cond:
+            return self._snapshot()
+
+    def iter_events(self, after=0, timeout=EVENT_WAIT_TIMEOUT):
+        """产出 seq 大于 after 的事件，直到任务结束（"done" 事件之后）；等待超过 timeout 秒时产出 None（用于发送保活）。"""
+        while True:
+            with self._cond:
+                if len(self._events) <= after and self.finished is None:
+                    self._cond.wait(timeout)
+                pending = self._events[after:]
+                done = self.finished is not None
+            if not pending:
+                if done:
+                    return
+                yield None
+                continue
+            for event in pending:
+                yield event
+            after = pending[-1]["seq"]
+            if done and after == len(self._events):
+                return
+
+
+# --- 跨进程的任务记录 ---
+
+_JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    control TEXT,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+
+class JobStore:
+    """保存在 SQLite 中的任务摘要、事件和控制请求，供多个工作进程共享。连接按调用创建。"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_JOB_SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self, write=True):
+        return transaction(self.path, write)
+
+    def create(self, job_id, session_id, snapshot):
+        with self._connect() as db:
+            # 顺便删除早已结束的任务
+            cutoff = time.time() - JOB_RETENTION
+            expired = [row[0] for row in db.execute("SELECT id FROM jobs WHERE heartbeat < ?", (cutoff,))]
+            for expired_id in expired:
+                db.execute("DELETE FROM events WHERE job_id = ?", (expired_id,))
+                db.execute("DELETE FROM jobs WHERE id = ?", (expired_id,))
+            db.execute("INSERT INTO jobs (id, session_id, snapshot, heartbeat) VALUES (?, ?, ?, ?)",
+                       (job_id, session_id, json.dumps(snapshot, ensure_ascii=False), time.time()))
+
+    def record_events(self, job_id, events, summary):
+        """写入事件并把任务摘要更新为 summary（最后一个事件之后的状态）。"""
+        with self._connect() as db:
+            db.executemany("INSERT OR REPLACE INTO events (job_id, seq, event) VALUES (?, ?, ?)",
+                           [(job_id, event["seq"], json.dumps(event, ensure_ascii=False)) for event in events])
+            db.execute("UPDATE jobs SET snapshot = ?, heartbeat = ? WHERE id = ?",
+                       (json.dumps(summary, ensure_ascii=False), time.time(), job_id))
+
+    def poll(self, job_ids):
+        """运行任务的进程调用：更新这些任务的心跳，取出并清除其他进程提交的控制请求，返回 {任务 id: 操作}。"""
+        if not job_ids:
+            return {}
+        placeholders = ",".join("?" * len(job_ids))
+        with self._connect() as db:
+            db.execute(f"UPDATE jobs SET heartbeat = ? WHERE id IN ({placeholders})", (time.time(), *job_ids))
+            controls = dict(db.execute(f"SELECT id, control FROM jobs WHERE control IS NOT NULL "
+                                       f"AND id IN ({placeholders})", job_ids).fetchall())
+            if controls:
+                db.execute(f"UPDATE jobs SET control = NULL WHERE id IN ({placeholders})", job_ids)
+            return controls
+
+    def request_control(self, job_id, action):
+        """提交控制请求（由运行任务的进程在 CONTROL_POLL_INTERVAL 秒内执行）。"""
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET control = ? WHERE id = ?", (action, job_id))
+
+    def get(self, job_id, results=True):
+        """返回 {"sessionId", "snapshot"}，不存在时返回 None。运行任务的进程已退出时把任务标记为失败。
+        results 为真时从事件中重建快照的 results 和 failures。"""
+        with self._connect(write=False) as db:
+            row = db.execute("SELECT session_id, snapshot, heartbeat FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        session_id, snapshot, heartbeat = row[0], json.loads(row[1]), row[2]
+        if snapshot["status"] in RUNNING_STATES and heartbeat < time.time() - ORPHAN_TIMEOUT:
+            snapshot = self._mark_orphaned(job_id) or snapshot
+        if results:
+            snapshot.update(self._results(job_id))
+        return {"sessionId": session_id, "snapshot": snapshot}
+
+    def _results(self, job_id):
+        results, failures = {}, {}
+        for event in self.events(job_id):
+            if event["type"] == "part":
+                results[event["partId"]] = event["result"]
+            elif event["type"] == "part_failed":
+                failures[event["partId"]] = event["error"]
+        return {"results": results, "failures": failures}
+
+    def _mark_orphaned(self, job_id):
+        with self._connect() as db:
+            row = db.execute("SELECT snapshot, heartbeat FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            snapshot = json.loads(row[0])
+            if snapshot["status"] not in RUNNING_STATES or row[1] >= time.time() - ORPHAN_TIMEOUT:
+                return snapshot
+            now = time.time()
+            error = "处理该任务的工作进程已退出。"
+            seq = snapshot["events"]
+            snapshot.update(status="failed", error=error, finished=now, events=seq + 2)
+            for offset, event in enumerate((
+                    {"type": "error", "error": error},
+                    {"type": "done", "status": "failed", "progress": snapshot["progress"], "error": error,
+                     "requests": snapshot["requests"]}), start=1):
+                event.update(seq=seq + offset, time=now)
+                db.execute("INSERT OR REPLACE INTO events (job_id, seq, event) VALUES (?, ?, ?)",
+                           (job_id, event["seq"], json.dumps(event, ensure_ascii=False)))
+            db.execute("UPDATE jobs SET snapshot = ?, heartbeat = ? WHERE id = ?",
+                       (json.dumps(snapshot, ensure_ascii=False), now, job_id))
+            logging.warning(f"智能体任务 {job_id} 的工作进程已退出，任务标记为失败。")
+            return snapshot
+
+    def events(self, job_id, after=0):
+        with self._connect(write=False) as db:
+            return [json.loads(row[0]) for row in db.execute(
+                "SELECT event FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after))]
+
+    def iter_events(self, job_id, after=0, timeout=EVENT_WAIT_TIMEOUT):
+        """与 AgentJob.iter_events() 相同，但每隔 CONTROL_POLL_INTERVAL 秒从数据库读取（用于其他进程中的任务）。"""
+        idle_since = time.monotonic()
+        while True:
+            pending = self.events(job_id, after)
+            for event in pending:
+                yield event
+                after = event["seq"]
+                if event["type"] == "done":
+                    return
+            if pending:
+                idle_since = time.monotonic()
+            else:
+                record = self.get(job_id, results=False)
+                if record is None:
+                    return
+                if record["snapshot"]["finished"] is not None and record["snapshot"]["events"] <= after:
+                    return
+                if time.monotonic() - idle_since >= timeout:
+                    idle_since = time.monotonic()
+                    yield None
+            time.sleep(CONTROL_POLL_INTERVAL)
+
+
+class AgentJobRunner:
+    """在有界线程池上运行材质分配任务。on_progress(job, results) 在部件完成（results 为 {部件 id: 结果}）
+    和任务状态变化（results 为空）时调用。"""
+
+    def __init__(self, max_workers=DEFAULT_AGENT_WORKERS, on_progress=None, store=None):
+        self.max_workers = max_workers
+        self.on_progress = on_progress
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._control_thread = None
+
+    def submit(self, session_id, parts, overall_analysis, model_name, assign_batch,
+               concurrency=DEFAULT_JOB_CONCURRENCY, batches=None):
+        """创建任务并开始处理，返回 AgentJob。parts 为带 "id" 的字典列表；assign_batch(部件列表) 返回
+        {部件 id: 结果}；batches 为部件的分批（默认每批一个部件）。"""
+        if not parts:
+            raise ValueError("没有需要处理的部件。")
+        ids = [str(part.get("id", "")) for part in parts]
+        if not all(ids) or len(set(ids)) != len(ids):
+            raise ValueError("每个部件都需要唯一的 id。")
+        batches = batches or [[part] for part in parts]
+        job = AgentJob(session_id, parts, overall_analysis, model_name, assign_batch, concurrency, batches, self.store)
+        if self.store is not None:
+            with job._cond:
+                summary = job._summary()
+            self.store.create(job.id, session_id, summary)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            if self.store is not None and self._control_thread is None:
+                self._control_thread = threading.Thread(target=self._control_loop, name="agent-control", daemon=True)
+                self._control_thread.start()
+        with job._locked():
+            job._emit("started", progress=job._progress(), batches=len(batches))
+        self._notify(job)
+        logging.info(f"智能体任务 {job.id} 开始: {len(parts)} 个部件, {len(batches)} 个批次, 并发 {job.concurrency}。")
+        for _ in range(job.concurrency):
+            self._schedule(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and job.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def _control_loop(self):
+        """执行其他进程通过 JobStore 提交的控制请求，并为本进程中未结束的任务写入心跳。"""
+        actions = {"pause": self.pause, "resume": self.resume, "cancel": self.cancel}
+        while True:
+            time.sleep(CONTROL_POLL_INTERVAL)
+            with self._lock:
+                jobs = {job.id: job for job in self._jobs.values() if job.finished is None}
+            try:
+                controls = self.store.poll(list(jobs))
+            except sqlite3.Error as e:
+                logging.warning(f"读取智能体任务控制请求失败: {e}")
+                continue
+            for job_id, action in controls.items():
+                if action in actions:
+                    actions[action](jobs[job_id])
+
+    def _notify(self, job, results=None):
+        if self.on_progress is None:
+            return
+        try:
+            self.on_progress(job, results or {})
+        except Exception as e:
+            logging.warning(f"保存智能体任务 {job.id} 的进度失败: {e}")
+
+    # --- 通道 ---
+
+    def _schedule(self, job):
+        with job._cond:
+            job._active += 1
+        self._executor.submit(self._lane, job)
+
+    def _lane(self, job):
+        """处理一个批次，然后把自己重新排队（或在暂停、结束时退出）。"""
+        with job._locked():
+            if job.status == "paused":
+                job._active -= 1
+                job._parked += 1
+                return
+            if job.status != "running" or not job._pending:
+                job._active -= 1
+                finished = self._finish_if_done(job)
+                batch = None
+            else:
+                batch = job._pending.popleft()
+        if batch is None:
+            if finished:
+                self._notify(job)
+            return
+
+        try:
+            results, failures, retry_batches = self._run_batch(job, batch)
+        except AgentJobError as e:
+            with job._locked():
+                job._active -= 1
+                if job.status in RUNNING_STATES:
+                    job.status, job.error = "failed", str(e)
+                    job._emit("error", error=str(e))
+                finished = self._finish_if_done(job)
+            if finished:
+                self._notify(job)
+            return
+        extra_lane = False
+        with job._locked():
+            for part_id, result in results.items():
+                job.results[part_id] = result
+                job._emit("part", partId=part_id, result=result, progress=job._progress())
+            for part_id, error in failures.items():
+                job.failures[part_id] = error
+                job._emit("part_failed", partId=part_id, error=error, progress=job._progress())
+            if retry_batches and job.status in RUNNING_STATES:
+                job._pending.extendleft(reversed(retry_batches))
+                # 拆分出的批次可以由空闲的通道并行处理
+                extra_lane = job._active < job.concurrency
+        if results:
+            self._notify(job, results)
+        with job._cond:
+            job._active -= 1
+        self._schedule(job)
+        if extra_lane:
+            self._schedule(job)
+
+    def _call(self, job, batch):
+        """调用 assign_batch 并只保留本批次的部件；任务暂停时先等待恢复，任务已取消时返回 None。"""
+        with job._cond:
+            while job.status == "paused":
+                job._cond.wait()
+            if job.status not in RUNNING_STATES:
+                return None
+            job.requests += 1
+        results = job.assign_batch(batch)
+        ids = {str(part["id"]) for part in batch}
+        return {part_id: result for part_id, result in results.items() if part_id in ids}
+
+    def _run_batch(self, job, batch):
+        """处理一个批次，返回 (结果, 失败, 需要重新排队的批次)。
+
+        多个部件的批次：回复无法解析 (ValueError) 时拆成两半，回复中缺少的部件组成新批次；
+        暂时性错误时退避后重试同一个批次，重试用尽后整批计入失败。
+        单个部件的批次失败后重试，全部失败时计入失败。任务被取消时返回空结果。"""
+        if len(batch) > 1:
+            error = None
+            for attempt in range(AGENT_MAX_RETRIES_PER_PART + 1):
+                try:
+                    results = self._call(job, batch)
+                    break
+                except AgentJobError:
+                    raise
+                except ValueError as e:
+                    results, error = {}, str(e)
+                    break
+                except Exception as e:
+                    error = str(e)
+                    with job._locked():
+                        job._emit("retry", size=len(batch), attempt=attempt + 1, error=error)
+                    if attempt < AGENT_MAX_RETRIES_PER_PART:
+                        time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            else:
+                return {}, {str(part["id"]): error for part in batch}, []
+            if results is None:
+                return {}, {}, []
+            missing = [part for part in batch if str(part["id"]) not in results]
+            if not missing:
+                return results, {}, []
+            if results:
+                retry_batches = [missing]
+            else:
+                middle = len(batch) // 2
+                retry_batches = [batch[:middle], batch[middle:]]
+            with job._locked():
+                job._emit("batch_retry", size=len(batch), missing=len(missing),
+                          sizes=[len(retry) for retry in retry_batches], error=error)
+            return results, {}, retry_batches
+
+        part_id = str(batch[0]["id"])
+        last_error = None
+        for attempt in range(AGENT_MAX_RETRIES_PER_PART + 1):
+            try:
+                results = self._call(job, batch)
+                if results is None:
+                    return {}, {}, []
+                if part_id in results:
+                    return results, {}, []
+                last_error = "回复中缺少该部件。"
+            except AgentJobError:
+                raise
+            except Exception as e:
+                last_error = str(e)
+            with job._locked():
+                job._emit("retry", partId=part_id, attempt=attempt + 1, error=last_error)
+            if attempt < AGENT_MAX_RETRIES_PER_PART:
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+        return {}, {part_id: last_error}, []
+
+    def _finish_if_done(self, job):
+        """在持有 _cond 时检查任务是否已经结束；刚刚结束时返回 True（调用方在释放锁后通知）。"""
+        if job.finished or job._active or job.status == "paused" and job._pending:
+            return False
+        if job.status in RUNNING_STATES:
+            job.status = "completed"
+        job.finished = time.time()
+        job._emit("done", status=job.status, progress=job._progress(), error=job.error, requests=job.requests)
+        logging.info(f"智能体任务 {job.id} 结束: {job.status}, 完成 {len(job.results)}/{len(job.parts)} 个部件, "
+                     f"{job.requests} 次请求。")
+        return True
+    # --- 控制 ---
+
+    def pause(self, job):
+        with job._locked():
+            if job.status != "running":
+                return False
+            job.status = "paused"
+            job._emit("paused", progress=job._progress())
+        self._notify(job)
+        return True
+
+    def resume(self, job):
+        with job._locked():
+            if job.status != "paused":
+                return False
+            job.status = "running"
+            lanes, job._parked = job._parked, 0
+            job._emit("resumed", progress=job._progress())
+        self._notify(job)
+        for _ in range(lanes):
+            self._schedule(job)
+        return True
+
+    def cancel(self, job):
+        with job._locked():
+            if job.status not in RUNNING_STATES:
+                return False
+            job.status = "cancelled"
+            job._emit("cancelled", progress=job._progress())
+            self._finish_if_done(job)
+        self._notify(job)
+        return True
@@ -0,0 +1,166 @@
+"""预计算建筑动画时间线：为每个体素给出开始时间、飞行时长、起始位置、起始缩放和缓动函数。
+
+输出为紧凑的 Float32 二进制（小端序），每个体素 TIMELINE_STRIDE 个值，顺序与输入体素一致:
+    [startTime, flightDuration, startX, startY, startZ, startScale, easing]
+位置以体素为单位，指体素中心（体素 (x, y, z) 的最终位置为 (x + 0.5, y + 0.5, z + 0.5)）。
+"""
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+TIMELINE_SUBDIR = "timelines"
+TIMELINE_STRIDE = 7
+DEFAULT_ANIMATION_DURATION = 8.0
+MAX_ANIMATION_DURATION = 600.0
+
+# 缓动函数编号，与前端 EASING_FUNCTIONS 的下标一致
+EASE_LINEAR = 0
+EASE_OUT_CUBIC = 1
+EASE_OUT_BACK = 2
+EASE_OUT_BOUNCE = 3
+EASE_IN_OUT_SINE = 4
+
+_CACHE_LOCK = threading.Lock()
+
+
+def _rank(keys, rng, jitter=0.0):
+    """把排序键转换为 [0, 1] 区间的开始进度，可选加入随机扰动让同层方块错开。"""
+    keys = np.asarray(keys, dtype=np.float64)
+    if jitter:
+        keys = keys + rng.random(len(keys)) * jitter
+    span = keys.max() - keys.min()
+    if span <= 0:
+        return np.zeros(len(keys))
+    return (keys - keys.min()) / span
+
+
+def _effect_magic_gradient(centers, rng):
+    # 沿对角线方向逐渐淡入（以缩放代替透明度）
+    keys = centers[:, 1] + 0.35 * (centers[:, 0] + centers[:, 2])
+    return _rank(keys, rng, jitter=0.5), centers.copy(), 0.0, 0.6, EASE_IN_OUT_SINE
+
+
+def _effect_vortex(centers, rng):
+    # 从下到上、按绕中心轴的角度依次螺旋飞入
+    middle = centers.mean(axis=0)
+    offset = centers[:, [0, 2]] - middle[[0, 2]]
+    angle = np.arctan2(offset[:, 1], offset[:, 0])
+    radius = np.hypot(offset[:, 0], offset[:, 1])
+    height = np.ptp(centers[:, 1]) + 1
+    progress = _rank(centers[:, 1] + (angle + np.pi) / (2 * np.pi), rng)
+
+    spin = angle + np.pi * 1.5
+    start_radius = radius + 6 + height * 0.5
+    start = np.column_stack((
+        middle[0] + np.cos(spin) * start_radius,
+        centers[:, 1] + height * 0.5,
+        middle[2] + np.sin(spin) * start_radius,
+    ))
+    return progress, start, 0.2, 1.0, EASE_OUT_CUBIC
+
+
+def _effect_ripple(centers, rng):
+    # 从水平中心向外一圈圈升起
+    middle = centers.mean(axis=0)
+    distance = np.hypot(centers[:, 0] - middle[0], centers[:, 2] - middle[2])
+    start = centers.copy()
+    start[:, 1] -= 2.0
+    return _rank(np.round(distance) + centers[:, 1] * 0.05, rng, jitter=0.3), start, 0.3, 0.5, EASE_OUT_BACK
+
+
+def _effect_rain_down(centers, rng):
+    # 从天而降，下层先落地
+    top = centers[:, 1].max()
+    start = centers.copy()
+    start[:, 1] = top + 10 + rng.random(len(centers)) * 6
+    return _rank(centers[:, 1], rng, jitter=2.0), start, 1.0, 0.9, EASE_OUT_BOUNCE
+
+
+def _effect_ground_up(centers, rng):
+    # 从地底升起到位
+    height = np.ptp(centers[:, 1]) + 1
+    start = centers.copy()
+    start[:, 1] -= height + 4
+    return _rank(centers[:, 1], rng, jitter=0.8), start, 1.0, 0.8, EASE_OUT_CUBIC
+
+
+def _effect_layer_scan(centers, rng):
+    # 逐层出现，同层方块同时出现
+    return _rank(centers[:, 1], rng), centers.copy(), 0.0, 0.25, EASE_OUT_CUBIC
+
+
+def _effect_assemble(centers, rng):
+    # 方块从左右两侧飞入，靠近中心的先到
+    middle = centers.mean(axis=0)
+    side = np.where(centers[:, 0] < middle[0], -1.0, 1.0)
+    width = np.ptp(centers[:, 0]) + 1
+    start = centers.copy()
+    start[:, 0] = middle[0] + side * (width + 12)
+    start[:, 1] += rng.normal(0, 2, len(centers))
+    distance = np.abs(centers[:, 0] - middle[0])
+    return _rank(centers[:, 1] * 0.5 + distance, rng, jitter=1.0), start, 0.6, 1.0, EASE_OUT_CUBIC
+
+
+def _effect_simple(centers, rng):
+    # 随机顺序闪现
+    return rng.permutation(len(centers)) / max(len(centers) - 1, 1), centers.copy(), 1.0, 0.0, EASE_LINEAR
+
+
+ANIMATION_EFFECTS = {
+    "magic-gradient": _effect_magic_gradient,
+    "vortex": _effect_vortex,
+    "ripple": _effect_ripple,
+    "rain-down": _effect_rain_down,
+    "ground-up": _effect_ground_up,
+    "layer-scan": _effect_layer_scan,
+    "assemble": _effect_assemble,
+    "simple": _effect_simple,
+}
+
+
+def scene_hash(coords):
+    """按体素坐标及其顺序计算场景哈希（时间线与输入顺序一一对应）。"""
+    return hashlib.sha256(np.ascontiguousarray(coords, dtype='<i4').tobytes()).hexdigest()
+
+
+def build_timeline(coords, effect, duration=DEFAULT_ANIMATION_DURATION, seed=0):
+    """生成 (N, TIMELINE_STRIDE) 的 float32 时间线。"""
+    if effect not in ANIMATION_EFFECTS:
+        raise ValueError(f"未知的动画效果: {effect}")
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    timeline = np.zeros((len(coords), TIMELINE_STRIDE), dtype='<f4')
+    if len(coords) == 0:
+        return timeline
+
+    rng = np.random.default_rng(seed)
+    centers = coords + 0.5
+    progress, start, start_scale, flight_fraction, easing = ANIMATION_EFFECTS[effect](centers, rng)
+
+    # 飞行时长占总时长的一部分，其余时间用于错开各方块的开始时间
+    flight = min(flight_fraction, 0.5 * duration)
+    timeline[:, 0] = progress * (duration - flight)
+    timeline[:, 1] = flight
+    timeline[:, 2:5] = start
+    timeline[:, 5] = start_scale
+    timeline[:, 6] = easing
+    return timeline
+
+
+def build_timeline_cached(coords, effect, duration, cache_dir):
+    """带磁盘缓存的 build_timeline()，缓存键为 (场景哈希, 效果, 时长)，返回二进制字节串。"""
+    digest = scene_hash(coords)
+    cache_path = os.path.join(cache_dir, TIMELINE_SUBDIR, f"{digest}_{effect}_{duration:g}.f32")
+    with _CACHE_LOCK:
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return f.read()
+
+        seed = int(digest[:8], 16)
+        data = build_timeline(coords, effect, duration, seed).tobytes()
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(cache_path + '.tmp', cache_path)
+        return data
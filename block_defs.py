@@ -0,0 +1,104 @@
+"""方块定义：与前端 DEFAULT_BLOCK_ID_LIST 保持一致的 blockId/metaData → 材质名映射。"""
+
+# blockId -> metaData -> 材质名（或按面区分的材质字典，可带 ":旋转角度" 后缀）
+DEFAULT_BLOCK_ID_LIST = {
+    "1": {"0": "stone", "1": "granite", "2": "polished_granite", "3": "stone_diorite", "4": "polished_diorite", "5": "andersite", "6": "polished_andersite"},
+    "2": {"0": {"top": "dirt", "bottom": "dirt", "*": "dirt"}},
+    "3": {"0": "dirt", "1": "coarse_dirt", "2": "podzol"},
+    "4": {"0": "cobblestone"},
+    "5": {"0": "planks_oak", "1": "planks_spruce", "3": "planks_jungle", "4": "planks_acacia", "5": "planks_big_oak"},
+    "7": {"0": "cobblestone"},
+    "12": {"0": "sand", "1": "red_sand"},
+    "13": {"0": "gravel"},
+    "14": {"0": "gold_ore"},
+    "15": {"0": "iron_ore"},
+    "16": {"0": "coal_ore"},
+    "17": {"0": {"top": "log_oak_top", "bottom": "log_oak_top", "*": "log_oak"}, "1": {"top": "log_spruce_top", "bottom": "log_spruce_top", "*": "log_spruce"}, "2": {"top": "log_birch_top", "bottom": "log_birch_top", "*": "log_birch"}, "3": {"top": "log_jungle_top", "bottom": "log_jungle_top", "*": "log_jungle"}, "4": {"east": "log_oak_top:180", "west": "log_oak_top", "top": "log_oak:270", "bottom": "log_oak:270", "north": "log_oak:90", "south": "log_oak:270"}, "5": {"east": "log_spruce_top:180", "west": "log_spruce_top", "top": "log_spruce:270", "bottom": "log_spruce:270", "north": "log_spruce:90", "south": "log_spruce:270"}, "6": {"east": "log_birch_top:180", "west": "log_birch_top", "top": "log_birch:270", "bottom": "log_birch:270", "north": "log_birch:90", "south": "log_birch:270"}, "7": {"east": "log_jungle_top:180", "west": "log_jungle_top", "top": "log_jungle:270", "bottom": "log_jungle:270", "north": "log_jungle:90", "south": "log_jungle:270"}, "8": {"north": "log_oak_top:180", "south": "log_oak_top", "top": "log_oak", "bottom": "log_oak:180", "east": "log_oak:270", "west": "log_oak:90"}, "9": {"north": "log_spruce_top:180", "south": "log_spruce_top", "top": "log_spruce", "bottom": "log_spruce:180", "east": "log_spruce:270", "west": "log_spruce:90"}, "10": {"north": "log_birch_top:180", "south": "log_birch_top", "top": "log_birch", "bottom": "log_birch:180", "east": "log_birch:270", "west": "log_birch:90"}, "11": {"north": "log_jungle_top:180", "south": "log_jungle_top", "top": "log_jungle", "bottom": "log_jungle:180", "east": "log_jungle:270", "west": "log_jungle:90"}, "12": {"*": "log_oak"}, "13": {"*": "log_spruce"}, "14": {"*": "log_birch"}, "15": {"*": "log_jungle"}},
+    "19": {"0": "sponge", "1": "wet_sponge"},
+    "21": {"0": "lapis_ore"},
+    "22": {"0": "lapis_block"},
+    "35": {"0": "wool_colored_white", "1": "wool_colored_orange", "2": "wool_colored_magenta", "3": "wool_colored_light_blue", "4": "wool_colored_yellow", "5": "wool_colored_lime", "6": "wool_colored_pink", "7": "wool_colored_gray", "8": "wool_colored_silver", "9": "wool_colored_cyan", "10": "wool_colored_purple", "11": "wool_colored_blue", "12": "wool_colored_brown", "13": "wool_colored_green", "14": "wool_colored_red", "15": "wool_colored_black"},
+    "41": {"0": "gold_block"},
+    "42": {"0": "iron_block"},
+    "43": {"0": {"top": "stone_slab_top", "bottom": "stone_slab_top", "*": "stone_slab_side"}, "1": {"top": "sandstone_top", "bottom": "sandstone_bottom", "*": "sandstone_normal"}, "2": "planks_oak", "3": "cobblestone", "4": "brick", "5": "stonebrick", "6": "nether_brick", "7": "quartz_block_side"},
+    "45": {"0": "brick"},
+    "57": {"0": "diamond_block"},
+    "98": {"0": "stonebrick", "1": "stonebrick_mossy", "2": "stonebrick_cracked", "3": "stonebrick_carved"},
+}
+
+# 材质名 -> 颜色（没有材质包贴图时使用），与前端 TEXTURE_KEY_TO_COLOR_MAP 一致
+TEXTURE_KEY_TO_COLOR_MAP = {
+    'stone': 0x888888, 'grass_top': 0x74b44a, 'grass_side': 0x90ac50, 'dirt': 0x8d6b4a,
+    'cobblestone': 0x7a7a7a, 'planks_oak': 0xaf8f58, 'planks_spruce': 0x806038,
+    'planks_birch': 0xdace9b, 'planks_jungle': 0xac7d5a, 'planks_acacia': 0xad6c49,
+    'planks_dark_oak': 0x4c331e, 'bedrock': 0x555555, 'sand': 0xe3dbac, 'gravel': 0x84807b,
+    'log_oak': 0x685133, 'log_oak_top': 0x9e8054, 'log_spruce': 0x513f27,
+    'log_spruce_top': 0x716041, 'log_birch': 0xd0cbb0, 'log_birch_top': 0xe0d6b5,
+    'log_jungle': 0x584c24, 'log_jungle_top': 0x84733c, 'log_acacia': 0x645c50,
+    'log_acacia_top': 0x918877, 'log_dark_oak': 0x3c2d1b, 'log_big_oak_top': 0x5f4931,
+    'leaves_oak': 0x44aa44, 'leaves_spruce': 0x4c784c, 'leaves_birch': 0x6aac6a,
+    'leaves_jungle': 0x48a048, 'leaves_acacia': 0x4c8c4c, 'leaves_dark_oak': 0x4c784c,
+    'glass': 0xeeeeff, 'glass_pane_top': 0xddddf0, 'brick': 0xa05050, 'obsidian': 0x1c1824,
+    'diamond_block': 0x7dedde, 'netherrack': 0x883333, 'glowstone': 0xfff055, 'unknown': 0xff00ff,
+}
+
+# 面名称 -> 朝向（单位法向量），与 Minecraft 约定一致：south 为 +z，east 为 +x
+FACE_DIRECTIONS = {
+    "east": (1, 0, 0),
+    "west": (-1, 0, 0),
+    "top": (0, 1, 0),
+    "bottom": (0, -1, 0),
+    "south": (0, 0, 1),
+    "north": (0, 0, -1),
+}
+
+
+def strip_rotation(texture_ref):
+    """去掉材质引用中的旋转后缀，例如 'log_oak:270' -> 'log_oak'。"""
+    return texture_ref.split(':')[0]
+
+
+def get_texture_key_for_voxel(block_id, meta_data, block_defs=None):
+    """返回体素的代表材质名，与前端 getTextureKeyForVoxel() 的逻辑一致。"""
+    block_defs = block_defs or DEFAULT_BLOCK_ID_LIST
+    block_entry = block_defs.get(str(block_id))
+    if not block_entry:
+        return 'unknown'
+    meta_entry = block_entry.get(str(meta_data))
+    if not meta_entry:
+        return 'unknown'
+    if isinstance(meta_entry, str):
+        return strip_rotation(meta_entry)
+    key = meta_entry.get('*') or meta_entry.get('top') or meta_entry.get('side') or 'unknown'
+    return strip_rotation(key)
+
+
+def get_face_texture_key(block_id, meta_data, face, block_defs=None):
+    """返回体素某个面（top/bottom/north/south/east/west）使用的材质名。"""
+    block_defs = block_defs or DEFAULT_BLOCK_ID_LIST
+    meta_entry = (block_defs.get(str(block_id)) or {}).get(str(meta_data))
+    if not meta_entry:
+        return 'unknown'
+    if isinstance(meta_entry, str):
+        return strip_rotation(meta_entry)
+    key = meta_entry.get(face) or meta_entry.get('*') or meta_entry.get('side') or meta_entry.get('top') or 'unknown'
+    return strip_rotation(key)
+
+
+def texture_key_color(texture_key):
+    """返回材质的 0xRRGGBB 颜色，未知材质使用 'unknown' 的颜色。"""
+    return TEXTURE_KEY_TO_COLOR_MAP.get(texture_key, TEXTURE_KEY_TO_COLOR_MAP['unknown'])
+
+
+def iter_referenced_texture_keys(block_defs=None):
+    """按出现顺序去重地列出方块定义中引用的所有材质名。"""
+    block_defs = block_defs or DEFAULT_BLOCK_ID_LIST
+    seen = set()
+    for block_entry in block_defs.values():
+        for meta_entry in block_entry.values():
+            refs = [meta_entry] if isinstance(meta_entry, str) else meta_entry.values()
+            for ref in refs:
+                key = strip_rotation(ref)
+                if key not in seen:
+                    seen.add(key)
+                    yield key
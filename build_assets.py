@@ -0,0 +1,156 @@
+"""前端资源构建：把页面脚本和依赖库输出为带哈希的文件，并预先生成 gzip / brotli 版本。
+
+步骤:
+    1. 从 server.HTML_CONTENT 中提取内联的 <script type="module">（页面脚本唯一的源码）
+    2. 把 VENDOR_SCRIPTS 中的依赖库放入 static/vendor/（已有则直接使用；
+       否则依次从 --vendor_dir 复制，或通过下载缓存从 CDN 下载）
+    3. 为每个文件写入 static/dist/<名称>.<哈希><扩展名> 及其 .gz / .br（未安装 brotli 时跳过 .br），
+       并写出 static/dist/manifest.json
+
+服务器启动时读取该清单：页面改为从 /dist/ 加载这些文件（长期缓存），不再访问 CDN，
+因此构建一次后可以在完全离线的机器上运行。没有清单时页面仍使用 CDN。
+
+用法:
+    python build_assets.py
+    python build_assets.py --vendor_dir /path/to/predownloaded/libs
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import textwrap
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from download_cache import fetch_cached
+from server import (APP_SCRIPT_ASSET, ASSET_DIST_DIR, ASSET_HASH_LENGTH, ASSET_MANIFEST_NAME, CACHE_DIR,
+                    HTML_CONTENT, VENDOR_SCRIPTS)
+
+STATIC_DIR = os.path.dirname(ASSET_DIST_DIR)
+VENDOR_DIR = os.path.join(STATIC_DIR, "vendor")
+APP_SCRIPT_START = '<script type="module">\n'
+APP_SCRIPT_END = '</script>'
+HASH_LENGTH = ASSET_HASH_LENGTH
+# 小于该大小的文件不生成压缩版本
+COMPRESS_MIN_SIZE = 1024
+
+
+def extract_app_script(html):
+    """返回页面中内联模块脚本的内容。"""
+    start = html.find(APP_SCRIPT_START)
+    if start < 0:
+        raise ValueError("页面中没有内联的模块脚本。")
+    start += len(APP_SCRIPT_START)
+    end = html.find(APP_SCRIPT_END, start)
+    return textwrap.dedent(html[start:end]).strip() + '\n'
+
+
+def vendor_library(name, cdn_url, vendor_dir=None, refresh=False):
+    """确保依赖库位于 static/vendor/ 中，返回其路径；无法获得时返回 None。"""
+    target = os.path.join(VENDOR_DIR, name)
+    if os.path.isfile(target) and not refresh:
+        return target
+    source = os.path.join(vendor_dir, name) if vendor_dir else None
+    if not (source and os.path.isfile(source)):
+        try:
+            source = fetch_cached(cdn_url, CACHE_DIR, default_extension='.js')
+        except Exception as e:
+            logging.warning(f"无法获取 '{name}' ({cdn_url})，页面将继续从 CDN 加载: {e}")
+            return None
+    os.makedirs(VENDOR_DIR, exist_ok=True)
+    shutil.copyfile(source, target)
+    return target
+
+
+def _fingerprinted_name(name, data):
+    stem, extension = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{extension}"
+
+
+def write_asset(name, data, dist_dir=ASSET_DIST_DIR):
+    """写入带哈希的文件及其压缩版本，返回 (带哈希的文件名, 写出的文件名列表)。"""
+    hashed = _fingerprinted_name(name, data)
+    outputs = {hashed: data}
+    if len(data) >= COMPRESS_MIN_SIZE:
+        # mtime=0 保证相同输入得到相同的 .gz
+        outputs[hashed + '.gz'] = gzip.compress(data, compresslevel=9, mtime=0)
+        if brotli is not None:
+            outputs[hashed + '.br'] = brotli.compress(data, quality=11)
+    for filename, content in outputs.items():
+        path = os.path.join(dist_dir, filename)
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+    return hashed, list(outputs)
+
+
+def _load_manifest(dist_dir):
+    try:
+        with open(os.path.join(dist_dir, ASSET_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _related_files(names):
+    return {name + suffix for name in names for suffix in ('', '.gz', '.br')}
+
+
+def build(vendor_dir=None, refresh=False, dist_dir=ASSET_DIST_DIR):
+    """构建全部资源并写出清单，返回清单。
+
+    上一次构建的文件会保留一代，已经打开的旧页面仍能加载它们；更早的文件被删除。
+    """
+    os.makedirs(dist_dir, exist_ok=True)
+    if brotli is None:
+        logging.warning("未安装 brotli，只生成 gzip 压缩版本。")
+
+    sources = {}
+    # 页面脚本只写入 static/dist/（带哈希），不生成需要提交的副本
+    sources[APP_SCRIPT_ASSET] = extract_app_script(HTML_CONTENT).encode('utf-8')
+    for name, cdn_url in VENDOR_SCRIPTS:
+        path = vendor_library(name, cdn_url, vendor_dir, refresh)
+        if path:
+            with open(path, 'rb') as f:
+                sources[name] = f.read()
+
+    previous = _load_manifest(dist_dir)
+    manifest = {}
+    raw_bytes = compressed_bytes = 0
+    for name, data in sources.items():
+        hashed, outputs = write_asset(name, data, dist_dir)
+        manifest[name] = hashed
+        raw_bytes += len(data)
+        smallest = min(os.path.getsize(os.path.join(dist_dir, filename)) for filename in outputs)
+        compressed_bytes += smallest
+        logging.info(f"{name} -> {hashed} ({len(data)} 字节, 压缩后 {smallest} 字节)")
+
+    with open(os.path.join(dist_dir, ASSET_MANIFEST_NAME + '.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(os.path.join(dist_dir, ASSET_MANIFEST_NAME + '.tmp'), os.path.join(dist_dir, ASSET_MANIFEST_NAME))
+
+    keep = _related_files(manifest.values()) | _related_files(previous.values()) | {ASSET_MANIFEST_NAME}
+    for filename in os.listdir(dist_dir):
+        if filename not in keep:
+            os.remove(os.path.join(dist_dir, filename))
+    logging.info(f"构建完成: {len(manifest)} 个文件, 共 {raw_bytes} 字节, 压缩后 {compressed_bytes} 字节。")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="构建带哈希和预压缩版本的前端资源")
+    parser.add_argument('--vendor_dir', type=str, help='预先下载的依赖库目录（文件名与 static/vendor/ 中相同），用于离线构建。')
+    parser.add_argument('--refresh', action='store_true', help='忽略 static/vendor/ 中已有的依赖库，重新获取。')
+    args = parser.parse_args()
+    build(args.vendor_dir, args.refresh)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""按内容寻址的下载缓存：URL → SHA-256 索引、条件请求、断点续传和并行分段下载。
+
+目录布局（位于 CACHE_DIR/downloads 下）:
+    objects/<sha256><扩展名>     下载完成的文件，内容相同的 URL 共享同一个文件
+    partial/<url 哈希>.json      未完成下载的元数据（校验值、总大小、分段范围）
+    partial/<url 哈希>.<n>       第 n 个分段已下载的字节
+    index.json                   URL → {hash, path, etag, lastModified, size, fetched}
+
+再次请求同一 URL 时带上 If-None-Match / If-Modified-Since，服务器返回 304 则直接使用缓存；
+下载中断后，下次以 Range + If-Range 从已下载的位置继续。支持 Range 的大文件拆成多段并行下载。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+from http_client import DOWNLOAD_TIMEOUT, http_get
+
+DOWNLOAD_SUBDIR = "downloads"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+_INDEX_LOCK = threading.Lock()
+
+
+class DownloadChangedError(Exception):
+    """续传或分段下载过程中，服务器上的文件发生了变化。"""
+
+
+def _paths(cache_dir):
+    root = os.path.join(cache_dir, DOWNLOAD_SUBDIR)
+    return root, os.path.join(root, "objects"), os.path.join(root, "partial"), os.path.join(root, "index.json")
+
+
+def _load_index(index_path):
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_index(index_path, index):
+    temp_path = index_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, index_path)
+
+
+def _update_index(index_path, url, entry):
+    with _INDEX_LOCK:
+        index = _load_index(index_path)
+        if entry is None:
+            index.pop(url, None)
+        else:
+            index[url] = entry
+        _save_index(index_path, index)
+
+
+def _url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def _url_extension(url, default):
+    _, extension = os.path.splitext(os.path.basename(urlparse(url).path))
+    return extension.lower() if extension else default
+
+
+def _validator(response):
+    """返回可用于 If-Range 的强校验值（ETag 优先，其次 Last-Modified），没有时返回 None。"""
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _plan_pieces(total, workers):
+    """把 [0, total) 平均切成 workers 段，返回 [[起点, 终点(含)], ...]。"""
+    step = -(-total // workers)
+    return [[start, min(start + step, total) - 1] for start in range(0, total, step)]
+
+
+def _write_stream(response, piece_path):
+    with open(piece_path, 'ab') as f:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+
+
+def _download_piece(url, piece, piece_path, validator):
+    """以 Range 请求下载（或续传）一个分段。"""
+    start, end = piece
+    done = os.path.getsize(piece_path) if os.path.exists(piece_path) else 0
+    if end is not None and start + done > end:
+        return
+    headers = {'Range': f"bytes={start + done}-{'' if end is None else end}"}
+    if validator:
+        headers['If-Range'] = validator
+    with http_get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 200 and (start + done) > 0:
+            # If-Range 不匹配时服务器返回完整文件：已下载的部分作废
+            raise DownloadChangedError(url)
+        response.raise_for_status()
+        _write_stream(response, piece_path)
+
+
+def _assemble(piece_paths, expected_size, target_path):
+    """按顺序拼接分段并计算 SHA-256，返回哈希值。"""
+    digest = hashlib.sha256()
+    with open(target_path, 'wb') as out:
+        for piece_path in piece_paths:
+            with open(piece_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+    if expected_size is not None and os.path.getsize(target_path) != expected_size:
+        raise DownloadChangedError(f"大小不一致: 期望 {expected_size} 字节")
+    return digest.hexdigest()
+
+
+def _clear_partial(partial_dir, url_key):
+    for name in os.listdir(partial_dir):
+        if name.startswith(url_key + '.'):
+            os.remove(os.path.join(partial_dir, name))
+
+
+def _download(url, response, objects_dir, partial_dir, extension, workers):
+    """把 200 响应对应的文件完整下载到 objects/，返回 (哈希, 路径, 大小)。"""
+    url_key = _url_key(url)
+    meta_path = os.path.join(partial_dir, url_key + '.json')
+    validator = _validator(response)
+    length = response.headers.get('Content-Length')
+    total = int(length) if length and 'Content-Encoding' not in response.headers else None
+    ranged = response.headers.get('Accept-Ranges', '').lower() == 'bytes' and total is not None
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if not (ranged and validator and meta.get('validator') == validator and meta.get('size') == total):
+            meta = None
+    if meta is None:
+        _clear_partial(partial_dir, url_key)
+        count = workers if ranged and total >= PARALLEL_MIN_SIZE and workers > 1 else 1
+        pieces = _plan_pieces(total, count) if total else [[0, None]]
+        meta = {"url": url, "validator": validator, "size": total, "pieces": pieces}
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+    pieces = meta['pieces']
+    piece_paths = [os.path.join(partial_dir, f"{url_key}.{i}") for i in range(len(pieces))]
+    resumed = sum(os.path.getsize(p) for p in piece_paths if os.path.exists(p))
+    if resumed:
+        logging.info(f"继续未完成的下载: 已有 {resumed} / {total} 字节。")
+
+    started = time.perf_counter()
+    if len(pieces) == 1 and not resumed:
+        # 单段且从头下载：直接消费已经打开的响应
+        _write_stream(response, piece_paths[0])
+    else:
+        response.close()
+        if len(pieces) == 1:
+            _download_piece(url, pieces[0], piece_paths[0], validator)
+        else:
+            logging.info(f"分 {len(pieces)} 段并行下载 {total} 字节。")
+            with ThreadPoolExecutor(max_workers=len(pieces)) as pool:
+                futures = [pool.submit(_download_piece, url, piece, path, validator)
+                           for piece, path in zip(pieces, piece_paths)]
+                for future in futures:
+                    future.result()
+
+    temp_path = os.path.join(partial_dir, url_key + '.download')
+    digest = _assemble(piece_paths, total, temp_path)
+    object_path = os.path.join(objects_dir, digest + extension)
+    if os.path.exists(object_path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, object_path)
+    _clear_partial(partial_dir, url_key)
+
+    size = os.path.getsize(object_path)
+    elapsed = time.perf_counter() - started
+    logging.info(f"下载完成: {size} 字节, 用时 {elapsed:.1f} 秒 ({size / max(elapsed, 1e-6) / 1024 ** 2:.1f} MB/s)。")
+    return digest, object_path, size
+
+
+def fetch_cached(url, cache_dir, default_extension='.bin', workers=DEFAULT_DOWNLOAD_WORKERS):
+    """下载 URL 并返回缓存文件路径；缓存有效（304）时不重新下载。
+
+    网络不可用但已有缓存时返回旧的缓存文件；其余下载失败时抛出 requests 异常。
+    """
+    root, objects_dir, partial_dir, index_path = _paths(cache_dir)
+    for directory in (objects_dir, partial_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    with _INDEX_LOCK:
+        entry = _load_index(index_path).get(url)
+    cached_path = entry and os.path.join(root, entry['path'])
+    if cached_path and not os.path.exists(cached_path):
+        entry, cached_path = None, None
+
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+
+    for attempt in range(2):
+        try:
+            response = http_get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            if cached_path:
+                logging.warning(f"无法连接到 {url}，使用已缓存的文件: {e}")
+                os.utime(cached_path)
+                return cached_path
+            raise
+
+        with response:
+            if response.status_code == 304 and cached_path:
+                logging.info(f"缓存仍然有效 (304)，使用 '{cached_path}'。")
+                os.utime(cached_path)
+                return cached_path
+            response.raise_for_status()
+            try:
+                digest, object_path, size = _download(
+                    url, response, objects_dir, partial_dir, _url_extension(url, default_extension), workers)
+                break
+            except DownloadChangedError as e:
+                _clear_partial(partial_dir, _url_key(url))
+                if attempt:
+                    raise
+                logging.warning(f"服务器上的文件在下载过程中发生变化，重新下载: {e}")
+                headers = {}
+
+    _update_index(index_path, url, {
+        "hash": digest,
+        "path": os.path.relpath(object_path, root),
+        "etag": response.headers.get('ETag'),
+        "lastModified": response.headers.get('Last-Modified'),
+        "size": size,
+        "fetched": time.time(),
+    })
+    return object_path
+
+
+def evict_cache(cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES, protect=()):
+    """按最近使用时间淘汰 cache_dir 下的文件，直到总大小不超过 max_bytes。
+
+    最近使用时间取 atime 与 mtime 的较大者（命中下载缓存时会更新 mtime）；
+    protect 中的文件、下载索引和未完成的下载不会被删除。返回释放的字节数。
+    """
+    root, _, partial_dir, index_path = _paths(cache_dir)
+    protected = {os.path.abspath(path) for path in protect}
+    protected.add(os.path.abspath(index_path))
+    files = []
+    total = 0
+    for directory, _, names in os.walk(cache_dir):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            total += stat.st_size
+            if os.path.abspath(path) in protected or os.path.abspath(directory) == os.path.abspath(partial_dir):
+                continue
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+
+    freed = 0
+    for _, size, path in sorted(files):
+        if total - freed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            freed += size
+        except OSError:
+            continue
+
+    if freed:
+        with _INDEX_LOCK:
+            index = _load_index(index_path)
+            kept = {url: entry for url, entry in index.items() if os.path.exists(os.path.join(root, entry['path']))}
+            if len(kept) != len(index):
+                _save_index(index_path, kept)
+        logging.info(f"缓存目录超过 {max_bytes / 1024 ** 2:.0f} MB，已淘汰 {freed / 1024 ** 2:.1f} MB。")
+    return freed
+
@@ -0,0 +1,142 @@
+"""本地 Gemini API 桩服务器：用于在没有网络或 API 密钥的情况下调试聊天接口。
+
+实现 models 列表、generateContent 和 streamGenerateContent?alt=sse 三个接口，
+回复内容由请求中的消息拼接而成，流式接口按 --delay 间隔逐词发送。
+请求带 generationConfig.responseSchema（结构化输出）时，按 schema 生成确定性的 JSON 回复:
+字符串枚举按消息内容的哈希选取；对象数组中第一个带枚举的属性，每个取值生成一项。
+--latency 为每个请求额外的固定延迟，用于模拟网络和首个 token 的耗时；--malformed_rate 为结构化输出
+回复被截断（无法解析）的概率，用于测试客户端的重试和拆分。
+
+用法:
+    python gemini_stub.py --port 5001 --delay 0.05
+    python server.py --gemini_api_base http://127.0.0.1:5001/v1beta
+"""
+import argparse
+import hashlib
+import json
+import random
+import time
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
+
+app = Flask(__name__)
+TOKEN_DELAY = 0.05
+REQUEST_LATENCY = 0.0
+MALFORMED_RATE = 0.0
+INVALID_KEY = "invalid"
+
+
+def _reply_tokens(payload):
+    """根据请求内容生成确定性的回复，按词切分。"""
+    message = ""
+    for content in payload.get('contents', []):
+        for part in content.get('parts', []):
+            message = part.get('text', message)
+    words = f"Stub reply to: {message}".split(' ')
+    return [word + ' ' for word in words[:-1]] + words[-1:]
+
+
+def _message_text(payload):
+    return "\n".join(part.get('text', '') for content in payload.get('contents', [])
+                     for part in content.get('parts', []))
+
+
+def _fake_from_schema(schema, seed):
+    """按 (Gemini 风格的) JSON schema 生成确定性的值。"""
+    kind = str(schema.get('type', 'STRING')).upper()
+    if kind == 'OBJECT':
+        return {name: _fake_from_schema(sub, f"{seed}/{name}") for name, sub in schema.get('properties', {}).items()}
+    if kind == 'ARRAY':
+        items = schema.get('items', {})
+        properties = items.get('properties', {})
+        key = next((name for name, sub in properties.items() if sub.get('enum')), None)
+        if key is None:
+            return [_fake_from_schema(items, seed)]
+        return [dict(_fake_from_schema(items, f"{seed}/{value}"), **{key: value}) for value in properties[key]['enum']]
+    if schema.get('enum'):
+        digest = int(hashlib.sha256(seed.encode('utf-8')).hexdigest(), 16)
+        return schema['enum'][digest % len(schema['enum'])]
+    if kind in ('INTEGER', 'NUMBER'):
+        return 0
+    if kind == 'BOOLEAN':
+        return True
+    return "stub"
+
+
+def _reply_text_tokens(payload):
+    """返回回复按词切分的列表：结构化输出请求返回 JSON，其余返回拼接的消息。"""
+    config = payload.get('generationConfig') or {}
+    if config.get('responseSchema'):
+        text = json.dumps(_fake_from_schema(config['responseSchema'], _message_text(payload)), ensure_ascii=False)
+        if random.random() < MALFORMED_RATE:
+            text = text[:len(text) // 2]
+        words = text.split(' ')
+        return [word + ' ' for word in words[:-1]] + words[-1:]
+    return _reply_tokens(payload)
+
+
+def _chunk(text, finish=False):
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finish:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate]}
+
+
+def _check_key():
+    if request.args.get('key') in (None, '', INVALID_KEY):
+        return jsonify({"error": {"code": 400, "message": "API key not valid.", "status": "INVALID_ARGUMENT"}}), 400
+    return None
+
+
+@app.route('/v1beta/models')
+def list_models():
+    return _check_key() or jsonify({"models": [{"name": "models/gemini-2.5-flash"}, {"name": "models/gemini-pro"}]})
+
+
+@app.route('/v1beta/models/<path:target>', methods=['POST'])
+def model_action(target):
+    error = _check_key()
+    if error:
+        return error
+    _, _, action = target.partition(':')
+    tokens = _reply_text_tokens(request.get_json(silent=True) or {})
+    time.sleep(REQUEST_LATENCY)
+
+    if action == 'generateContent':
+        time.sleep(TOKEN_DELAY * len(tokens))
+        return jsonify(_chunk(''.join(tokens), finish=True))
+
+    if action == 'streamGenerateContent':
+        def generate():
+            for index, token in enumerate(tokens):
+                time.sleep(TOKEN_DELAY)
+                chunk = _chunk(token, finish=index == len(tokens) - 1)
+                yield f"data: {json.dumps(chunk)}\r\n\r\n"
+        return Response(generate(), mimetype='text/event-stream')
+
+    return jsonify({"error": {"code": 404, "message": f"Unknown action: {action}"}}), 404
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """使用 HTTP/1.1，让客户端可以复用连接（开发服务器默认 HTTP/1.0，每次请求后断开）。"""
+    protocol_version = "HTTP/1.1"
+
+
+def main():
+    global TOKEN_DELAY, REQUEST_LATENCY, MALFORMED_RATE
+    parser = argparse.ArgumentParser(description="本地 Gemini API 桩服务器")
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--delay', type=float, default=TOKEN_DELAY, help='流式回复中每个词之间的延迟（秒）')
+    parser.add_argument('--latency', type=float, default=REQUEST_LATENCY, help='每个请求额外的固定延迟（秒）')
+    parser.add_argument('--malformed_rate', type=float, default=MALFORMED_RATE,
+                        help='结构化输出回复被截断为无效 JSON 的概率 (0-1)')
+    args = parser.parse_args()
+    TOKEN_DELAY = args.delay
+    REQUEST_LATENCY = args.latency
+    MALFORMED_RATE = args.malformed_rate
+    app.run(host='127.0.0.1', port=args.port, debug=False, threaded=True, request_handler=KeepAliveRequestHandler)
+
+
+if __name__ == '__main__':
+    main()
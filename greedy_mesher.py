@@ -0,0 +1,187 @@
+"""贪心网格化：剔除被相邻体素遮挡的面，把同一平面上相同材质的相邻面合并为大四边形，输出 GLB。
+
+每个面方向的合并全部向量化完成：先沿 u 轴求出同材质的连续段，再把 v 方向上
+起止位置完全相同的连续段叠成矩形。
+"""
+import json
+import struct
+
+import numpy as np
+
+from block_defs import FACE_DIRECTIONS, get_face_texture_key, texture_key_color
+from voxel_grid import block_palette, build_dense_grid
+from voxelizer import GLB_CHUNK_BIN, GLB_CHUNK_JSON, GLB_MAGIC
+
+# 每个法线轴对应的 (v 轴, u 轴)：侧面的 v 轴取 y，使贴图保持竖直
+FACE_PLANE_AXES = {0: (1, 2), 1: (2, 0), 2: (1, 0)}
+
+
+def _runs_along_last_axis(values):
+    """找出最后一个轴上非零且取值相同的连续段，返回 (前导索引..., 起点, 终点(不含), 值)。"""
+    padded = np.pad(values, [(0, 0)] * (values.ndim - 1) + [(1, 1)])
+    current = padded[..., 1:-1]
+    starts = (current != 0) & (current != padded[..., :-2])
+    ends = (current != 0) & (current != padded[..., 2:])
+    start_index = np.nonzero(starts)
+    end_index = np.nonzero(ends)
+    return start_index[:-1], start_index[-1], end_index[-1] + 1, current[starts]
+
+
+def _merge_runs(layer, row, u0, u1, material):
+    """把相邻行中起止相同的连续段合并为矩形，返回 (layer, v0, v1, u0, u1, material)。"""
+    order = np.lexsort((row, material, u1, u0, layer))
+    layer, row, u0, u1, material = layer[order], row[order], u0[order], u1[order], material[order]
+    new_quad = np.ones(len(row), dtype=bool)
+    new_quad[1:] = ((layer[1:] != layer[:-1]) | (u0[1:] != u0[:-1]) | (u1[1:] != u1[:-1])
+                    | (material[1:] != material[:-1]) | (row[1:] != row[:-1] + 1))
+    first = np.flatnonzero(new_quad)
+    last = np.append(first[1:], len(row)) - 1
+    return layer[first], row[first], row[last] + 1, u0[first], u1[first], material[first]
+
+
+def greedy_mesh(coords, block_ids, meta_data):
+    """对体素做贪心网格化，返回 ({材质名: {"positions", "normals", "uvs", "indices"}}, 统计信息)。
+
+    顶点坐标以体素为单位，与输入坐标系一致（体素 (x, y, z) 占据 [x, x+1] × [y, y+1] × [z, z+1]）。
+    """
+    palette, palette_index = block_palette(block_ids, meta_data)
+    grid, origin = build_dense_grid(coords, palette_index)
+
+    texture_keys = []
+    key_index = {}
+    face_materials = {}
+    for face in FACE_DIRECTIONS:
+        table = np.zeros(len(palette) + 1, dtype=np.int32)
+        for index, (block_id, meta) in enumerate(palette.tolist(), start=1):
+            key = get_face_texture_key(block_id, meta, face)
+            if key not in key_index:
+                key_index[key] = len(texture_keys)
+                texture_keys.append(key)
+            table[index] = key_index[key] + 1
+        face_materials[face] = table
+
+    occupied = grid > 0
+    parts = {key: [] for key in texture_keys}
+    quad_count = 0
+    for face, direction in FACE_DIRECTIONS.items():
+        axis = int(np.flatnonzero(direction)[0])
+        sign = direction[axis]
+        neighbor = np.roll(occupied, -sign, axis=axis)
+        visible = occupied & ~neighbor
+        face_material = np.where(visible, face_materials[face][grid], 0)
+
+        v_axis, u_axis = FACE_PLANE_AXES[axis]
+        arranged = np.transpose(face_material, (axis, v_axis, u_axis))
+        (layer, row), u0, u1, material = _runs_along_last_axis(arranged)
+        if len(layer) == 0:
+            continue
+        layer, v0, v1, u0, u1, material = _merge_runs(layer, row, u0, u1, material)
+        quad_count += len(layer)
+
+        plane = layer + (1 if sign > 0 else 0)
+        corners = []
+        for cu, cv in ((u0, v0), (u1, v0), (u1, v1), (u0, v1)):
+            point = np.zeros((len(layer), 3), dtype=np.float64)
+            point[:, axis] = plane
+            point[:, v_axis] = cv
+            point[:, u_axis] = cu
+            corners.append(point + origin)
+        corners = np.stack(corners, axis=1)
+        uvs = np.stack([np.stack((cu - u0, cv - v0), axis=1)
+                        for cu, cv in ((u0, v0), (u1, v0), (u1, v1), (u0, v1))], axis=1).astype(np.float64)
+
+        # 保证逆时针（从外侧看）绕序
+        reference = np.cross(corners[0, 1] - corners[0, 0], corners[0, 3] - corners[0, 0])
+        if np.dot(reference, direction) < 0:
+            corners = corners[:, ::-1]
+            uvs = uvs[:, ::-1]
+
+        for material_index in np.unique(material):
+            selected = material == material_index
+            parts[texture_keys[material_index - 1]].append((corners[selected], uvs[selected], direction))
+
+    primitives = {}
+    for key, chunks in parts.items():
+        if not chunks:
+            continue
+        positions = np.concatenate([c.reshape(-1, 3) for c, _, _ in chunks]).astype(np.float32)
+        uvs = np.concatenate([u.reshape(-1, 2) for _, u, _ in chunks]).astype(np.float32)
+        normals = np.concatenate([np.tile(np.array(d, dtype=np.float32), (len(c) * 4, 1))
+                                  for c, _, d in chunks])
+        base = np.arange(len(positions) // 4, dtype=np.uint32)[:, None] * 4
+        indices = (base + np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)).reshape(-1)
+        primitives[key] = {"positions": positions, "normals": normals, "uvs": uvs, "indices": indices}
+
+    stats = {
+        "voxels": int(len(palette_index)),
+        "quads": int(quad_count),
+        "triangles": int(quad_count * 2),
+        "naiveTriangles": int(len(palette_index) * 12),
+    }
+    return primitives, stats
+
+
+def write_glb(primitives, scale=1.0, translation=(0.0, 0.0, 0.0)):
+    """把 greedy_mesh() 的结果写成 GLB：一个网格、每种材质一个图元，材质名即材质键。"""
+    gltf = {
+        "asset": {"version": "2.0", "generator": "mine-builder greedy mesher"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"name": "voxels", "mesh": 0, "scale": [scale] * 3, "translation": list(translation)}],
+        "meshes": [{"name": "voxels", "primitives": []}],
+        "materials": [],
+        "accessors": [],
+        "bufferViews": [],
+        "buffers": [],
+    }
+    blob = bytearray()
+
+    def add_accessor(array, accessor_type, target, with_bounds=False):
+        while len(blob) % 4:
+            blob.append(0)
+        data = np.ascontiguousarray(array)
+        gltf["bufferViews"].append({"buffer": 0, "byteOffset": len(blob), "byteLength": data.nbytes, "target": target})
+        blob.extend(data.tobytes())
+        accessor = {
+            "bufferView": len(gltf["bufferViews"]) - 1,
+            "componentType": 5125 if data.dtype == np.uint32 else 5126,
+            "count": len(data),
+            "type": accessor_type,
+        }
+        if with_bounds:
+            accessor["min"] = data.min(axis=0).tolist()
+            accessor["max"] = data.max(axis=0).tolist()
+        gltf["accessors"].append(accessor)
+        return len(gltf["accessors"]) - 1
+
+    for key, primitive in primitives.items():
+        color = texture_key_color(key)
+        gltf["materials"].append({
+            "name": key,
+            "pbrMetallicRoughness": {
+                "baseColorFactor": [((color >> 16) & 0xFF) / 255, ((color >> 8) & 0xFF) / 255, (color & 0xFF) / 255, 1.0],
+                "metallicFactor": 0.1,
+                "roughnessFactor": 0.8,
+            },
+        })
+        gltf["meshes"][0]["primitives"].append({
+            "attributes": {
+                "POSITION": add_accessor(primitive["positions"], "VEC3", 34962, with_bounds=True),
+                "NORMAL": add_accessor(primitive["normals"], "VEC3", 34962),
+                "TEXCOORD_0": add_accessor(primitive["uvs"], "VEC2", 34962),
+            },
+            "indices": add_accessor(primitive["indices"], "SCALAR", 34963),
+            "material": len(gltf["materials"]) - 1,
+        })
+    while len(blob) % 4:
+        blob.append(0)
+    gltf["buffers"].append({"byteLength": len(blob)})
+
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+    total = 12 + 8 + len(json_chunk) + 8 + len(blob)
+    return b''.join([
+        struct.pack('<4sII', GLB_MAGIC, 2, total),
+        struct.pack('<II', len(json_chunk), GLB_CHUNK_JSON), json_chunk,
+        struct.pack('<II', len(blob), GLB_CHUNK_BIN), bytes(blob),
+    ])
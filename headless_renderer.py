@@ -0,0 +1,382 @@
+"""无界面 CPU 渲染器：用 NumPy 把体素场景和建筑动画渲染成 PNG 序列或 GIF 动画。
+
+采用正交（等轴测）相机，把每个体素朝向相机的面按固定密度采样成点，
+投影到屏幕后用深度排序实现 z-buffer。各帧相互独立，在进程内共享的进程池中并行渲染。
+进程池用 spawn 方式启动（不从多线程的服务器进程 fork），并发的渲染请求在池中排队。
+
+用法:
+    python headless_renderer.py voxel_output17.txt --effect ripple --out build.gif
+    python headless_renderer.py scene.mbvx --frames 300 --out frames/ --workers 16
+"""
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from PIL import Image
+
+from animation_timelines import (DEFAULT_ANIMATION_DURATION, EASE_IN_OUT_SINE, EASE_LINEAR, EASE_OUT_BACK,
+                                 EASE_OUT_BOUNCE, EASE_OUT_CUBIC, build_timeline, scene_hash)
+from block_defs import FACE_DIRECTIONS, get_face_texture_key, texture_key_color
+from voxel_format import read_voxel_file
+from voxel_grid import build_dense_grid, exposed_mask
+from voxel_txt import read_txt_voxels
+
+BACKGROUND_COLOR = (0x1f, 0x29, 0x37)
+FACE_SHADING = {"top": 1.0, "bottom": 0.5, "east": 0.8, "west": 0.8, "south": 0.65, "north": 0.65}
+CAMERA_VIEWS = {
+    # 相机所在方向（从场景指向相机）
+    "isometric": (1.0, 1.0, 1.0),
+    "isometric-back": (-1.0, 1.0, -1.0),
+    "front": (0.0, 0.35, 1.0),
+    "top": (0.0, 1.0, 0.0001),
+}
+# 每个法线轴对应的 (u 轴, v 轴)：侧面的 v 轴取 y，使贴图保持竖直
+FACE_SAMPLE_AXES = {0: (2, 1), 1: (0, 2), 2: (0, 1)}
+DEFAULT_FPS = 30
+DEFAULT_IMAGE_SIZE = 512
+MAX_RENDER_FRAMES = 1200
+MAX_IMAGE_SIZE = 2048
+# 一次渲染的像素总量上限（帧数 × 边长²），约等于 512px 下 256 帧；所有帧的 RGB 数组同时在内存中
+MAX_RENDER_PIXELS = 64 * 1024 * 1024
+THUMBNAIL_SIZE = 128
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+# --- 缓动函数（与前端 EASING_FUNCTIONS 一致） ---
+
+def apply_easing(easing, t):
+    """对进度数组 t 按每个体素的缓动编号求值。"""
+    easing = easing.astype(np.int64)
+    result = t.copy()
+    cubic = 1 - (1 - t) ** 3
+    back = 1 + 2.70158 * (t - 1) ** 3 + 1.70158 * (t - 1) ** 2
+    n1, d1 = 7.5625, 2.75
+    bounce = np.select(
+        [t < 1 / d1, t < 2 / d1, t < 2.5 / d1],
+        [n1 * t * t, n1 * (t - 1.5 / d1) ** 2 + 0.75, n1 * (t - 2.25 / d1) ** 2 + 0.9375],
+        n1 * (t - 2.625 / d1) ** 2 + 0.984375,
+    )
+    sine = -(np.cos(np.pi * t) - 1) / 2
+    result = np.where(easing == EASE_OUT_CUBIC, cubic, result)
+    result = np.where(easing == EASE_OUT_BACK, back, result)
+    result = np.where(easing == EASE_OUT_BOUNCE, bounce, result)
+    result = np.where(easing == EASE_IN_OUT_SINE, sine, result)
+    return np.where(easing == EASE_LINEAR, t, result)
+
+
+# --- 场景准备 ---
+
+def _camera_basis(view):
+    """返回 (right, up, toward_camera) 三个单位向量。"""
+    toward = np.array(CAMERA_VIEWS[view], dtype=np.float64)
+    toward /= np.linalg.norm(toward)
+    right = np.cross((0.0, 1.0, 0.0), toward)
+    right /= np.linalg.norm(right)
+    up = np.cross(toward, right)
+    return right, up, toward
+
+
+def _face_colors(block_ids, meta_data, faces, atlas):
+    """返回 {面名: (N, 3) 基础颜色} 或贴图采样所需的图集瓦片坐标。"""
+    keys = (np.asarray(block_ids, dtype=np.int64) << 16) | np.asarray(meta_data, dtype=np.int64)
+    palette, inverse = np.unique(keys, return_inverse=True)
+    colors, tiles = {}, {}
+    for face in faces:
+        table = np.zeros((len(palette), 3), dtype=np.float32)
+        tile_table = np.full((len(palette), 4), -1.0, dtype=np.float32)
+        for index, key in enumerate(palette.tolist()):
+            texture_key = get_face_texture_key(key >> 16, key & 0xFFFF, face)
+            color = texture_key_color(texture_key)
+            table[index] = ((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF)
+            if atlas is not None and texture_key in atlas[1]:
+                uv = atlas[1][texture_key]
+                tile_table[index] = (uv["u0"], uv["v0"], uv["u1"], uv["v1"])
+        colors[face] = table[inverse]
+        tiles[face] = tile_table[inverse]
+    return colors, tiles
+
+
+def prepare_render_context(coords, block_ids, meta_data, effect, duration=DEFAULT_ANIMATION_DURATION,
+                           size=DEFAULT_IMAGE_SIZE, view="isometric", atlas=None):
+    """预先计算所有帧共享的数据：时间线、相机、取景范围、面颜色。"""
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+    right, up, toward = _camera_basis(view)
+    faces = [face for face, normal in FACE_DIRECTIONS.items() if np.dot(normal, toward) > 1e-6]
+
+    # 以静止状态的场景包围盒取景，保证各帧画面稳定
+    corners = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float64)
+    points = (coords.min(axis=0) + corners * (np.ptp(coords, axis=0) + 1)) if len(coords) else corners
+    screen_x, screen_y = points @ right, points @ up
+    extent = max(np.ptp(screen_x), np.ptp(screen_y)) * 1.1 or 1.0
+    pixels_per_unit = size / extent
+
+    # 每个面方向上相邻体素的索引（-1 表示没有），用于剔除已落位体素之间的遮挡面
+    index_grid, grid_origin = build_dense_grid(coords, np.arange(1, len(coords) + 1))
+    neighbors = {}
+    for face in faces:
+        local = coords - grid_origin + np.array(FACE_DIRECTIONS[face])
+        neighbors[face] = index_grid[local[:, 0], local[:, 1], local[:, 2]] - 1
+
+    colors, tiles = _face_colors(block_ids, meta_data, faces, atlas)
+    timeline = build_timeline(coords, effect, duration, int(scene_hash(coords)[:8], 16)) if effect else None
+    return {
+        "coords": coords,
+        "timeline": timeline,
+        "size": size,
+        "right": right,
+        "up": up,
+        "toward": toward,
+        "center": ((screen_x.max() + screen_x.min()) / 2, (screen_y.max() + screen_y.min()) / 2),
+        "pixels_per_unit": pixels_per_unit,
+        "faces": faces,
+        "neighbors": neighbors,
+        "colors": colors,
+        "tiles": tiles,
+        "atlas_pixels": np.asarray(atlas[0].convert('RGB'), dtype=np.float32) if atlas is not None else None,
+    }
+
+
+def _voxel_state(context, time):
+    """返回时刻 time 的 (可见体素索引, 体素最小角坐标, 缩放, 全部体素是否已落位)。"""
+    coords = context["coords"].astype(np.float64)
+    timeline = context["timeline"]
+    if timeline is None or time is None:
+        return np.arange(len(coords)), coords, np.ones(len(coords)), np.ones(len(coords), dtype=bool)
+    elapsed = time - timeline[:, 0]
+    landed = elapsed >= timeline[:, 1]
+    visible = np.flatnonzero(elapsed >= 0)
+    line = timeline[visible].astype(np.float64)
+    flight = line[:, 1]
+    progress = np.where(flight > 0, np.clip(elapsed[visible] / np.where(flight > 0, flight, 1), 0, 1), 1.0)
+    eased = apply_easing(line[:, 6], progress)
+    final_centers = coords[visible] + 0.5
+    centers = line[:, 2:5] + (final_centers - line[:, 2:5]) * eased[:, None]
+    scale = line[:, 5] + (1 - line[:, 5]) * eased
+    return visible, centers - 0.5 * scale[:, None], scale, landed
+
+
+# --- 渲染 ---
+
+def render_frame(context, time=None):
+    """渲染单帧，返回 (size, size, 3) uint8 数组。time 为 None 时渲染静止的完整场景。"""
+    size = context["size"]
+    image = np.empty((size, size, 3), dtype=np.float32)
+    image[:] = BACKGROUND_COLOR
+    visible, origins, scale, landed = _voxel_state(context, time)
+    visible_mask = scale > 1e-3
+    visible, origins, scale = visible[visible_mask], origins[visible_mask], scale[visible_mask]
+    if len(visible) == 0:
+        return image.astype(np.uint8)
+
+    right, up, toward = context["right"], context["up"], context["toward"]
+    ppu = context["pixels_per_unit"]
+    # 每个面按比像素更密的网格采样，避免出现空洞
+    samples = max(2, int(np.ceil(ppu * 1.5)))
+    grid = (np.arange(samples) + 0.5) / samples
+    grid_a, grid_b = [g.ravel() for g in np.meshgrid(grid, grid, indexing='ij')]
+
+    all_pixels, all_depth, all_colors = [], [], []
+    for face in context["faces"]:
+        # 自身与相邻体素都已落位时，这个面被挡住，无需采样
+        neighbor = context["neighbors"][face][visible]
+        hidden = landed[visible] & (neighbor >= 0) & landed[np.maximum(neighbor, 0)]
+        face_voxels, face_origins, face_scale = visible[~hidden], origins[~hidden], scale[~hidden]
+        if len(face_voxels) == 0:
+            continue
+
+        normal = np.array(FACE_DIRECTIONS[face], dtype=np.float64)
+        axis = int(np.flatnonzero(normal)[0])
+        edge_axes = FACE_SAMPLE_AXES[axis]
+        base = face_origins.copy()
+        if normal[axis] > 0:
+            base[:, axis] += face_scale
+
+        # (voxel, sample) 的三维采样点
+        points = np.repeat(base[:, None, :], len(grid_a), axis=1)
+        points[:, :, edge_axes[0]] += grid_a[None, :] * face_scale[:, None]
+        points[:, :, edge_axes[1]] += grid_b[None, :] * face_scale[:, None]
+        points = points.reshape(-1, 3)
+
+        px = ((points @ right - context["center"][0]) * ppu + size / 2).astype(np.int64)
+        py = (size / 2 - (points @ up - context["center"][1]) * ppu).astype(np.int64)
+        inside = (px >= 0) & (px < size) & (py >= 0) & (py < size)
+
+        voxel_index = np.repeat(face_voxels, len(grid_a))
+        color = np.repeat(context["colors"][face][face_voxels], len(grid_a), axis=0)
+        atlas_pixels = context["atlas_pixels"]
+        if atlas_pixels is not None:
+            tiles = context["tiles"][face][voxel_index]
+            textured = tiles[:, 0] >= 0
+            if np.any(textured):
+                a = np.tile(grid_a, len(face_voxels))[textured]
+                b = np.tile(grid_b, len(face_voxels))[textured]
+                tile = tiles[textured]
+                height, width = atlas_pixels.shape[:2]
+                u = tile[:, 0] + (tile[:, 2] - tile[:, 0]) * a
+                v = tile[:, 1] + (tile[:, 3] - tile[:, 1]) * b
+                tx = np.clip((u * width).astype(np.int64), 0, width - 1)
+                ty = np.clip(((1 - v) * height).astype(np.int64), 0, height - 1)
+                color[textured] = atlas_pixels[ty, tx]
+
+        all_pixels.append((py * size + px)[inside])
+        all_depth.append((points @ toward)[inside])
+        all_colors.append(color[inside] * FACE_SHADING[face])
+
+    if not all_pixels:
+        return image.astype(np.uint8)
+    pixels = np.concatenate(all_pixels)
+    depth = np.concatenate(all_depth)
+    colors = np.concatenate(all_colors)
+    # z-buffer：按像素分组，每组取离相机最近（深度最大）的采样
+    order = np.lexsort((-depth, pixels))
+    pixels, colors = pixels[order], colors[order]
+    first = np.ones(len(pixels), dtype=bool)
+    first[1:] = pixels[1:] != pixels[:-1]
+    flat = image.reshape(-1, 3)
+    flat[pixels[first]] = colors[first]
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def render_pixels(frame_count, size):
+    """一次渲染的像素总量，与 MAX_RENDER_PIXELS 比较。"""
+    return frame_count * size * size
+
+
+def get_render_pool(workers):
+    """返回进程内共享的渲染进程池（首次调用时以 workers 个 spawn 进程创建）。"""
+    global _POOL, _POOL_PID
+    if _POOL is None or _POOL_PID != os.getpid():
+        with _POOL_LOCK:
+            if _POOL is None or _POOL_PID != os.getpid():
+                _POOL = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                _POOL_PID = os.getpid()
+    return _POOL
+
+
+def _render_frames_worker(context, times):
+    return [render_frame(context, t) for t in times]
+
+
+def render_animation(context, frame_count, duration=DEFAULT_ANIMATION_DURATION, workers=None):
+    """在共享进程池中并行渲染动画，按顺序返回每帧的 uint8 数组。
+
+    每个任务携带一份 context 和一段连续的帧，任务数等于进程数，context 只需序列化这么多次。
+    """
+    times = np.linspace(0, duration, frame_count).tolist()
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or frame_count <= 1:
+        return [render_frame(context, t) for t in times]
+    global _POOL
+    pool = get_render_pool(workers)
+    step = -(-frame_count // workers)
+    try:
+        futures = [pool.submit(_render_frames_worker, context, times[start:start + step])
+                   for start in range(0, frame_count, step)]
+        return [frame for future in futures for frame in future.result()]
+    except BrokenProcessPool:
+        # 工作进程异常退出后进程池不可再用，丢弃它，下次调用时重新创建
+        with _POOL_LOCK:
+            if _POOL is pool:
+                _POOL = None
+        raise
+
+
+def encode_gif(frames, fps=DEFAULT_FPS):
+    """把帧序列编码为循环播放的 GIF 字节串。"""
+    images = [Image.fromarray(frame).quantize(colors=256, method=Image.Quantize.MEDIANCUT) for frame in frames]
+    buffer = io.BytesIO()
+    images[0].save(buffer, format='GIF', save_all=True, append_images=images[1:],
+                   duration=max(1, round(1000 / fps)), loop=0, optimize=False)
+    return buffer.getvalue()
+
+
+def encode_png_zip(frames):
+    """把帧序列打包为包含 frame_0000.png ... 的 zip 字节串。"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zipf:
+        for index, frame in enumerate(frames):
+            png = io.BytesIO()
+            Image.fromarray(frame).save(png, format='PNG')
+            zipf.writestr(f"frame_{index:04d}.png", png.getvalue())
+    return buffer.getvalue()
+
+
+def render_thumbnail(coords, block_ids, meta_data, size=THUMBNAIL_SIZE):
+    """渲染静止场景的等轴测缩略图，返回 PNG 字节串；只渲染暴露在外的体素。"""
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+    exposed = exposed_mask(coords)
+    context = prepare_render_context(coords[exposed], np.asarray(block_ids)[exposed], np.asarray(meta_data)[exposed],
+                                     None, size=size)
+    buffer = io.BytesIO()
+    Image.fromarray(render_frame(context)).save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def load_scene_file(path):
+    """读取 .txt 或 .mbvx 体素场景，返回 (coords, block_ids, meta_data)。"""
+    if path.lower().endswith('.mbvx'):
+        decoded = read_voxel_file(path)
+        return decoded['coords'], decoded['block_ids'], decoded['meta_data']
+    with open(path, 'rb') as f:
+        return read_txt_voxels(f)
+
+
+def main():
+    """命令行入口：渲染场景动画为 GIF 或 PNG 序列。"""
+    from animation_timelines import ANIMATION_EFFECTS
+
+    parser = argparse.ArgumentParser(description="体素场景无界面渲染器")
+    parser.add_argument('scene', help='体素场景文件 (.txt 或 .mbvx)')
+    parser.add_argument('--out', default='build.gif', help='输出 .gif 文件，或用于存放 PNG 帧的目录')
+    parser.add_argument('--effect', default='magic-gradient', choices=sorted(ANIMATION_EFFECTS) + ['none'])
+    parser.add_argument('--duration', type=float, default=DEFAULT_ANIMATION_DURATION, help='动画时长（秒）')
+    parser.add_argument('--fps', type=int, default=DEFAULT_FPS)
+    parser.add_argument('--frames', type=int, help='帧数（默认 duration × fps）')
+    parser.add_argument('--size', type=int, default=DEFAULT_IMAGE_SIZE, help='输出图像边长（像素）')
+    parser.add_argument('--view', default='isometric', choices=sorted(CAMERA_VIEWS))
+    parser.add_argument('--texture-pack', help='可选的材质包 .zip，用贴图代替纯色')
+    parser.add_argument('--workers', type=int, help='渲染进程数（默认 CPU 核数）')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - [RENDER] - %(levelname)s - %(message)s')
+    coords, block_ids, meta_data = load_scene_file(args.scene)
+
+    atlas = None
+    if args.texture_pack:
+        import hashlib
+        from texture_atlas import build_texture_atlas
+        with open(args.texture_pack, 'rb') as f:
+            pack_hash = hashlib.sha256(f.read()).hexdigest()
+        png_path, uv_table = build_texture_atlas(args.texture_pack, pack_hash, "cache")
+        atlas = (Image.open(png_path), uv_table["textures"])
+
+    effect = None if args.effect == 'none' else args.effect
+    context = prepare_render_context(coords, block_ids, meta_data, effect, args.duration, args.size, args.view, atlas)
+    if effect is None:
+        frames = [render_frame(context)]
+    else:
+        frame_count = min(args.frames or int(args.duration * args.fps), MAX_RENDER_FRAMES)
+        frames = render_animation(context, frame_count, args.duration, args.workers)
+
+    if args.out.lower().endswith('.gif'):
+        with open(args.out, 'wb') as f:
+            f.write(encode_gif(frames, args.fps))
+    else:
+        os.makedirs(args.out, exist_ok=True)
+        for index, frame in enumerate(frames):
+            Image.fromarray(frame).save(os.path.join(args.out, f"frame_{index:04d}.png"))
+    logging.info(f"渲染完成: {len(frames)} 帧 -> {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""共享的出站 HTTP 客户端：所有 Gemini 请求和文件下载复用进程内的连接池。
+
+每个进程按用途创建少量 requests.Session，挂载带连接池和重试策略的 HTTPAdapter：
+- 连接保持 (keep-alive)，同一主机的后续请求省去 TCP/TLS 握手；
+- 普通请求每个主机最多 HTTP_POOL_MAXSIZE 个连接，池满时阻塞等待而不是新建连接；
+- 流式请求（stream=True，SSE 和文件下载）使用单独的连接池且池满时不阻塞，
+  长时间占用连接的流不会让普通请求排队；
+- GET 遇到 429/5xx、POST 只在 429/503（请求未被处理）时按指数退避重试，
+  遵守 Retry-After 但最多等待 MAX_RETRY_AFTER 秒；连接错误同样重试；
+- 经过限流器的 Gemini 请求使用 "limited" Session，不在 HTTP 层重试 429，
+  由 GeminiRateLimiter.backoff() 统一暂停该密钥，避免重试绕过限流；
+- 每类请求都有明确的 (连接超时, 读取超时)。
+
+各项参数可用同名环境变量覆盖。
+
+基准测试（默认在后台启动 gemini_stub 作为本地服务器）:
+    python http_client.py --requests 200
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 8))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 16))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+HTTP_BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", 0.5))
+MAX_RETRY_AFTER = float(os.environ.get("HTTP_MAX_RETRY_AFTER", 10))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# POST 不是幂等的：500/502/504 时上游可能已经处理了请求，只有 429/503 明确表示未处理
+POST_RETRY_STATUS_CODES = (429, 503)
+# 受限流器管理的请求：429 交给限流器处理
+LIMITED_RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# (连接超时, 读取超时)，单位秒；流式请求的读取超时指两个分块之间的最长等待时间
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+CHAT_TIMEOUT = (CONNECT_TIMEOUT, float(os.environ.get("HTTP_CHAT_TIMEOUT", 45)))
+VALIDATE_TIMEOUT = (CONNECT_TIMEOUT, float(os.environ.get("HTTP_VALIDATE_TIMEOUT", 10)))
+# 启动时的密钥验证：不重试、超时更短，上游不可用时尽快继续启动
+QUICK_VALIDATE_TIMEOUT = (min(CONNECT_TIMEOUT, 3.0), float(os.environ.get("HTTP_QUICK_VALIDATE_TIMEOUT", 5)))
+DOWNLOAD_TIMEOUT = (CONNECT_TIMEOUT, float(os.environ.get("HTTP_DOWNLOAD_TIMEOUT", 60)))
+
+# 各类 Session 的 create_session 参数；stream=True 的请求另外使用不阻塞的连接池
+SESSION_KINDS = {
+    "default": {},
+    "limited": {"status_forcelist": LIMITED_RETRY_STATUS_CODES},
+    "once": {"retries": 0},
+}
+
+_SESSIONS = {}
+_SESSIONS_PID = None
+_SESSION_LOCK = threading.Lock()
+
+
+class _Retry(Retry):
+    """按请求方法区分可重试的状态码，并限制 Retry-After 的最长等待时间。
+
+    只重试 status_forcelist 中的状态码（urllib3 默认还会重试带 Retry-After 的 413/429/503）。
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code not in (self.status_forcelist or ()):
+            return False
+        if method.upper() == "POST" and status_code not in POST_RETRY_STATUS_CODES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+
+def create_session(pool_maxsize=HTTP_POOL_MAXSIZE, retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR,
+                   pool_block=True, status_forcelist=RETRY_STATUS_CODES):
+    """创建带连接池和重试策略的 Session。"""
+    retry = _Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        # Gemini 的 generateContent 是 POST；可重试的状态码由 _Retry 进一步收窄
+        allowed_methods=frozenset({"GET", "HEAD", "POST"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=pool_maxsize,
+                          max_retries=retry, pool_block=pool_block)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(kind="default", stream=False):
+    """返回进程内共享的某类 Session（首次调用时创建），kind 见 SESSION_KINDS。
+
+    urllib3 连接池本身是线程安全的；共享的 Session 不保存 Cookie 之外的请求状态，
+    调用方应通过参数传递请求头，而不是修改 session.headers。
+    fork 出的子进程（gunicorn 工作进程）不复用父进程的连接，首次调用时重新创建。
+    """
+    global _SESSIONS, _SESSIONS_PID
+    name = (kind, bool(stream))
+    session = _SESSIONS.get(name) if _SESSIONS_PID == os.getpid() else None
+    if session is None:
+        with _SESSION_LOCK:
+            if _SESSIONS_PID != os.getpid():
+                _SESSIONS, _SESSIONS_PID = {}, os.getpid()
+            session = _SESSIONS.get(name)
+            if session is None:
+                options = dict(SESSION_KINDS[kind], pool_block=not stream)
+                session = _SESSIONS[name] = create_session(**options)
+    return session
+
+
+def _reset_after_fork():
+    """在 fork 出的子进程中丢弃父进程的 Session（不关闭：连接仍属于父进程）和可能被持有的锁。"""
+    global _SESSIONS, _SESSIONS_PID, _SESSION_LOCK
+    _SESSIONS, _SESSIONS_PID = {}, None
+    _SESSION_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def http_get(url, timeout=CHAT_TIMEOUT, kind="default", **kwargs):
+    """通过共享 Session 发送 GET 请求（stream=True 时使用流式连接池）。"""
+    return get_session(kind, kwargs.get('stream')).get(url, timeout=timeout, **kwargs)
+
+
+def http_post(url, timeout=CHAT_TIMEOUT, kind="default", **kwargs):
+    """通过共享 Session 发送 POST 请求（stream=True 时使用流式连接池）。"""
+    return get_session(kind, kwargs.get('stream')).post(url, timeout=timeout, **kwargs)
+
+
+class DownloadTooLargeError(Exception):
+    """下载内容超过了允许的大小上限。"""
+
+
+def download_to_file(url, file, max_bytes, timeout=DOWNLOAD_TIMEOUT, chunk_size=1024 * 1024):
+    """把 URL 的内容流式写入已打开的文件对象，超过 max_bytes 时抛出 DownloadTooLargeError。
+
+    返回写入的字节数。Content-Length 已声明超限时不会开始下载。
+    """
+    with http_get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        declared = response.headers.get('Content-Length')
+        if declared and declared.isdigit() and int(declared) > max_bytes:
+            raise DownloadTooLargeError(f"文件大小 {int(declared)} 字节超过上限 {max_bytes} 字节")
+        written = 0
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            written += len(chunk)
+            if written > max_bytes:
+                raise DownloadTooLargeError(f"文件大小超过上限 {max_bytes} 字节")
+            file.write(chunk)
+        return written
+
+
+# --- 基准测试 ---
+
+def _start_stub_server():
+    """在后台线程中启动 gemini_stub（HTTP/1.1，支持 keep-alive），返回 (server, 基础地址)。"""
+    from werkzeug.serving import make_server
+
+    import gemini_stub
+
+    class QuietHandler(gemini_stub.KeepAliveRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    gemini_stub.TOKEN_DELAY = 0
+    server = make_server('127.0.0.1', 0, gemini_stub.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1beta"
+
+
+def benchmark(url, count):
+    """对比每次新建连接（requests.get）与共享连接池（http_get）的单次请求延迟。"""
+    def measure(fetch):
+        timings = []
+        for _ in range(count):
+            start = time.perf_counter()
+            fetch(url).content
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    measure(http_get)  # 预热连接池
+    fresh = measure(lambda u: requests.get(u, timeout=VALIDATE_TIMEOUT))
+    pooled = measure(lambda u: http_get(u, timeout=VALIDATE_TIMEOUT))
+
+    print(f"目标: {url} ({count} 次请求)")
+    for name, timings in (("每次新建连接", fresh), ("共享连接池", pooled)):
+        ordered = sorted(timings)
+        print(f"  {name:<8} 中位数 {statistics.median(ordered):7.2f} ms   "
+              f"p95 {ordered[int(len(ordered) * 0.95) - 1]:7.2f} ms   总计 {sum(ordered):8.1f} ms")
+    saved = statistics.median(fresh) - statistics.median(pooled)
+    print(f"  每次请求节省约 {saved:.2f} ms（中位数）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="出站 HTTP 连接池基准测试")
+    parser.add_argument('--url', help='测试地址（默认在本地启动 gemini_stub 并请求 models 列表）')
+    parser.add_argument('--requests', type=int, default=200, help='每种方式的请求次数')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        server, base = _start_stub_server()
+        url = f"{base}/models?key=benchmark"
+    try:
+        benchmark(url, args.requests)
+    finally:
+        if server:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
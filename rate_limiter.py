@@ -0,0 +1,394 @@
+"""出站 Gemini 请求的限流与合并。
+
+每个 API 密钥有两个令牌桶：每分钟请求数 (rpm) 和每分钟 token 数 (tpm)，为 0 时不限制。
+请求按客户端（浏览器会话、智能体任务）分队列等待，各客户端的队首按轮转顺序放行，
+一个客户端的大量请求不会让其他客户端一直等待。等待超过 max_wait 秒的请求抛出
+RateLimitExceeded（带建议的重试时间），而不是继续涌向上游换来一串 429。
+上游返回 429 时调用 backoff() 暂停该密钥的所有请求。空闲的密钥（无排队、未暂停、桶已补满）
+每 KEY_SWEEP_INTERVAL 秒清理一次，与新建的状态没有区别，不会影响限流。
+
+coalesce() 合并相同的并发请求（single-flight）：同一个键同时只有一个调用在执行，
+其余调用等待并共享它的结果或异常。
+
+限制在进程内生效；多个工作进程时按进程数分摊（见 server.py 的 --gemini_rpm）。
+
+用法（自检）:
+    python rate_limiter.py --rpm 600 --clients 3
+"""
+import argparse
+import collections
+import hashlib
+import statistics
+import threading
+import time
+
+DEFAULT_MAX_WAIT = 30.0
+# 上游返回 429 但没有 Retry-After 时暂停的秒数
+DEFAULT_BACKOFF = 10.0
+# 保留最近这么多次等待时间用于计算分位数
+WAIT_SAMPLES = 1000
+# 清理空闲密钥状态的间隔（秒）
+KEY_SWEEP_INTERVAL = 60.0
+
+
+class RateLimitExceeded(Exception):
+    """在 max_wait 内没有等到配额；retry_after 为建议的重试等待秒数。"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text):
+    """粗略估计 token 数（UTF-8 字节数 / 4，对中文偏低，预算需留有余量）。"""
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def _key_hash(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+
+class _Bucket:
+    """令牌桶：容量为每分钟的配额，按配额 / 60 每秒补充。level 可以为负（实际用量超过预留时）。"""
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, per_minute, now):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+
+class _KeyState:
+    __slots__ = ("requests", "tokens", "queues", "blocked_until", "granted", "rejected")
+
+    def __init__(self, rpm, tpm, now):
+        self.requests = _Bucket(rpm, now) if rpm > 0 else None
+        self.tokens = _Bucket(tpm, now) if tpm > 0 else None
+        self.queues = collections.OrderedDict()  # 客户端 → 等待中的 _Ticket 队列，按轮转顺序排列
+        self.blocked_until = 0.0
+        self.granted = 0
+        self.rejected = 0
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class _Ticket:
+    __slots__ = ("tokens", "granted")
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.granted = False
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GeminiRateLimiter:
+    """按 API 密钥限流的公平队列（线程安全）。"""
+
+    def __init__(self, rpm=0, tpm=0, max_wait=DEFAULT_MAX_WAIT):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._keys = {}
+        self._flights = {}
+        self._waits = collections.deque(maxlen=WAIT_SAMPLES)
+        self._max_queued = 0
+        self._last_sweep = time.monotonic()
+        self._counters = {"granted": 0, "rejected": 0, "coalesced": 0, "backoffs": 0, "evicted": 0}
+
+    @property
+    def enabled(self):
+        return self.rpm > 0 or self.tpm > 0
+
+    # --- 限流 ---
+
+    def _state(self, api_key, now):
+        if now - self._last_sweep >= KEY_SWEEP_INTERVAL:
+            self._evict_idle(now)
+        key_hash = _key_hash(api_key)
+        state = self._keys.get(key_hash)
+        if state is None:
+            state = self._keys[key_hash] = _KeyState(self.rpm, self.tpm, now)
+        return state
+
+    def _evict_idle(self, now):
+        """在持有锁时删除空闲的密钥状态，避免大量不同的密钥让 _keys 无限增长。"""
+        self._last_sweep = now
+        idle = [key_hash for key_hash, state in self._keys.items() if self._is_idle(state, now)]
+        for key_hash in idle:
+            del self._keys[key_hash]
+        self._counters["evicted"] += len(idle)
+
+    @staticmethod
+    def _is_idle(state, now):
+        if state.queues or state.blocked_until > now:
+            return False
+        for bucket in (state.requests, state.tokens):
+            if bucket is not None:
+                bucket.refill(now)
+                if bucket.level < bucket.capacity:
+                    return False
+        return True
+
+    @staticmethod
+    def _wait_time(state, tokens, now):
+        wait = max(0.0, state.blocked_until - now)
+        if state.requests is not None:
+            state.requests.refill(now)
+            wait = max(wait, state.requests.wait_for(1))
+        if state.tokens is not None:
+            state.tokens.refill(now)
+            wait = max(wait, state.tokens.wait_for(tokens))
+        return wait
+
+    def _dispatch(self, state, now):
+        """在持有锁时按轮转顺序放行各客户端的队首请求，返回 (放行数, 下一个请求还需等待的秒数或 None)。"""
+        granted = 0
+        while state.queues:
+            client, queue = next(iter(state.queues.items()))
+            ticket = queue[0]
+            wait = self._wait_time(state, ticket.tokens, now)
+            if wait > 0:
+                return granted, wait
+            if state.requests is not None:
+                state.requests.level -= 1
+            if state.tokens is not None:
+                state.tokens.level -= min(ticket.tokens, state.tokens.capacity)
+            queue.popleft()
+            ticket.granted = True
+            granted += 1
+            # 放行后把该客户端移到队尾（队列为空时删除）
+            del state.queues[client]
+            if queue:
+                state.queues[client] = queue
+        return granted, None
+
+    def _record(self, state, waited):
+        state.granted += 1
+        self._counters["granted"] += 1
+        self._waits.append(waited)
+
+    def acquire(self, api_key, tokens=1, client=None, max_wait=None):
+        """等待 api_key 的配额（一个请求和 tokens 个 token），返回等待的秒数。
+        超过 max_wait（默认为构造时的值）仍未放行时抛出 RateLimitExceeded。"""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        started = time.monotonic()
+        with self._cond:
+            state = self._state(api_key, started)
+            if not self.enabled and state.blocked_until <= started:
+                self._record(state, 0.0)
+                return 0.0
+            ticket = _Ticket(tokens)
+            queue = state.queues.setdefault(client, collections.deque())
+            queue.append(ticket)
+            self._max_queued = max(self._max_queued, sum(key.queued() for key in self._keys.values()))
+            deadline = started + max_wait
+            while True:
+                now = time.monotonic()
+                granted, wait = self._dispatch(state, now)
+                if granted:
+                    self._cond.notify_all()
+                if ticket.granted:
+                    waited = now - started
+                    self._record(state, waited)
+                    return waited
+                if now >= deadline:
+                    queue.remove(ticket)
+                    if not queue and state.queues.get(client) is queue:
+                        del state.queues[client]
+                    state.rejected += 1
+                    self._counters["rejected"] += 1
+                    # 队首可能换成了别的请求，唤醒其他等待者重新检查
+                    self._cond.notify_all()
+                    raise RateLimitExceeded(f"Gemini 请求排队超过 {max_wait:g} 秒，请稍后重试。",
+                                            retry_after=max(1.0, wait or 1.0))
+                self._cond.wait(min(wait if wait is not None else max_wait, deadline - now))
+
+    def settle(self, api_key, reserved, actual):
+        """用上游报告的实际 token 数修正预留的数量（多退少补）。"""
+        if not self.tpm or actual is None:
+            return
+        with self._cond:
+            state = self._state(api_key, time.monotonic())
+            state.tokens.level = min(state.tokens.capacity, state.tokens.level - (actual - reserved))
+            self._cond.notify_all()
+
+    def backoff(self, api_key, seconds=None):
+        """上游返回 429 时调用：在 seconds 秒（默认 DEFAULT_BACKOFF）内暂停该密钥的所有请求。"""
+        seconds = DEFAULT_BACKOFF if seconds is None else seconds
+        with self._cond:
+            state = self._state(api_key, time.monotonic())
+            state.blocked_until = max(state.blocked_until, time.monotonic() + seconds)
+            self._counters["backoffs"] += 1
+
+    # --- 合并相同的请求 ---
+
+    def coalesce(self, key, function):
+        """同一个 key 同时只执行一次 function()，并发的调用者等待并共享其结果（或异常）。"""
+        with self._cond:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._cond:
+                del self._flights[key]
+            flight.done.set()
+
+    # --- 统计 ---
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            waits = sorted(self._waits)
+            keys = {}
+            for key_hash, state in self._keys.items():
+                self._wait_time(state, 1, now)
+                keys[key_hash] = {
+                    "queued": state.queued(),
+                    "clients": len(state.queues),
+                    "granted": state.granted,
+                    "rejected": state.rejected,
+                    "requestsAvailable": None if state.requests is None else round(state.requests.level, 2),
+                    "tokensAvailable": None if state.tokens is None else round(state.tokens.level),
+                    "blockedFor": round(max(0.0, state.blocked_until - now), 2),
+                }
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "maxWait": self.max_wait,
+                "queued": sum(key["queued"] for key in keys.values()),
+                "maxQueued": self._max_queued,
+                "inFlight": len(self._flights),
+                **self._counters,
+                "waitMs": {
+                    "avg": round(statistics.fmean(waits) * 1000, 1) if waits else 0.0,
+                    "p50": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                    "p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                    "max": round(waits[-1] * 1000, 1) if waits else 0.0,
+                },
+                "keys": keys,
+            }
+
+
+# --- 自检 ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini 限流器自检")
+    parser.add_argument('--rpm', type=int, default=600)
+    parser.add_argument('--clients', type=int, default=3)
+    parser.add_argument('--burst', type=int, default=40, help='第一个客户端一次性发出的请求数')
+    parser.add_argument('--requests', type=int, default=5, help='其他客户端各自发出的请求数')
+    args = parser.parse_args()
+
+    failed = False
+    # 1) 公平性：第一个客户端先发出大量请求，其他客户端随后发出少量请求，后者不应排在前者全部请求之后
+    limiter = GeminiRateLimiter(rpm=args.rpm, max_wait=60)
+    # 先用掉桶中的全部配额，之后的请求按 rpm / 60 每秒放行
+    for _ in range(args.rpm):
+        limiter.acquire("key", client="warmup")
+    finished = collections.defaultdict(list)
+    lock = threading.Lock()
+
+    def worker(client):
+        limiter.acquire("key", client=client)
+        with lock:
+            finished[client].append(time.monotonic())
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=("burst",)) for _ in range(args.burst)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    for client in range(1, args.clients):
+        for _ in range(args.requests):
+            thread = threading.Thread(target=worker, args=(f"client{client}",))
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    total = args.burst + (args.clients - 1) * args.requests
+    expected = total * 60.0 / args.rpm
+    small_done = max((max(times) for client, times in finished.items() if client != "burst"), default=0) - started
+    print(f"放行 {total} 个请求用时 {elapsed:.2f} 秒（按速率预计 {expected:.2f} 秒）；"
+          f"小客户端最后完成于 {small_done:.2f} 秒，大客户端最后完成于 {max(finished['burst']) - started:.2f} 秒")
+    if small_done >= max(finished["burst"]) - started:
+        print("  失败: 小客户端没有被公平调度")
+        failed = True
+    print(f"  统计: {limiter.stats()}")
+
+    # 2) 超时：配额耗尽且 max_wait 很短时抛出 RateLimitExceeded
+    limiter = GeminiRateLimiter(rpm=1, max_wait=0.2)
+    limiter.acquire("key")
+    try:
+        limiter.acquire("key")
+        print("失败: 没有抛出 RateLimitExceeded")
+        failed = True
+    except RateLimitExceeded as e:
+        print(f"超时: {e} (retry_after={e.retry_after:.1f}s)")
+
+    # 3) 合并：并发的相同请求只调用一次
+    limiter = GeminiRateLimiter()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return "reply"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(limiter.coalesce("same", slow))) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"合并: 20 个并发调用, 实际执行 {len(calls)} 次, 结果 {set(results)}")
+    failed = failed or len(calls) != 1 or results != ["reply"] * 20
+
+    # 4) 清理：配额已恢复的密钥在下一次清理时被删除，仍在退避的密钥保留
+    limiter = GeminiRateLimiter(rpm=6000)
+    for index in range(100):
+        limiter.acquire(f"key{index}")
+    limiter.backoff("key0", 120)
+    limiter._last_sweep -= KEY_SWEEP_INTERVAL
+    time.sleep(0.02)
+    limiter.acquire("fresh")
+    remaining = len(limiter._keys)
+    print(f"清理: 101 个密钥中保留 {remaining} 个（退避中的密钥和刚使用的密钥）")
+    failed = failed or remaining != 2
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
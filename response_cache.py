@@ -0,0 +1,224 @@
+"""带过期时间的 LRU 缓存，用于缓存聊天回复等可重复使用的上游响应。
+
+内存层按最近使用顺序淘汰；可选的磁盘层把条目以 JSON 文件保存在 disk_dir 下，
+进程重启后仍可命中。两层的条目都带过期时间，过期条目在访问时删除。
+磁盘层在创建时以及之后每隔 DISK_SWEEP_INTERVAL 秒（或写入 disk_max_entries / 10 次后）清理一次：
+删除过期条目和遗留的临时文件，条目仍多于 disk_max_entries 时按最近使用时间（文件 mtime，
+命中时更新）删除最旧的条目。多个进程共用同一目录时各自清理，互不影响。
+写入磁盘失败（磁盘已满等）时只记录警告，条目仍保留在内存层。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+CHAT_CACHE_SUBDIR = "chat"
+DEFAULT_CACHE_ENTRIES = 256
+DEFAULT_CACHE_TTL = 3600.0
+DEFAULT_DISK_ENTRIES = 4096
+DISK_SWEEP_INTERVAL = 300.0
+# 超过这么多秒的 .tmp 文件视为写入中途退出的遗留文件
+STALE_TEMP_AGE = 3600.0
+
+_MISSING = object()
+
+
+def chat_cache_key(model, message):
+    """按 (模型, 规范化后的消息) 计算缓存键：统一 Unicode 形式、去掉首尾空白并合并连续空白。"""
+    normalized = re.sub(r'\s+', ' ', unicodedata.normalize('NFC', message)).strip()
+    return hashlib.sha256(json.dumps([model, normalized], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class LruTtlCache:
+    """线程安全的 LRU + TTL 缓存，值必须可以 JSON 序列化（启用磁盘层时）。"""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL, disk_dir=None,
+                 disk_max_entries=DEFAULT_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._writes_since_sweep = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.sweep_disk()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _store(self, key, expires, value):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _read_disk(self, key, now):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return _MISSING
+        if entry.get('expires', 0) <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return _MISSING
+        try:
+            # 更新 mtime，清理时按最近使用时间淘汰
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['expires'], entry['value']
+
+    def sweep_disk(self):
+        """清理磁盘层：删除过期条目和遗留的临时文件，再把条目数减到 disk_max_entries 以内。返回删除的条目数。"""
+        if not self.disk_dir or not self._sweep_lock.acquire(blocking=False):
+            return 0
+        try:
+            now = time.time()
+            self._last_sweep, self._writes_since_sweep = now, 0
+            live, removed = [], 0
+            with os.scandir(self.disk_dir) as entries:
+                for entry in entries:
+                    try:
+                        mtime = entry.stat().st_mtime
+                        if entry.name.endswith('.tmp'):
+                            if now - mtime > STALE_TEMP_AGE:
+                                os.remove(entry.path)
+                            continue
+                        if not entry.name.endswith('.json'):
+                            continue
+                        with open(entry.path, 'r', encoding='utf-8') as f:
+                            expired = json.load(f).get('expires', 0) <= now
+                    except (AttributeError, ValueError):
+                        expired = True
+                    except OSError:
+                        continue
+                    if expired:
+                        removed += self._remove_file(entry.path)
+                    else:
+                        live.append((mtime, entry.path))
+            if len(live) > self.disk_max_entries:
+                live.sort()
+                for _, path in live[:len(live) - self.disk_max_entries]:
+                    removed += self._remove_file(path)
+            with self._lock:
+                self.disk_evictions += removed
+            return removed
+        finally:
+            self._sweep_lock.release()
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+    def get(self, key, default=None):
+        """返回未过期的缓存值；未命中时返回 default。"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+        if self.disk_dir:
+            entry = self._read_disk(key, now)
+            if entry is not _MISSING:
+                with self._lock:
+                    self._store(key, *entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return entry[1]
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """写入缓存；ttl 缺省时使用缓存的默认过期时间（秒）。"""
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._store(key, expires, value)
+        if self.disk_dir:
+            # 临时文件名在所有进程间唯一，共用同一目录的工作进程不会写入同一个临时文件
+            temp_path = None
+            try:
+                with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.disk_dir, suffix='.tmp',
+                                                 delete=False) as f:
+                    temp_path = f.name
+                    json.dump({"expires": expires, "value": value}, f, ensure_ascii=False)
+                os.replace(temp_path, self._disk_path(key))
+            except OSError as e:
+                logging.warning(f"无法把缓存条目写入磁盘，只保留在内存中: {e}")
+                if temp_path:
+                    self._remove_file(temp_path)
+                return
+            with self._lock:
+                self._writes_since_sweep += 1
+                due = (time.time() - self._last_sweep >= DISK_SWEEP_INTERVAL
+                       or self._writes_since_sweep >= max(1, self.disk_max_entries // 10))
+            if due:
+                self.sweep_disk()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """清空内存层和磁盘层（计数器保留）。"""
+        with self._lock:
+            self._entries.clear()
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.json'):
+                    try:
+                        os.remove(os.path.join(self.disk_dir, name))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "ttl": self.ttl,
+                "disk": bool(self.disk_dir),
+                "diskMaxEntries": self.disk_max_entries if self.disk_dir else None,
+                "diskEvictions": self.disk_evictions,
+                "hits": self.hits,
+                "misses": self.misses,
+                "diskHits": self.disk_hits,
+                "evictions": self.evictions,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+            }
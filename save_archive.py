@@ -0,0 +1,198 @@
+"""存档 zip 的读写。
+
+版本 2 的存档把各部分拆成独立成员，读取时只解析需要的部分:
+    manifest.json       版本、时间戳、各部分对应的成员名、体素数和消息数
+    agent_state.json    智能体状态
+    voxels.mbvx         体素（MBVX 二进制；无法编码为 MBVX 时为 voxels.json）
+    chat.jsonl          聊天记录，每行一条消息
+    thumbnail.png       可选的等轴测缩略图
+
+仍然可以读取版本 1 的存档（单个 save_data.json，体素可能在 voxels.mbvx 中）。
+"""
+import io
+import json
+import zipfile
+
+import numpy as np
+
+from headless_renderer import render_thumbnail
+from voxel_format import (arrays_to_voxel_dict, check_voxel_arrays, decode_voxels, encode_voxels,
+                          voxel_dict_to_arrays)
+from voxel_grid import MAX_GRID_VOLUME, grid_volume
+from zip_stream import iter_bytes, iter_zip_stream
+
+SAVE_FORMAT_VERSION = "2.0"
+MANIFEST_MEMBER = "manifest.json"
+LEGACY_MEMBER = "save_data.json"
+VOXEL_MEMBER_NAME = "voxels.mbvx"
+VOXEL_JSON_MEMBER = "voxels.json"
+CHAT_MEMBER = "chat.jsonl"
+AGENT_MEMBER = "agent_state.json"
+THUMBNAIL_MEMBER = "thumbnail.png"
+SAVE_PARTS = ("voxels", "chat", "agent")
+
+# 存档中各部分在 save_data 中对应的键
+_PART_KEYS = {"voxels": "voxel_data", "chat": "chat_history", "agent": "agent_state"}
+
+
+def parse_save_parts(value):
+    """解析 "voxels,agent" 形式的部分列表；为空时返回全部部分。未知部分抛出 ValueError。"""
+    if not value:
+        return set(SAVE_PARTS)
+    parts = {part.strip() for part in value.split(',') if part.strip()}
+    unknown = parts - set(SAVE_PARTS)
+    if unknown:
+        raise ValueError(f"未知的存档部分: {', '.join(sorted(unknown))}")
+    return parts
+
+
+def _json_bytes(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def iter_save_zip(save_data, tee_path=None, thumbnail=True):
+    """逐块生成版本 2 的存档 zip；tee_path 不为空时同时写入该路径。
+
+    小的清单和智能体状态最先发出，体素在其后编码，缩略图最后渲染。
+    """
+    voxel_data = save_data.get("voxel_data") or {}
+    chat_history = save_data.get("chat_history") or []
+    # 只有能原样还原的体素才写成 MBVX，其余保留为 JSON
+    arrays = voxel_dict_to_arrays(voxel_data, lossless=True) if voxel_data else None
+    if arrays is not None:
+        # 在选定成员名之前检查（含部件索引），避免 MBVX 编码在流的中途失败而截断 zip
+        try:
+            check_voxel_arrays(*arrays[:4])
+        except ValueError:
+            arrays = None
+    voxel_member = VOXEL_MEMBER_NAME if arrays is not None or not voxel_data else VOXEL_JSON_MEMBER
+    members = {"voxels": voxel_member, "chat": CHAT_MEMBER, "agent": AGENT_MEMBER}
+    if thumbnail and arrays is not None and grid_volume(arrays[0]) <= MAX_GRID_VOLUME:
+        members["thumbnail"] = THUMBNAIL_MEMBER
+    manifest = {
+        "version": SAVE_FORMAT_VERSION,
+        "timestamp": save_data.get("timestamp"),
+        "members": members,
+        "voxelCount": len(voxel_data) if isinstance(voxel_data, dict) else None,
+        "chatCount": len(chat_history),
+    }
+    if "snapshot_id" in save_data:
+        manifest["snapshotId"] = save_data["snapshot_id"]
+
+    def voxel_chunks():
+        if voxel_member == VOXEL_JSON_MEMBER:
+            yield _json_bytes(voxel_data)
+        elif arrays is None:
+            yield encode_voxels(np.zeros((0, 3), dtype=np.int64), [], [])
+        else:
+            yield from iter_bytes(encode_voxels(*arrays))
+
+    def chat_chunks():
+        for message in chat_history:
+            yield _json_bytes(message) + b'\n'
+
+    def thumbnail_chunks():
+        coords, block_ids, meta_data, _, _ = arrays
+        yield render_thumbnail(coords, block_ids, meta_data)
+
+    stream_members = [
+        (MANIFEST_MEMBER, zipfile.ZIP_DEFLATED, iter([_json_bytes(manifest)])),
+        (AGENT_MEMBER, zipfile.ZIP_DEFLATED, iter([_json_bytes(save_data.get("agent_state") or {})])),
+        # MBVX 与 PNG 已经压缩过，直接存储
+        (voxel_member, zipfile.ZIP_STORED if voxel_member == VOXEL_MEMBER_NAME else zipfile.ZIP_DEFLATED,
+         voxel_chunks()),
+        (CHAT_MEMBER, zipfile.ZIP_DEFLATED, chat_chunks()),
+    ]
+    if "thumbnail" in members:
+        stream_members.append((THUMBNAIL_MEMBER, zipfile.ZIP_STORED, thumbnail_chunks()))
+    return iter_zip_stream(stream_members, tee_path)
+
+
+def _read_manifest(zipf):
+    try:
+        with zipf.open(MANIFEST_MEMBER) as f:
+            return json.load(f)
+    except KeyError:
+        return None
+
+
+def _read_voxels_member(zipf, member):
+    if member.endswith('.json'):
+        with zipf.open(member) as f:
+            return json.load(f)
+    return arrays_to_voxel_dict(decode_voxels(zipf.read(member)))
+
+
+def read_save(zip_path, parts=SAVE_PARTS):
+    """读取存档中的指定部分，返回 save_data 字典（未请求的部分不会出现在结果中）。"""
+    parts = set(parts)
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        manifest = _read_manifest(zipf)
+        if manifest is None:
+            return _read_legacy_save(zipf, parts)
+
+        members = manifest.get("members", {})
+        save_data = {"version": manifest.get("version"), "timestamp": manifest.get("timestamp")}
+        if "voxels" in parts:
+            save_data["voxel_data"] = _read_voxels_member(zipf, members["voxels"]) if members.get("voxels") else {}
+        if "chat" in parts:
+            chat_history = []
+            if members.get("chat"):
+                with zipf.open(members["chat"]) as f:
+                    chat_history = [json.loads(line) for line in io.TextIOWrapper(f, encoding='utf-8') if line.strip()]
+            save_data["chat_history"] = chat_history
+        if "agent" in parts:
+            agent_state = {}
+            if members.get("agent"):
+                with zipf.open(members["agent"]) as f:
+                    agent_state = json.load(f)
+            save_data["agent_state"] = agent_state
+        return save_data
+
+
+def _read_legacy_save(zipf, parts):
+    """读取版本 1 的存档（只有在请求体素时才解码 MBVX 成员）。"""
+    with zipf.open(LEGACY_MEMBER) as f:
+        save_data = json.load(f)
+    voxel_file = save_data.pop('voxel_file', None)
+    if "voxels" in parts and voxel_file:
+        save_data['voxel_data'] = arrays_to_voxel_dict(decode_voxels(zipf.read(voxel_file)))
+    for part, key in _PART_KEYS.items():
+        if part not in parts:
+            save_data.pop(key, None)
+    return save_data
+
+
+def read_save_voxel_arrays(zip_path):
+    """读取存档的体素数组和缩略图，返回 (时间戳, coords, block_ids, meta_data, 缩略图 PNG 或 None)。
+
+    只读取清单、体素和缩略图成员，不解析聊天记录。
+    """
+    thumbnail = None
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        manifest = _read_manifest(zipf)
+        if manifest is not None:
+            members = manifest.get("members", {})
+            timestamp = manifest.get("timestamp")
+            if members.get("thumbnail"):
+                thumbnail = zipf.read(members["thumbnail"])
+            voxel_member = members.get("voxels")
+            if voxel_member and not voxel_member.endswith('.json'):
+                decoded = decode_voxels(zipf.read(voxel_member))
+                return timestamp, decoded['coords'], decoded['block_ids'], decoded['meta_data'], thumbnail
+            voxel_data = _read_voxels_member(zipf, voxel_member) if voxel_member else {}
+        else:
+            with zipf.open(LEGACY_MEMBER) as f:
+                save_data = json.load(f)
+            timestamp = save_data.get('timestamp')
+            if save_data.get('voxel_file'):
+                decoded = decode_voxels(zipf.read(save_data['voxel_file']))
+                return timestamp, decoded['coords'], decoded['block_ids'], decoded['meta_data'], None
+            voxel_data = save_data.get('voxel_data')
+
+    arrays = voxel_dict_to_arrays(voxel_data)
+    if arrays is None:
+        empty = np.zeros(0, dtype=np.int64)
+        return timestamp, np.zeros((0, 3), dtype=np.int64), empty, empty, thumbnail
+    coords, block_ids, meta_data, _, _ = arrays
+    return timestamp, coords, block_ids, meta_data, thumbnail
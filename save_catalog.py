@@ -0,0 +1,246 @@
+"""存档库目录：用 SQLite 为 SAVE_DIR 中的存档 zip 建立元数据索引和缩略图。
+
+每个存档只在新增或修改（大小、修改时间变化）时读取一次，提取:
+时间戳、体素数、包围盒、方块直方图、文件大小和缩略图 (PNG，优先使用存档中自带的缩略图)。
+列表查询只访问数据库，支持分页、排序和过滤。
+
+同步策略: 每次查询前扫描目录（只读取文件状态，不打开 zip），立即删除已不存在的存档记录；
+新增或修改的存档交给后台线程索引，索引完成前不会出现在查询结果中。
+"""
+import contextlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from headless_renderer import render_thumbnail
+from save_archive import read_save_voxel_arrays
+from voxel_grid import MAX_GRID_VOLUME, grid_volume
+
+CATALOG_FILENAME = "catalog.sqlite3"
+SYNC_INTERVAL = 2.0
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+SORT_COLUMNS = {
+    "timestamp": "timestamp",
+    "name": "name",
+    "size": "size",
+    "voxelCount": "voxel_count",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS saves (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    timestamp TEXT,
+    voxel_count INTEGER NOT NULL DEFAULT 0,
+    min_x INTEGER, min_y INTEGER, min_z INTEGER,
+    max_x INTEGER, max_y INTEGER, max_z INTEGER,
+    histogram TEXT,
+    thumbnail BLOB,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS saves_timestamp ON saves (timestamp);
+CREATE INDEX IF NOT EXISTS saves_voxel_count ON saves (voxel_count);
+CREATE TABLE IF NOT EXISTS save_blocks (
+    name TEXT NOT NULL REFERENCES saves (name) ON DELETE CASCADE,
+    block_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (block_id, name)
+);
+"""
+# 列表查询不读取缩略图本身
+_LIST_COLUMNS = ("name, size, timestamp, voxel_count, min_x, min_y, min_z, max_x, max_y, max_z, histogram, error, "
+                 "thumbnail IS NOT NULL AS has_thumbnail")
+
+
+class SaveCatalog:
+    """SAVE_DIR 的存档目录。数据库连接按调用创建，可在多个线程中使用。"""
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.db_path = os.path.join(save_dir, CATALOG_FILENAME)
+        self._sync_lock = threading.Lock()
+        self._last_sync = 0.0
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._worker = None
+        os.makedirs(save_dir, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """打开数据库连接，退出时提交（出错时回滚）并关闭。"""
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA foreign_keys=ON")
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # --- 同步 ---
+
+    def _scan(self):
+        files = {}
+        with os.scandir(self.save_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith('.zip'):
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def sync(self, wait=False):
+        """使数据库与目录一致：删除已消失的记录，把新增或修改的存档加入索引队列。
+
+        wait 为 True 时在当前线程中完成索引后再返回。返回仍在等待索引的存档数。
+        """
+        with self._sync_lock:
+            now = time.monotonic()
+            if not wait and now - self._last_sync < SYNC_INTERVAL:
+                return len(self._pending)
+            self._last_sync = now
+
+            files = self._scan()
+            with self._connect() as db:
+                known = {row['name']: (row['size'], row['mtime'])
+                         for row in db.execute("SELECT name, size, mtime FROM saves")}
+                removed = [name for name in known if name not in files]
+                if removed:
+                    db.executemany("DELETE FROM saves WHERE name = ?", [(name,) for name in removed])
+                    logging.info(f"存档目录: 移除 {len(removed)} 个已删除的存档。")
+
+            stale = [name for name, stat in files.items() if known.get(name) != stat]
+            if wait:
+                for name in stale:
+                    self.index_save(name)
+                return 0
+            for name in stale:
+                if name not in self._pending:
+                    self._pending.add(name)
+                    self._queue.put(name)
+            if self._pending and (self._worker is None or not self._worker.is_alive()):
+                self._worker = threading.Thread(target=self._index_worker, daemon=True)
+                self._worker.start()
+            return len(self._pending)
+
+    def _index_worker(self):
+        while True:
+            try:
+                name = self._queue.get(timeout=1)
+            except queue.Empty:
+                return
+            try:
+                self.index_save(name)
+            finally:
+                with self._sync_lock:
+                    self._pending.discard(name)
+
+    def index_save(self, name):
+        """读取一个存档并写入（或更新）它的目录记录。"""
+        path = os.path.join(self.save_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        row = {"name": name, "size": stat.st_size, "mtime": stat.st_mtime, "timestamp": None, "voxel_count": 0,
+               "min_x": None, "min_y": None, "min_z": None, "max_x": None, "max_y": None, "max_z": None,
+               "histogram": "{}", "thumbnail": None, "error": None}
+        blocks = []
+        try:
+            timestamp, coords, block_ids, meta_data, thumbnail = read_save_voxel_arrays(path)
+            row["timestamp"] = timestamp or time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(stat.st_mtime))
+            row["voxel_count"] = len(coords)
+            if len(coords):
+                (row["min_x"], row["min_y"], row["min_z"]) = coords.min(axis=0).tolist()
+                (row["max_x"], row["max_y"], row["max_z"]) = coords.max(axis=0).tolist()
+                ids, counts = np.unique(block_ids, return_counts=True)
+                blocks = list(zip(ids.tolist(), counts.tolist()))
+                row["histogram"] = json.dumps({str(block): count for block, count in blocks})
+                # 版本 2 的存档自带缩略图，无需重新渲染
+                if thumbnail is None and grid_volume(coords) <= MAX_GRID_VOLUME:
+                    thumbnail = render_thumbnail(coords, block_ids, meta_data)
+                row["thumbnail"] = thumbnail
+        except Exception as e:
+            logging.warning(f"索引存档 '{name}' 失败: {e}")
+            row["error"] = str(e)
+
+        with self._connect() as db:
+            db.execute("DELETE FROM saves WHERE name = ?", (name,))
+            db.execute(f"INSERT INTO saves ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                       list(row.values()))
+            db.executemany("INSERT INTO save_blocks (name, block_id, count) VALUES (?, ?, ?)",
+                           [(name, block, count) for block, count in blocks])
+
+    # --- 查询 ---
+
+    @staticmethod
+    def _row_to_dict(row):
+        result = {
+            "name": row['name'],
+            "size": row['size'],
+            "timestamp": row['timestamp'],
+            "voxelCount": row['voxel_count'],
+            "boundingBox": None,
+            "blockHistogram": json.loads(row['histogram'] or '{}'),
+            "hasThumbnail": bool(row['has_thumbnail']),
+            "error": row['error'],
+        }
+        if row['min_x'] is not None:
+            result["boundingBox"] = {"min": [row['min_x'], row['min_y'], row['min_z']],
+                                     "max": [row['max_x'], row['max_y'], row['max_z']]}
+        return result
+
+    def query(self, offset=0, limit=DEFAULT_PAGE_SIZE, sort="timestamp", descending=True, name_contains=None,
+              min_voxels=None, max_voxels=None, since=None, until=None, block_id=None):
+        """分页查询存档记录，返回 (符合条件的总数, 记录列表)。"""
+        clauses, params = [], []
+        if name_contains:
+            clauses.append("name LIKE ? ESCAPE '\\'")
+            params.append('%' + name_contains.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if min_voxels is not None:
+            clauses.append("voxel_count >= ?")
+            params.append(min_voxels)
+        if max_voxels is not None:
+            clauses.append("voxel_count <= ?")
+            params.append(max_voxels)
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+        if block_id is not None:
+            clauses.append("name IN (SELECT name FROM save_blocks WHERE block_id = ?)")
+            params.append(block_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        order = f"{SORT_COLUMNS.get(sort, 'timestamp')} {'DESC' if descending else 'ASC'}, name"
+
+        with self._connect() as db:
+            total = db.execute(f"SELECT COUNT(*) FROM saves {where}", params).fetchone()[0]
+            rows = db.execute(f"SELECT {_LIST_COLUMNS} FROM saves {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                              params + [limit, offset]).fetchall()
+        return total, [self._row_to_dict(row) for row in rows]
+
+    def get(self, name):
+        """返回单个存档的记录，不存在时返回 None。"""
+        with self._connect() as db:
+            row = db.execute(f"SELECT {_LIST_COLUMNS} FROM saves WHERE name = ?", (name,)).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def thumbnail(self, name):
+        """返回 (PNG 字节串, 修改时间)；没有缩略图时返回 (None, None)。"""
+        with self._connect() as db:
+            row = db.execute("SELECT thumbnail, mtime FROM saves WHERE name = ?", (name,)).fetchone()
+        if not row or row['thumbnail'] is None:
+            return None, None
+        return row['thumbnail'], row['mtime']
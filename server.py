@@ -1,16 +1,51 @@
 import os
-import base64
+import hashlib
+import gzip
+import mimetypes
 import logging
 import threading
+import time
 import webbrowser
 import requests
 import argparse
 import json
 import datetime
+import re
 import tempfile
-import zipfile
-from urllib.parse import urlparse
-from flask import Flask, jsonify, Response, request, render_template_string, send_file
+import uuid
+
+import numpy as np
+from PIL import Image
+from flask import Flask, g, jsonify, Response, request, send_file, stream_with_context
+
+from agent_jobs import (DEFAULT_AGENT_WORKERS, DEFAULT_BATCH_TOKEN_BUDGET, DEFAULT_JOB_CONCURRENCY, RUNNING_STATES,
+                        AgentJobError, AgentJobRunner, JobStore, batch_response_schema, block_choices, build_batch_prompt, build_part_prompt,
+                        pack_batches, parse_batch_assignment, parse_part_assignment, part_response_schema,
+                        single_part_assigner)
+from animation_timelines import (ANIMATION_EFFECTS, DEFAULT_ANIMATION_DURATION, MAX_ANIMATION_DURATION,
+                                 TIMELINE_STRIDE, build_timeline_cached)
+from download_cache import (DEFAULT_CACHE_MAX_BYTES, DEFAULT_DOWNLOAD_WORKERS, DownloadChangedError, evict_cache,
+                            fetch_cached)
+from greedy_mesher import greedy_mesh, write_glb
+from headless_renderer import (CAMERA_VIEWS, DEFAULT_FPS, DEFAULT_IMAGE_SIZE, MAX_IMAGE_SIZE, MAX_RENDER_FRAMES,
+                               MAX_RENDER_PIXELS, encode_gif, encode_png_zip, prepare_render_context,
+                               render_animation, render_frame, render_pixels)
+from http_client import CHAT_TIMEOUT, QUICK_VALIDATE_TIMEOUT, VALIDATE_TIMEOUT, download_to_file, http_get, http_post
+from rate_limiter import DEFAULT_MAX_WAIT, GeminiRateLimiter, RateLimitExceeded, estimate_tokens
+from response_cache import (CHAT_CACHE_SUBDIR, DEFAULT_CACHE_ENTRIES, DEFAULT_CACHE_TTL, DEFAULT_DISK_ENTRIES, LruTtlCache,
+                            chat_cache_key)
+from save_archive import SAVE_PARTS, iter_save_zip, parse_save_parts, read_save
+from save_catalog import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, SaveCatalog
+from session_store import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_SESSIONS, SessionStore
+from shared_state import SharedState
+from snapshot_store import SNAPSHOT_SUBDIR, SnapshotStore
+from texture_atlas import build_texture_atlas
+from voxel_format import decode_voxels, encode_voxels, voxel_dict_to_arrays
+from voxel_txt import VoxelTxtError, iter_txt_lines, read_txt_voxels
+from voxel_grid import GridTooLargeError, exposed_mask
+from voxelizer import MAX_VOXEL_RESOLUTION, voxelize_model_cached
+from wsgi_server import DEFAULT_THREADS, DEFAULT_WORKERS
+from wsgi_server import serve as serve_production
 
 # --- 配置 ---
 PORT = 5000
@@ -19,18 +54,109 @@ CACHE_DIR = "cache"
 SAVE_DIR = "saves"
 API_KEY_FROM_FILE = None
 API_KEY_VALIDATED = False
-DOWNLOADED_MODEL_PATH = None
-
-# 全局变量保存AI聊天记录和状态
-CHAT_HISTORY = []
-AGENT_STATE = {
+# Gemini API 基础地址，可通过环境变量或 --gemini_api_base 指向本地桩服务器 (gemini_stub.py)
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+# 聊天回复缓存（通过 --chat_cache 启用），未启用时为 None
+CHAT_CACHE = None
+# 管理操作（例如清空聊天缓存）默认只接受来自本机的请求
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1")
+ALLOW_REMOTE_ADMIN = False
+# 出站 Gemini 请求的限流与合并（--gemini_rpm / --gemini_tpm，默认不限流，只合并相同的并发请求）
+GEMINI_LIMITER = GeminiRateLimiter()
+# 限流时为回复预留的 token 数，收到回复后按 usageMetadata 修正
+GEMINI_OUTPUT_TOKEN_RESERVE = 512
+# API 密钥验证结果缓存：有效结果 6 小时，无效结果 5 分钟；有效期过 80% 后在后台刷新
+KEY_VALID_TTL = 6 * 3600.0
+KEY_INVALID_TTL = 300.0
+KEY_REFRESH_FRACTION = 0.8
+KEY_CACHE_SUBDIR = "keys"
+KEY_VALIDATION_CACHE = LruTtlCache(max_entries=64, ttl=KEY_VALID_TTL)
+KEY_REFRESHING = set()
+KEY_REFRESH_LOCK = threading.Lock()
+
+# AI聊天记录和智能体状态按浏览器会话保存；启动时加载的存档和模型路径保存在共享状态中（多个工作进程可见）
+DEFAULT_AGENT_STATE = {
     "is_running": False,
     "is_paused": False,
     "current_part_index": 0,
     "overall_analysis": "",
     "model_name": "gemini-2.5-flash"
 }
-INITIAL_SAVE_DATA = None
+DEFAULT_SHARED_STATE = {
+    "initial_save_data": None,
+    "downloaded_model_path": None,
+}
+SHARED_STATE_FILENAME = "server_state.sqlite3"
+SHARED_STATE = None
+SHARED_STATE_LOCK = threading.Lock()
+SESSION_COOKIE = "mb_session"
+SESSION_SPILL_FILENAME = "sessions.sqlite3"
+SESSION_STORE = None
+SESSION_STORE_LOCK = threading.Lock()
+# 服务器端的材质分配智能体
+AGENT_WORKERS = DEFAULT_AGENT_WORKERS
+AGENT_RUNNER = None
+AGENT_RUNNER_LOCK = threading.Lock()
+# 任务快照和事件保存在 SAVE_DIR 下，任何工作进程都可以查询和控制其他进程中的任务
+AGENT_JOBS_FILENAME = "agent_jobs.sqlite3"
+AGENT_BLOCK_CHOICES = block_choices()
+# 启动时加载的存档在启动后不再改变，每个进程只序列化一次
+INITIAL_SAVE_PAYLOAD = None
+# 页面外壳：编译后的模板和按参数缓存的渲染结果
+PAGE_TEMPLATE = None
+PAGE_SHELL_CACHE = {}
+PAGE_SHELL_LOCK = threading.Lock()
+SNAPSHOT_STORE = None
+SNAPSHOT_STORE_LOCK = threading.Lock()
+SAVE_CATALOG = None
+SAVE_CATALOG_LOCK = threading.Lock()
+DEFAULT_VOXEL_RESOLUTION = 32
+DEFAULT_GRID_SIZE = 10
+# 远程存档的大小上限
+MAX_REMOTE_SAVE_BYTES = 256 * 1024 * 1024
+
+# 前端依赖库（逻辑文件名, CDN 地址）。运行 build_assets.py 后改为从本地 /dist/ 加载
+VENDOR_SCRIPTS = (
+    ("tailwind.js", "https://cdn.tailwindcss.com"),
+    ("three.min.js", "https://cdnjs.cloudflare.com/ajax/libs/three.js/r128/three.min.js"),
+    ("OrbitControls.js", "https://cdn.jsdelivr.net/npm/three@0.128.0/examples/js/controls/OrbitControls.js"),
+    ("GLTFLoader.js", "https://cdn.jsdelivr.net/npm/three@0.128.0/examples/js/loaders/GLTFLoader.js"),
+    ("jszip.min.js", "https://cdnjs.cloudflare.com/ajax/libs/jszip/3.7.1/jszip.min.js"),
+)
+APP_SCRIPT_ASSET = "animator.js"
+ASSET_DIST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "dist")
+ASSET_MANIFEST_NAME = "manifest.json"
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_HASH_LENGTH = 12
+# build_assets.py 生成的文件名: <名称>.<哈希><扩展名>
+ASSET_NAME_PATTERN = re.compile(r"^[\w.-]+\.[0-9a-f]{%d}\.\w+$" % ASSET_HASH_LENGTH)
+# 构建产物清单：逻辑文件名 → 带哈希的文件名；清单文件的修改时间变化（重新构建）后重新加载
+ASSET_MANIFEST = None
+ASSET_MANIFEST_MTIME = None
+
+# 资源文件：默认MIME类型、哈希缓存
+ASSET_DEFAULT_MIME = {
+    "model": "model/gltf-binary",
+    "texture": "application/zip",
+    "reference": "image/png",
+}
+FILE_HASH_CACHE = {}
+FILE_HASH_LOCK = threading.Lock()
+
+def _reset_after_fork():
+    """在 gunicorn 工作进程 fork 后调用：丢弃主进程创建的线程池、后台线程状态和可能被持有的锁，
+    让这些对象在工作进程中按需重新创建。"""
+    global KEY_VALIDATION_CACHE, KEY_REFRESHING, KEY_REFRESH_LOCK, GEMINI_LIMITER
+    global SHARED_STATE_LOCK, SESSION_STORE_LOCK, AGENT_RUNNER, AGENT_RUNNER_LOCK, PAGE_SHELL_LOCK
+    global SNAPSHOT_STORE, SNAPSHOT_STORE_LOCK, SAVE_CATALOG, SAVE_CATALOG_LOCK, FILE_HASH_LOCK
+    cache = KEY_VALIDATION_CACHE
+    KEY_VALIDATION_CACHE = LruTtlCache(cache.max_entries, cache.ttl, cache.disk_dir, cache.disk_max_entries)
+    KEY_REFRESHING, KEY_REFRESH_LOCK = set(), threading.Lock()
+    GEMINI_LIMITER = GeminiRateLimiter(GEMINI_LIMITER.rpm, GEMINI_LIMITER.tpm, GEMINI_LIMITER.max_wait)
+    AGENT_RUNNER, SNAPSHOT_STORE, SAVE_CATALOG = None, None, None
+    SHARED_STATE_LOCK, SESSION_STORE_LOCK, AGENT_RUNNER_LOCK = threading.Lock(), threading.Lock(), threading.Lock()
+    PAGE_SHELL_LOCK, SNAPSHOT_STORE_LOCK, SAVE_CATALOG_LOCK = threading.Lock(), threading.Lock(), threading.Lock()
+    FILE_HASH_LOCK = threading.Lock()
 
 # --- 日志设置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - [SERVER] - %(levelname)s - %(message)s')
@@ -43,6 +169,45 @@ log.setLevel(logging.ERROR)
 
 # --- 后端核心功能 ---
 
+def get_shared_state():
+    """返回共享状态仓库（首次调用时创建）。"""
+    global SHARED_STATE
+    with SHARED_STATE_LOCK:
+        if SHARED_STATE is None:
+            SHARED_STATE = SharedState(os.path.join(SAVE_DIR, SHARED_STATE_FILENAME))
+        return SHARED_STATE
+
+def get_session_store():
+    """返回会话状态仓库（首次调用时以默认配置创建，main() 会按命令行参数重新配置）。"""
+    global SESSION_STORE
+    with SESSION_STORE_LOCK:
+        if SESSION_STORE is None:
+            SESSION_STORE = SessionStore(DEFAULT_AGENT_STATE)
+        return SESSION_STORE
+
+def current_session_id():
+    """返回当前请求的会话 id；请求没有有效的会话 cookie 时分配一个新的（在响应中设置）。"""
+    if 'session_id' not in g:
+        session_id = request.cookies.get(SESSION_COOKIE, '')
+        if len(session_id) != 32 or not all(c in '0123456789abcdef' for c in session_id):
+            session_id = uuid.uuid4().hex
+            g.new_session_id = session_id
+        g.session_id = session_id
+    return g.session_id
+
+@app.after_request
+def _set_session_cookie(response):
+    if 'new_session_id' in g:
+        response.set_cookie(SESSION_COOKIE, g.new_session_id, httponly=True, samesite='Lax')
+    return response
+
+def get_agent_state():
+    return get_session_store().get(current_session_id())["agent_state"]
+
+def record_session_state(chat_history, agent_state):
+    """保存当前会话的聊天记录（为 None 时不变）并合并智能体状态。"""
+    get_session_store().update(current_session_id(), chat_history, agent_state)
+
 def find_first_file(directory, extensions):
     """在指定目录中查找第一个具有给定扩展名的文件。"""
     if not os.path.isdir(directory):
@@ -57,17 +222,44 @@ def find_first_file(directory, extensions):
     logging.warning(f"在 '{directory}' 中未找到类型为 {extensions} 的文件。")
     return None
 
-def read_file_as_base64(filepath):
-    """读取文件并将其内容作为 Base64 编码的字符串返回。"""
+def compute_file_hash(filepath):
+    """计算文件内容的 SHA-256 哈希，按路径、大小和修改时间缓存结果。"""
     if not filepath or not os.path.exists(filepath):
         return None
     try:
+        stat = os.stat(filepath)
+        cache_key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        with FILE_HASH_LOCK:
+            if cache_key in FILE_HASH_CACHE:
+                return FILE_HASH_CACHE[cache_key]
+        digest = hashlib.sha256()
         with open(filepath, "rb") as f:
-            return base64.b64encode(f.read()).decode('utf-8')
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        file_hash = digest.hexdigest()
+        with FILE_HASH_LOCK:
+            FILE_HASH_CACHE[cache_key] = file_hash
+        return file_hash
     except Exception as e:
-        logging.error(f"无法读取文件 {filepath}: {e}")
+        logging.error(f"无法计算文件哈希 {filepath}: {e}")
         return None
 
+def resolve_asset_paths():
+    """定位当前的模型、材质包和参考图文件路径。"""
+    texture_path = find_first_file('.', ['.zip'])
+    downloaded_model_path = get_shared_state().get("downloaded_model_path")
+    if downloaded_model_path:
+        model_path = downloaded_model_path
+        logging.info(f"使用命令行提供的模型: {model_path}")
+    else:
+        model_path = find_first_file(INPUT_DIR, ['.glb', '.gltf'])
+    ref_image_path = find_first_file(INPUT_DIR, ['.png', '.jpg', '.jpeg', '.webp', '.gif'])
+    return {
+        "model": model_path,
+        "texture": texture_path,
+        "reference": ref_image_path,
+    }
+
 # --- 存档功能 ---
 
 def create_save_data(voxel_data=None, chat_history=None, agent_state=None):
@@ -87,57 +279,37 @@ def create_save_data(voxel_data=None, chat_history=None, agent_state=None):
     }
     return save_data
 
-def export_save_file(save_data):
-    """导出存档文件为zip格式"""
-    temp_dir = tempfile.mkdtemp()
-    try:
-        save_json_path = os.path.join(temp_dir, "save_data.json")
-        with open(save_json_path, 'w', encoding='utf-8') as f:
-            json.dump(save_data, f, ensure_ascii=False, indent=2)
-        
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        zip_filename = f"mine_builder_save_{timestamp}.zip"
-        
-        if not os.path.exists(SAVE_DIR):
-            os.makedirs(SAVE_DIR)
-        
-        zip_path = os.path.join(SAVE_DIR, zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(save_json_path, "save_data.json")
-        
-        return zip_path
-    finally:
-        if os.path.exists(temp_dir):
-            import shutil
-            shutil.rmtree(temp_dir)
+def new_save_path():
+    """返回 SAVE_DIR 中带时间戳的新存档路径。"""
+    if not os.path.exists(SAVE_DIR):
+        os.makedirs(SAVE_DIR)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    # 同一秒内的多次导出不能共用同一个 .part 临时文件
+    return os.path.join(SAVE_DIR, f"mine_builder_save_{timestamp}_{uuid.uuid4().hex[:8]}.zip")
+
+def import_save_file(zip_path_or_url, parts=SAVE_PARTS):
+    """导入存档文件，只读取 parts 中列出的部分（voxels、chat、agent）。
 
-def import_save_file(zip_path_or_url):
-    """导入存档文件"""
+    远程存档流式写入临时文件，超过 MAX_REMOTE_SAVE_BYTES 时放弃。
+    """
+    temp_path = None
     try:
         if zip_path_or_url.startswith(('http://', 'https://')):
-            import requests
-            response = requests.get(zip_path_or_url)
-            response.raise_for_status()
-            
-            temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-            temp_zip.write(response.content)
-            temp_zip.close()
-            zip_path = temp_zip.name
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as temp_zip:
+                temp_path = temp_zip.name
+                size = download_to_file(zip_path_or_url, temp_zip, MAX_REMOTE_SAVE_BYTES)
+            logging.info(f"已下载远程存档: {size} 字节")
+            zip_path = temp_path
         else:
             zip_path = zip_path_or_url
-        
-        with zipfile.ZipFile(zip_path, 'r') as zipf:
-            with zipf.open('save_data.json') as f:
-                save_data = json.load(f)
-        
-        if zip_path_or_url.startswith(('http://', 'https://')):
-            os.unlink(zip_path)
-        
-        return save_data
+
+        return read_save(zip_path, parts)
     except Exception as e:
         logging.error(f"导入存档失败: {e}")
         return None
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.unlink(temp_path)
 
 # --- HTML/JavaScript 前端内容（包含动画功能）---
 HTML_CONTENT = """
@@ -147,11 +319,9 @@ HTML_CONTENT = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Minecraft 动画制作器 - AI 助手版</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/three.js/r128/three.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/three@0.128.0/examples/js/controls/OrbitControls.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/three@0.128.0/examples/js/loaders/GLTFLoader.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/jszip/3.7.1/jszip.min.js"></script>
+{% for src in vendor_scripts %}
+    <script src="{{ src }}"></script>
+{% endfor %}
     <style>
         body { background-color: #111827; color: #f3f4f6; overflow: hidden; margin: 0; padding: 0; font-family: sans-serif; }
         #main-container { position: relative; width: 100vw; height: 100vh; }
@@ -223,6 +393,7 @@ HTML_CONTENT = """
                     <button id="view-top" class="bg-blue-600 hover:bg-blue-700 text-white font-medium py-2 px-3 rounded-md text-xs" disabled>顶</button>
                     <button id="view-bottom" class="bg-blue-600 hover:bg-blue-700 text-white font-medium py-2 px-3 rounded-md text-xs" disabled>底</button>
                 </div>
+                <button id="static-view-btn" class="bg-gray-600 hover:bg-gray-700 text-white font-medium py-2 px-3 rounded-md text-xs w-full mt-1.5 disabled:opacity-50" disabled>静态视图 (合并网格)</button>
             </div>
 
             <div class="mt-3 pt-3 border-t border-gray-700">
@@ -369,8 +540,15 @@ HTML_CONTENT = """
     <script>
         window.isKeyPreValidated = {{ is_key_pre_validated | tojson }};
         window.apiKeyFromFile = "{{ api_key_from_file }}";
-        window.initialSaveData = {{ initial_save_data | tojson }};
+        // 初始存档通过单独的压缩接口加载，页面本身不随存档大小变化
+        window.initialSaveData = null;
+        window.initialSaveDataPromise = {{ initial_save_url | tojson }}
+            ? fetch({{ initial_save_url | tojson }}).then(r => r.ok ? r.json() : null).then(data => (window.initialSaveData = data))
+            : Promise.resolve(null);
     </script>
+{% if app_script %}
+    <script type="module" src="{{ app_script }}"></script>
+{% else %}
     <script type="module">
         // ====================================================================
         // Constants and Data
@@ -383,6 +561,22 @@ HTML_CONTENT = """
         const PRO_MODEL_NAME = 'gemini-2.5-pro';
         const AGENT_MAX_RETRIES_PER_PART = 2;
         const MAX_PARTICLES_PER_BLOCK = 30;
+        const SURFACE_CULL_MIN_VOXELS = 4096;
+        const ANIMATION_DURATION_SECONDS = 8;
+        const TIMELINE_STRIDE = 7;
+        const EASING_FUNCTIONS = [
+            t => t,
+            t => 1 - Math.pow(1 - t, 3),
+            t => 1 + 2.70158 * Math.pow(t - 1, 3) + 1.70158 * Math.pow(t - 1, 2),
+            t => {
+                const n1 = 7.5625, d1 = 2.75;
+                if (t < 1 / d1) return n1 * t * t;
+                if (t < 2 / d1) return n1 * (t -= 1.5 / d1) * t + 0.75;
+                if (t < 2.5 / d1) return n1 * (t -= 2.25 / d1) * t + 0.9375;
+                return n1 * (t -= 2.625 / d1) * t + 0.984375;
+            },
+            t => -(Math.cos(Math.PI * t) - 1) / 2,
+        ];
         const DEFAULT_BLOCK_ID_LIST = { "1": { "0": "stone", "1": "granite", "2": "polished_granite", "3": "stone_diorite", "4": "polished_diorite", "5": "andersite", "6": "polished_andersite" }, "2": { "0": { "top": "dirt", "bottom": "dirt", "*": "dirt" } }, "3": { "0": "dirt", "1": "coarse_dirt", "2": "podzol" }, "4": { "0": "cobblestone" }, "5": { "0": "planks_oak", "1": "planks_spruce", "3": "planks_jungle", "4": "planks_acacia", "5": "planks_big_oak" }, "7": { "0": "cobblestone" }, "12": { "0": "sand", "1": "red_sand" }, "13": { "0": "gravel" }, "14": { "0": "gold_ore" }, "15": { "0": "iron_ore" }, "16": { "0": "coal_ore" }, "17": { "0": { "top": "log_oak_top", "bottom": "log_oak_top", "*": "log_oak" }, "1": { "top": "log_spruce_top", "bottom": "log_spruce_top", "*": "log_spruce" }, "2": { "top": "log_birch_top", "bottom": "log_birch_top", "*": "log_birch" }, "3": { "top": "log_jungle_top", "bottom": "log_jungle_top", "*": "log_jungle" }, "4": { "east": "log_oak_top:180", "west": "log_oak_top", "top": "log_oak:270", "bottom": "log_oak:270", "north": "log_oak:90", "south": "log_oak:270" }, "5": { "east": "log_spruce_top:180", "west": "log_spruce_top", "top": "log_spruce:270", "bottom": "log_spruce:270", "north": "log_spruce:90", "south": "log_spruce:270" }, "6": { "east": "log_birch_top:180", "west": "log_birch_top", "top": "log_birch:270", "bottom": "log_birch:270", "north": "log_birch:90", "south": "log_birch:270" }, "7": { "east": "log_jungle_top:180", "west": "log_jungle_top", "top": "log_jungle:270", "bottom": "log_jungle:270", "north": "log_jungle:90", "south": "log_jungle:270" }, "8": { "north": "log_oak_top:180", "south": "log_oak_top", "top": "log_oak", "bottom": "log_oak:180", "east": "log_oak:270", "west": "log_oak:90" }, "9": { "north": "log_spruce_top:180", "south": "log_spruce_top", "top": "log_spruce", "bottom": "log_spruce:180", "east": "log_spruce:270", "west": "log_spruce:90" }, "10": { "north": "log_birch_top:180", "south": "log_birch_top", "top": "log_birch", "bottom": "log_birch:180", "east": "log_birch:270", "west": "log_birch:90" }, "11": { "north": "log_jungle_top:180", "south": "log_jungle_top", "top": "log_jungle", "bottom": "log_jungle:180", "east": "log_jungle:270", "west": "log_jungle:90" }, "12": { "*": "log_oak" }, "13": { "*": "log_spruce" }, "14": { "*": "log_birch" }, "15": { "*": "log_jungle" } }, "19": { "0": "sponge", "1": "wet_sponge" }, "21": { "0": "lapis_ore" }, "22": { "0": "lapis_block" }, "35": { "0": "wool_colored_white", "1": "wool_colored_orange", "2": "wool_colored_magenta", "3": "wool_colored_light_blue", "4": "wool_colored_yellow", "5": "wool_colored_lime", "6": "wool_colored_pink", "7": "wool_colored_gray", "8": "wool_colored_silver", "9": "wool_colored_cyan", "10": "wool_colored_purple", "11": "wool_colored_blue", "12": "wool_colored_brown", "13": "wool_colored_green", "14": "wool_colored_red", "15": "wool_colored_black" }, "41": { "0": "gold_block" }, "42": { "0": "iron_block" }, "43": { "0": { "top": "stone_slab_top", "bottom": "stone_slab_top", "*": "stone_slab_side" }, "1": { "top": "sandstone_top", "bottom": "sandstone_bottom", "*": "sandstone_normal" }, "2": "planks_oak", "3": "cobblestone", "4": "brick", "5": "stonebrick", "6": "nether_brick", "7": "quartz_block_side" }, "45": { "0": "brick" }, "57": { "0": "diamond_block" }, "98": { "0": "stonebrick", "1": "stonebrick_mossy", "2": "stonebrick_cracked", "3": "stonebrick_carved" } };
         const TEXTURE_KEY_TO_COLOR_MAP = { 'stone': 0x888888, 'grass_top': 0x74b44a, 'grass_side': 0x90ac50, 'dirt': 0x8d6b4a, 'cobblestone': 0x7a7a7a, 'planks_oak': 0xaf8f58, 'planks_spruce': 0x806038, 'planks_birch': 0xdace9b, 'planks_jungle': 0xac7d5a, 'planks_acacia': 0xad6c49, 'planks_dark_oak': 0x4c331e, 'bedrock': 0x555555, 'sand': 0xe3dbac, 'gravel': 0x84807b, 'log_oak': 0x685133, 'log_oak_top': 0x9e8054, 'log_spruce': 0x513f27, 'log_spruce_top': 0x716041, 'log_birch': 0xd0cbb0, 'log_birch_top': 0xe0d6b5, 'log_jungle': 0x584c24, 'log_jungle_top': 0x84733c, 'log_acacia': 0x645c50, 'log_acacia_top': 0x918877, 'log_dark_oak': 0x3c2d1b, 'log_big_oak_top': 0x5f4931, 'leaves_oak': 0x44aa44, 'leaves_spruce': 0x4c784c, 'leaves_birch': 0x6aac6a, 'leaves_jungle': 0x48a048, 'leaves_acacia': 0x4c8c4c, 'leaves_dark_oak': 0x4c784c, 'glass': 0xeeeeff, 'glass_pane_top': 0xddddf0, 'brick': 0xa05050, 'obsidian': 0x1c1824, 'diamond_block': 0x7dedde, 'netherrack': 0x883333, 'glowstone': 0xfff055, 'unknown': 0xff00ff };
 
@@ -406,6 +600,11 @@ HTML_CONTENT = """
         const mouseNdc = new THREE.Vector2();
         let isolateTimer = null;
         let allMaterialsCache = null;
+        let staticMeshGroup = null;
+        let surfaceVoxelCoords = null;
+        let surfaceVoxelSource = null;
+        let surfaceVoxelSourceSize = 0;
+        let surfaceRequestPending = false;
 
         // Agent State
         let isAgentRunning = false;
@@ -612,9 +811,12 @@ HTML_CONTENT = """
             const animEffect = document.getElementById('animation-effect-selector');
             const magicTheme = document.getElementById('magic-theme-selector');
             const particleSlider = document.getElementById('particle-density-slider');
+            const staticViewBtn = document.getElementById('static-view-btn');
 
+            clearStaticMeshView();
             const hasVoxels = currentVoxelCoords.size > 0;
             if(exportBtn) exportBtn.disabled = !hasVoxels;
+            if(staticViewBtn) staticViewBtn.disabled = !hasVoxels;
             if(playAnimBtn) playAnimBtn.disabled = !hasVoxels;
             if(animEffect) animEffect.disabled = !hasVoxels;
             if(magicTheme) magicTheme.disabled = !hasVoxels;
@@ -626,7 +828,7 @@ HTML_CONTENT = """
             }
 
             const materialToInstancesMap = new Map();
-            currentVoxelCoords.forEach(coordString => {
+            getRenderableVoxelCoords().forEach(coordString => {
                 const voxelProps = voxelProperties.get(coordString) || DEFAULT_VOXEL_PROPERTIES;
                 const textureKey = getTextureKeyForVoxel(voxelProps.blockId, voxelProps.metaData, DEFAULT_BLOCK_ID_LIST);
                 if (!materialToInstancesMap.has(textureKey)) materialToInstancesMap.set(textureKey, []);
@@ -671,6 +873,106 @@ HTML_CONTENT = """
             updateSelectionUI();
         }
 
+        // ====================================================================
+        // Surface Voxels (interior blocks are skipped for display/animation)
+        // ====================================================================
+        function getRenderableVoxelCoords() {
+            if (currentVoxelCoords.size < SURFACE_CULL_MIN_VOXELS) return currentVoxelCoords;
+            const isFresh = surfaceVoxelCoords && surfaceVoxelSource === currentVoxelCoords
+                && surfaceVoxelSourceSize === currentVoxelCoords.size;
+            if (isFresh) return surfaceVoxelCoords;
+            refreshSurfaceVoxels();
+            return currentVoxelCoords;
+        }
+
+        async function refreshSurfaceVoxels() {
+            if (surfaceRequestPending || currentVoxelCoords.size === 0) return;
+            surfaceRequestPending = true;
+            const source = currentVoxelCoords;
+            const sourceSize = source.size;
+            try {
+                const response = await fetch('/api/voxels/surface', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ voxelData: collectVoxelData() })
+                });
+                if (!response.ok) return;
+                const result = await response.json();
+                if (source !== currentVoxelCoords || sourceSize !== currentVoxelCoords.size) return;
+                const exposed = new Set();
+                for (let i = 0; i < result.exposed.length; i += 3) {
+                    exposed.add(`${result.exposed[i]},${result.exposed[i + 1]},${result.exposed[i + 2]}`);
+                }
+                surfaceVoxelCoords = exposed;
+                surfaceVoxelSource = source;
+                surfaceVoxelSourceSize = sourceSize;
+                if (!isAnimationPlaying) displayVoxels();
+            } catch (error) {
+                console.error("Surface voxel request failed:", error);
+            } finally {
+                surfaceRequestPending = false;
+            }
+        }
+
+        // ====================================================================
+        // Static Mesh View (server-side greedy meshing)
+        // ====================================================================
+        function collectVoxelData(coords = currentVoxelCoords) {
+            const voxelData = {};
+            coords.forEach(coordString => {
+                voxelData[coordString] = voxelProperties.get(coordString) || DEFAULT_VOXEL_PROPERTIES;
+            });
+            return voxelData;
+        }
+
+        function clearStaticMeshView() {
+            if (!staticMeshGroup) return;
+            scene.remove(staticMeshGroup);
+            staticMeshGroup.traverse(obj => {
+                if (obj.geometry) obj.geometry.dispose();
+                if (obj.material) obj.material.dispose();
+            });
+            staticMeshGroup = null;
+            voxelContainerGroup.visible = true;
+        }
+
+        async function toggleStaticMeshView() {
+            if (staticMeshGroup) {
+                clearStaticMeshView();
+                return;
+            }
+            if (currentVoxelCoords.size === 0 || isAnimationPlaying) return;
+            const response = await fetch(`/api/mesh?gridSize=${GRID_SIZE}&resolution=${VOXEL_RESOLUTION}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ voxelData: collectVoxelData() })
+            });
+            if (!response.ok) {
+                console.error("Static mesh request failed:", response.status);
+                return;
+            }
+            const buffer = await response.arrayBuffer();
+            new THREE.GLTFLoader().parse(buffer, '', gltf => {
+                gltf.scene.traverse(obj => {
+                    if (!obj.isMesh) return;
+                    // 材质名即材质键；合并后的大四边形需要重复平铺贴图
+                    const texture = loadedTextures.get(obj.material.name);
+                    if (texture) {
+                        const repeated = texture.clone();
+                        repeated.wrapS = repeated.wrapT = THREE.RepeatWrapping;
+                        repeated.needsUpdate = true;
+                        obj.material.map = repeated;
+                        obj.material.color.set(0xffffff);
+                    }
+                    obj.castShadow = true;
+                    obj.receiveShadow = true;
+                });
+                staticMeshGroup = gltf.scene;
+                voxelContainerGroup.visible = false;
+                scene.add(staticMeshGroup);
+            }, error => console.error("Failed to parse static mesh:", error));
+        }
+
         // ====================================================================
         // Animation Functions (Simplified Core)
         // ====================================================================
@@ -678,6 +980,7 @@ HTML_CONTENT = """
             if (isAnimationPlaying || currentVoxelCoords.size === 0) return;
             
             isAnimationPlaying = true;
+            clearStaticMeshView();
             document.getElementById('play-animation-btn').classList.add('hidden');
             document.getElementById('stop-animation-btn').classList.remove('hidden');
             
@@ -689,18 +992,113 @@ HTML_CONTENT = """
             // Set particle system visibility
             particleSystem.visible = (currentMagicTheme !== 'none' && particleDensity > 0);
             
-            // Start animation based on effect
-            switch (currentAnimationEffect) {
-                case 'layer-scan':
-                    animateLayerScan();
-                    break;
-                case 'ripple':
-                    animateRipple();
-                    break;
-                default:
-                    animateRandomSequence();
-                    break;
+            // Play the server-computed timeline; fall back to client-side sequencing if it is unavailable
+            animateFromTimeline().catch(error => {
+                console.error("Timeline animation failed, falling back:", error);
+                if (!isAnimationPlaying) return;
+                if (currentAnimationEffect === 'layer-scan') animateLayerScan();
+                else animateRandomSequence();
+            });
+        }
+
+        function createVoxelMaterial(textureKey) {
+            const texture = loadedTextures.get(textureKey);
+            if (texture) return new THREE.MeshStandardMaterial({ map: texture, metalness: 0.1, roughness: 0.8 });
+            const color = TEXTURE_KEY_TO_COLOR_MAP[textureKey] || TEXTURE_KEY_TO_COLOR_MAP['unknown'];
+            return new THREE.MeshLambertMaterial({ color });
+        }
+
+        async function fetchAnimationTimeline(voxelArray, effect) {
+            const params = new URLSearchParams({ effect, duration: ANIMATION_DURATION_SECONDS });
+            const response = await fetch(`/api/animation/timeline?${params}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ voxelData: collectVoxelData(voxelArray) })
+            });
+            if (!response.ok) throw new Error(`Timeline request failed: ${response.status}`);
+            return new Float32Array(await response.arrayBuffer());
+        }
+
+        async function animateFromTimeline() {
+            const voxelArray = Array.from(getRenderableVoxelCoords());
+            const timeline = await fetchAnimationTimeline(voxelArray, currentAnimationEffect);
+            if (!isAnimationPlaying) return;
+
+            const halfGrid = GRID_SIZE / 2;
+            const finalCenters = new Float32Array(voxelArray.length * 3);
+            const groups = new Map();
+            let totalTime = 0;
+            voxelArray.forEach((coordString, index) => {
+                const [x, y, z] = coordString.split(',').map(Number);
+                finalCenters.set([x + 0.5, y + 0.5, z + 0.5], index * 3);
+                const voxelProps = voxelProperties.get(coordString) || DEFAULT_VOXEL_PROPERTIES;
+                const textureKey = getTextureKeyForVoxel(voxelProps.blockId, voxelProps.metaData, DEFAULT_BLOCK_ID_LIST);
+                if (!groups.has(textureKey)) groups.set(textureKey, []);
+                groups.get(textureKey).push(index);
+                const base = index * TIMELINE_STRIDE;
+                totalTime = Math.max(totalTime, timeline[base] + timeline[base + 1]);
+            });
+
+            const geometry = new THREE.BoxGeometry(VOXEL_SIZE * 0.98, VOXEL_SIZE * 0.98, VOXEL_SIZE * 0.98);
+            const batches = [];
+            groups.forEach((indices, textureKey) => {
+                const mesh = new THREE.InstancedMesh(geometry, createVoxelMaterial(textureKey), indices.length);
+                mesh.castShadow = true;
+                mesh.receiveShadow = true;
+                mesh.instanceMatrix.setUsage(THREE.DynamicDrawUsage);
+                voxelContainerGroup.add(mesh);
+                batches.push({ mesh, indices, landed: new Uint8Array(indices.length) });
+            });
+
+            const matrix = new THREE.Matrix4();
+            const position = new THREE.Vector3();
+            const quaternion = new THREE.Quaternion();
+            const scale = new THREE.Vector3();
+            const emitEnabled = currentMagicTheme !== 'none' && particleDensity > 0;
+            const startMs = performance.now();
+
+            function step() {
+                if (!isAnimationPlaying) return;
+                const elapsed = (performance.now() - startMs) / 1000;
+                batches.forEach(({ mesh, indices, landed }) => {
+                    indices.forEach((voxelIndex, i) => {
+                        const base = voxelIndex * TIMELINE_STRIDE;
+                        const t = elapsed - timeline[base];
+                        if (t < 0) {
+                            scale.set(0, 0, 0);
+                            position.set(0, 0, 0);
+                        } else {
+                            const flight = timeline[base + 1];
+                            const progress = flight > 0 ? Math.min(1, t / flight) : 1;
+                            const eased = EASING_FUNCTIONS[timeline[base + 6]](progress);
+                            const c = voxelIndex * 3;
+                            const vx = timeline[base + 2] + (finalCenters[c] - timeline[base + 2]) * eased;
+                            const vy = timeline[base + 3] + (finalCenters[c + 1] - timeline[base + 3]) * eased;
+                            const vz = timeline[base + 4] + (finalCenters[c + 2] - timeline[base + 4]) * eased;
+                            const s = timeline[base + 5] + (1 - timeline[base + 5]) * eased;
+                            position.set(-halfGrid + vx * VOXEL_SIZE, vy * VOXEL_SIZE, -halfGrid + vz * VOXEL_SIZE);
+                            scale.set(s, s, s);
+                            if (progress >= 1 && !landed[i]) {
+                                landed[i] = 1;
+                                if (emitEnabled) emitParticles({ x: position.x, y: position.y, z: position.z }, currentMagicTheme);
+                            }
+                        }
+                        matrix.compose(position, quaternion, scale);
+                        mesh.setMatrixAt(i, matrix);
+                    });
+                    mesh.instanceMatrix.needsUpdate = true;
+                });
+                if (elapsed > totalTime) {
+                    isAnimationPlaying = false;
+                    document.getElementById('play-animation-btn').classList.remove('hidden');
+                    document.getElementById('stop-animation-btn').classList.add('hidden');
+                    displayVoxels();
+                    return;
+                }
+                requestAnimationFrame(step);
             }
+
+            step();
         }
 
         function stopBuildAnimation() {
@@ -712,7 +1110,7 @@ HTML_CONTENT = """
         }
 
         function animateRandomSequence() {
-            const voxelArray = Array.from(currentVoxelCoords);
+            const voxelArray = Array.from(getRenderableVoxelCoords());
             let index = 0;
             const delay = 30;
             
@@ -764,7 +1162,7 @@ HTML_CONTENT = """
 
         function animateLayerScan() {
             const layerMap = new Map();
-            currentVoxelCoords.forEach(coordString => {
+            getRenderableVoxelCoords().forEach(coordString => {
                 const [x, y, z] = coordString.split(',').map(Number);
                 if (!layerMap.has(y)) layerMap.set(y, []);
                 layerMap.get(y).push(coordString);
@@ -822,11 +1220,6 @@ HTML_CONTENT = """
             placeNextLayer();
         }
 
-        function animateRipple() {
-            // Simplified ripple animation
-            animateRandomSequence();
-        }
-
         // ====================================================================
         // Particle System
         // ====================================================================
@@ -953,6 +1346,7 @@ HTML_CONTENT = """
             });
             
             document.getElementById('play-animation-btn')?.addEventListener('click', playBuildAnimation);
+            document.getElementById('static-view-btn')?.addEventListener('click', toggleStaticMeshView);
             document.getElementById('stop-animation-btn')?.addEventListener('click', stopBuildAnimation);
         });
         
@@ -960,6 +1354,7 @@ HTML_CONTENT = """
         function updateSelectionHighlight() {}
         function unlockUI() {}
     </script>
+{% endif %}
 </body>
 </html>
 """
@@ -967,55 +1362,499 @@ HTML_CONTENT = """
 # 此处省略了超长的JavaScript代码，实际代码会在下一个文件中完成
 
 # --- Flask 路由 ---
+def _gzip_payload(body):
+    """返回 (原始字节, gzip 字节, ETag)，供预先压缩的响应使用。"""
+    return body, gzip.compress(body, compresslevel=6), hashlib.sha256(body).hexdigest()[:32]
+
+def _precompressed_response(payload, mimetype):
+    """按 Accept-Encoding 返回预先压缩或原始内容，带 ETag，客户端每次都需重新验证。"""
+    body, compressed, etag = payload
+    use_gzip = 'gzip' in request.accept_encodings
+    response = Response(compressed if use_gzip else body, mimetype=mimetype)
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response.make_conditional(request)
+
+def load_asset_manifest():
+    """读取 build_assets.py 生成的清单；没有构建产物时返回空字典（页面继续使用 CDN）。"""
+    path = os.path.join(ASSET_DIST_DIR, ASSET_MANIFEST_NAME)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"无法读取前端资源清单 '{path}'，使用 CDN: {e}")
+        return {}
+    logging.info(f"使用本地前端资源: {', '.join(sorted(manifest))}")
+    return manifest
+
+def get_asset_manifest():
+    global ASSET_MANIFEST, ASSET_MANIFEST_MTIME
+    try:
+        mtime = os.path.getmtime(os.path.join(ASSET_DIST_DIR, ASSET_MANIFEST_NAME))
+    except OSError:
+        mtime = None
+    if ASSET_MANIFEST is None or mtime != ASSET_MANIFEST_MTIME:
+        ASSET_MANIFEST, ASSET_MANIFEST_MTIME = load_asset_manifest(), mtime
+    return ASSET_MANIFEST
+
+def _asset_url(name):
+    hashed = get_asset_manifest().get(name)
+    return f"/dist/{hashed}" if hashed else None
+
+def get_page_shell():
+    """返回渲染好的页面外壳。模板只编译一次，同样的参数只渲染一次。"""
+    global PAGE_TEMPLATE
+    context = {
+        "api_key_from_file": API_KEY_FROM_FILE if API_KEY_VALIDATED else '',
+        "is_key_pre_validated": API_KEY_VALIDATED,
+        "initial_save_url": "/api/save/initial" if get_initial_save_payload() else None,
+        "vendor_scripts": [_asset_url(name) or cdn_url for name, cdn_url in VENDOR_SCRIPTS],
+        "app_script": _asset_url(APP_SCRIPT_ASSET),
+    }
+    key = json.dumps(context, sort_keys=True)
+    with PAGE_SHELL_LOCK:
+        if key not in PAGE_SHELL_CACHE:
+            if PAGE_TEMPLATE is None:
+                PAGE_TEMPLATE = app.jinja_env.from_string(HTML_CONTENT)
+            PAGE_SHELL_CACHE.clear()
+            PAGE_SHELL_CACHE[key] = _gzip_payload(PAGE_TEMPLATE.render(**context).encode('utf-8'))
+        return PAGE_SHELL_CACHE[key]
+
+def get_initial_save_payload():
+    """返回启动时加载的存档的 JSON（预先压缩，只序列化一次），没有时返回 None。"""
+    global INITIAL_SAVE_PAYLOAD
+    with PAGE_SHELL_LOCK:
+        if INITIAL_SAVE_PAYLOAD is None:
+            save_data = get_shared_state().get("initial_save_data")
+            if not save_data:
+                INITIAL_SAVE_PAYLOAD = False
+            else:
+                body = json.dumps(save_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                INITIAL_SAVE_PAYLOAD = _gzip_payload(body)
+        return INITIAL_SAVE_PAYLOAD or None
+
 @app.route('/')
 def index():
-    """提供主HTML页面内容。"""
-    return render_template_string(
-        HTML_CONTENT,
-        api_key_from_file=API_KEY_FROM_FILE if API_KEY_VALIDATED else '',
-        is_key_pre_validated=API_KEY_VALIDATED,
-        initial_save_data=INITIAL_SAVE_DATA
-    )
+    """提供主HTML页面（可缓存的外壳，以 ETag 验证）。"""
+    return _precompressed_response(get_page_shell(), 'text/html')
+
+@app.route('/dist/<name>')
+def get_built_asset(name):
+    """提供 build_assets.py 生成的带哈希的前端资源，优先返回预先压缩的 .br / .gz 版本，长期缓存。
+
+    不只限于当前清单中的文件：重新构建后，已经打开的旧页面（或其他工作进程中的旧清单）
+    仍能加载上一次构建保留下来的文件。"""
+    path = os.path.join(ASSET_DIST_DIR, name)
+    if not ASSET_NAME_PATTERN.match(name) or not os.path.isfile(path):
+        return jsonify({"success": False, "message": "资源不存在。"}), 404
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    encoding = None
+    for candidate, extension in (('br', '.br'), ('gzip', '.gz')):
+        if candidate in request.accept_encodings and os.path.isfile(path + extension):
+            encoding, path = candidate, path + extension
+            break
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=ASSET_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/save/initial')
+def get_initial_save():
+    """API端点，返回启动时通过 --input_data 加载的存档（gzip 压缩，以 ETag 验证）。"""
+    payload = get_initial_save_payload()
+    if not payload:
+        return jsonify({"success": False, "message": "没有初始存档。"}), 404
+    return _precompressed_response(payload, 'application/json')
 
 @app.route('/api/files')
 def get_initial_files():
-    """API端点，用于扫描并提供初始的模型、材质和参考文件。"""
+    """API端点，返回初始模型、材质和参考文件的清单（文件内容通过 /api/assets/<kind> 获取）。"""
     logging.info("收到自动加载文件的请求...")
 
-    texture_path = find_first_file('.', ['.zip'])
-    model_path = None
-    if DOWNLOADED_MODEL_PATH:
-        model_path = DOWNLOADED_MODEL_PATH
-        logging.info(f"使用命令行提供的模型: {model_path}")
-    else:
-        model_path = find_first_file(INPUT_DIR, ['.glb', '.gltf'])
-
-    ref_image_path = find_first_file(INPUT_DIR, ['.png', '.jpg', '.jpeg', '.webp', '.gif'])
-
-    def prepare_file_data(path, default_mime='application/octet-stream'):
-        if not path:
+    def prepare_file_entry(kind, path):
+        if not path or not os.path.isfile(path):
+            return None
+        file_hash = compute_file_hash(path)
+        if not file_hash:
             return None
-        import mimetypes
         mime_type, _ = mimetypes.guess_type(path)
         return {
             "name": os.path.basename(path),
-            "data": read_file_as_base64(path),
-            "mimeType": mime_type or default_mime
+            "size": os.path.getsize(path),
+            "mimeType": mime_type or ASSET_DEFAULT_MIME[kind],
+            "hash": file_hash,
+            "url": f"/api/assets/{kind}?v={file_hash[:16]}",
         }
 
-    response_data = {
-        "model": prepare_file_data(model_path, 'model/gltf-binary'),
-        "texture": prepare_file_data(texture_path, 'application/zip'),
-        "reference": prepare_file_data(ref_image_path, 'image/png'),
-    }
-
-    final_response = {k: v for k, v in response_data.items() if v and v.get('data')}
+    response_data = {kind: prepare_file_entry(kind, path) for kind, path in resolve_asset_paths().items()}
+    final_response = {k: v for k, v in response_data.items() if v}
 
     logging.info(f"文件扫描完成。结果: 模型={'找到' if 'model' in final_response else '未找到'}, "
                  f"材质包={'找到' if 'texture' in final_response else '未找到'}, "
                  f"参考图={'找到' if 'reference' in final_response else '未找到'}.")
 
-    return jsonify(final_response)
+    response = jsonify(final_response)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/assets/<kind>')
+def get_asset(kind):
+    """API端点，以二进制流形式提供资源文件，支持 ETag/If-None-Match 与 Range 请求。"""
+    if kind not in ASSET_DEFAULT_MIME:
+        return jsonify({"error": f"未知的资源类型: {kind}"}), 404
+
+    path = resolve_asset_paths().get(kind)
+    if not path or not os.path.isfile(path):
+        return jsonify({"error": "资源文件不存在。"}), 404
+
+    file_hash = compute_file_hash(path)
+    mime_type, _ = mimetypes.guess_type(path)
+    response = send_file(
+        os.path.abspath(path),
+        mimetype=mime_type or ASSET_DEFAULT_MIME[kind],
+        download_name=os.path.basename(path),
+        conditional=True,
+        etag=file_hash,
+    )
+    # 每次都向服务器重新验证：内容未变化时只需一个 304 响应
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = None
+    return response
+
+def _current_texture_atlas():
+    """为当前材质包构建（或读取缓存的）材质图集，返回 (材质包哈希, 图集 PNG, UV 表)，没有材质包时返回 None。
+
+    无法计算材质包哈希时哈希为 None，图集 PNG 为不缓存的内存文件。"""
+    zip_path = resolve_asset_paths().get("texture")
+    if not zip_path:
+        return None
+    zip_hash = compute_file_hash(zip_path)
+    png_path, uv_table = build_texture_atlas(zip_path, zip_hash, CACHE_DIR)
+    return zip_hash, png_path, uv_table
+
+@app.route('/api/texture_atlas')
+def get_texture_atlas():
+    """API端点，返回材质图集的 UV 表和图集图片地址。"""
+    try:
+        atlas = _current_texture_atlas()
+    except Exception as e:
+        logging.error(f"构建材质图集失败: {e}")
+        return jsonify({"error": f"构建材质图集失败: {e}"}), 500
+    if not atlas:
+        return jsonify({"error": "未找到材质包。"}), 404
+
+    zip_hash, _, uv_table = atlas
+    url = f"/api/texture_atlas.png?v={zip_hash[:16]}" if zip_hash else "/api/texture_atlas.png"
+    response = jsonify(dict(uv_table, url=url))
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/texture_atlas.png')
+def get_texture_atlas_image():
+    """API端点，提供材质图集 PNG（以材质包哈希作为 ETag）。"""
+    try:
+        atlas = _current_texture_atlas()
+    except Exception as e:
+        logging.error(f"构建材质图集失败: {e}")
+        return jsonify({"error": f"构建材质图集失败: {e}"}), 500
+    if not atlas:
+        return jsonify({"error": "未找到材质包。"}), 404
+
+    zip_hash, png, _ = atlas
+    if zip_hash is None:
+        response = send_file(png, mimetype='image/png', etag=False)
+    else:
+        response = send_file(os.path.abspath(png), mimetype='image/png', conditional=True, etag=zip_hash)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/voxelize', methods=['GET', 'POST'])
+def voxelize_current_model():
+    """API端点，在服务器端体素化当前模型，返回体素坐标及其所属部件。"""
+    data = request.get_json(silent=True) or {}
+    try:
+        resolution = int(data.get('resolution', request.args.get('resolution', DEFAULT_VOXEL_RESOLUTION)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "resolution 必须是整数。"}), 400
+    if not 1 <= resolution <= MAX_VOXEL_RESOLUTION:
+        return jsonify({"error": f"resolution 必须在 1 到 {MAX_VOXEL_RESOLUTION} 之间。"}), 400
+
+    model_path = resolve_asset_paths().get("model")
+    if not model_path:
+        return jsonify({"error": "未找到模型文件。"}), 404
+
+    model_hash = compute_file_hash(model_path)
+    try:
+        result = voxelize_model_cached(model_path, model_hash, resolution, CACHE_DIR)
+    except Exception as e:
+        logging.error(f"体素化模型失败: {e}")
+        return jsonify({"error": f"体素化失败: {e}"}), 500
+
+    coords = result['coords'].astype('int32')
+    voxels = np.column_stack((coords, result['part_ids'])).ravel()
+    return jsonify({
+        "resolution": resolution,
+        "modelHash": model_hash,
+        "parts": result['parts'],
+        "count": len(coords),
+        # 扁平数组: [x, y, z, partIndex, x, y, z, partIndex, ...]
+        "voxels": voxels.tolist(),
+    })
+
+def load_request_voxels():
+    """从请求体中读取体素：MBVX 二进制或 {"voxelData": {...}} JSON，返回 decode_voxels() 结构。"""
+    if request.mimetype == 'application/octet-stream':
+        return decode_voxels(request.get_data())
+    data = request.get_json(silent=True) or {}
+    arrays = voxel_dict_to_arrays(data.get('voxelData'))
+    if arrays is None:
+        raise ValueError("请求中没有可识别的体素数据。")
+    coords, block_ids, meta_data, _, _ = arrays
+    return {"coords": coords, "block_ids": block_ids, "meta_data": meta_data,
+            "part_ids": None, "part_names": None}
+
+@app.route('/api/voxels/import_txt', methods=['POST'])
+def import_voxels_txt():
+    """API端点，分块解析上传的 TXT 体素文件，默认返回 MBVX 二进制（?format=json 返回扁平数组）。"""
+    if 'file' in request.files:
+        stream = request.files['file'].stream
+    else:
+        stream = request.stream
+
+    try:
+        coords, block_ids, meta_data = read_txt_voxels(stream)
+    except (VoxelTxtError, UnicodeDecodeError) as e:
+        return jsonify({"error": f"TXT 体素文件无效: {e}"}), 400
+
+    logging.info(f"TXT 体素导入完成: {len(coords)} 个体素。")
+    if request.args.get('format') == 'json':
+        voxels = np.column_stack((coords, block_ids, meta_data)).ravel()
+        # 扁平数组: [x, y, z, blockId, metaData, ...]
+        return jsonify({"count": len(coords), "voxels": voxels.tolist()})
+
+    try:
+        payload = encode_voxels(coords, block_ids, meta_data)
+    except ValueError as e:
+        # TXT 坐标允许 ±2^20，但 MBVX 每轴跨度最多 65535
+        return jsonify({"error": f"无法编码为 MBVX: {e} 请改用 ?format=json。"}), 400
+    response = Response(payload, mimetype='application/octet-stream')
+    response.headers['X-Voxel-Count'] = str(len(coords))
+    return response
+
+@app.route('/api/voxels/export_txt', methods=['POST'])
+def export_voxels_txt():
+    """API端点，把请求中的体素以 TXT 格式分块流式下载。"""
+    try:
+        voxels = load_request_voxels()
+    except Exception as e:
+        return jsonify({"error": f"无法读取体素数据: {e}"}), 400
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    response = Response(
+        stream_with_context(iter_txt_lines(voxels['coords'], voxels['block_ids'], voxels['meta_data'])),
+        mimetype='text/plain',
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename="voxel_output_{timestamp}.txt"'
+    return response
+
+@app.route('/api/voxels/surface', methods=['POST'])
+def extract_surface_voxels():
+    """API端点，返回暴露在外（至少一个面没有被相邻体素遮挡）的体素坐标。"""
+    try:
+        voxels = load_request_voxels()
+    except Exception as e:
+        return jsonify({"error": f"无法读取体素数据: {e}"}), 400
+
+    coords = voxels['coords']
+    try:
+        exposed = coords[exposed_mask(coords)]
+    except GridTooLargeError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "count": len(coords),
+        "exposedCount": len(exposed),
+        # 扁平数组: [x, y, z, x, y, z, ...]
+        "exposed": exposed.ravel().tolist(),
+    })
+
+@app.route('/api/animation/timeline', methods=['POST'])
+def get_animation_timeline():
+    """API端点，返回预计算的动画时间线（Float32 二进制，顺序与请求中的体素一致）。"""
+    effect = request.args.get('effect', 'magic-gradient')
+    if effect not in ANIMATION_EFFECTS:
+        return jsonify({"error": f"未知的动画效果: {effect}"}), 400
+    try:
+        duration = float(request.args.get('duration', DEFAULT_ANIMATION_DURATION))
+        voxels = load_request_voxels()
+    except Exception as e:
+        return jsonify({"error": f"无法读取请求参数: {e}"}), 400
+    if not 0 < duration <= MAX_ANIMATION_DURATION:
+        return jsonify({"error": f"duration 必须在 0 到 {MAX_ANIMATION_DURATION:g} 秒之间。"}), 400
+
+    data = build_timeline_cached(voxels['coords'], effect, duration, CACHE_DIR)
+    response = Response(data, mimetype='application/octet-stream')
+    response.headers['X-Timeline-Stride'] = str(TIMELINE_STRIDE)
+    response.headers['X-Timeline-Count'] = str(len(voxels['coords']))
+    return response
+
+@app.route('/api/mesh', methods=['POST'])
+def mesh_voxels():
+    """API端点，把体素场景贪心网格化为 GLB（每种材质一个图元，隐藏面已剔除）。"""
+    try:
+        voxels = load_request_voxels()
+        grid_size = float(request.args.get('gridSize', DEFAULT_GRID_SIZE))
+        resolution = int(request.args.get('resolution', DEFAULT_VOXEL_RESOLUTION))
+    except Exception as e:
+        return jsonify({"error": f"无法读取体素数据: {e}"}), 400
+    if resolution <= 0:
+        return jsonify({"error": "resolution 必须为正整数。"}), 400
+
+    try:
+        primitives, stats = greedy_mesh(voxels['coords'], voxels['block_ids'], voxels['meta_data'])
+    except GridTooLargeError as e:
+        return jsonify({"error": str(e)}), 400
+    # 与前端 displayVoxels() 的布局一致：x/z 以网格中心为原点，y 从 0 开始
+    glb = write_glb(primitives, scale=grid_size / resolution, translation=(-grid_size / 2, 0.0, -grid_size / 2))
+    logging.info(f"贪心网格化完成: {stats['voxels']} 个体素 -> {stats['triangles']} 个三角形 "
+                 f"(逐方块渲染为 {stats['naiveTriangles']} 个)。")
+
+    response = Response(glb, mimetype='model/gltf-binary')
+    response.headers['X-Triangle-Count'] = str(stats['triangles'])
+    response.headers['X-Naive-Triangle-Count'] = str(stats['naiveTriangles'])
+    return response
+
+@app.route('/api/render', methods=['POST'])
+def render_voxels():
+    """API端点，在服务器端无界面渲染建筑动画，返回 GIF（?format=zip 返回 PNG 帧的 zip）。"""
+    effect = request.args.get('effect', 'magic-gradient')
+    if effect != 'none' and effect not in ANIMATION_EFFECTS:
+        return jsonify({"error": f"未知的动画效果: {effect}"}), 400
+    view = request.args.get('view', 'isometric')
+    if view not in CAMERA_VIEWS:
+        return jsonify({"error": f"未知的视角: {view}"}), 400
+    output_format = request.args.get('format', 'gif')
+    if output_format not in ('gif', 'zip'):
+        return jsonify({"error": "format 必须是 gif 或 zip。"}), 400
+    try:
+        duration = float(request.args.get('duration', DEFAULT_ANIMATION_DURATION))
+        fps = int(request.args.get('fps', DEFAULT_FPS))
+        frame_count = int(request.args.get('frames', round(duration * fps)))
+        size = int(request.args.get('size', DEFAULT_IMAGE_SIZE))
+        voxels = load_request_voxels()
+    except Exception as e:
+        return jsonify({"error": f"无法读取请求参数: {e}"}), 400
+    if not 0 < duration <= MAX_ANIMATION_DURATION:
+        return jsonify({"error": f"duration 必须在 0 到 {MAX_ANIMATION_DURATION:g} 秒之间。"}), 400
+    if not 1 <= frame_count <= MAX_RENDER_FRAMES or fps <= 0:
+        return jsonify({"error": f"frames 必须在 1 到 {MAX_RENDER_FRAMES} 之间，fps 必须为正整数。"}), 400
+    if not 16 <= size <= MAX_IMAGE_SIZE:
+        return jsonify({"error": f"size 必须在 16 到 {MAX_IMAGE_SIZE} 之间。"}), 400
+    if effect != 'none' and render_pixels(frame_count, size) > MAX_RENDER_PIXELS:
+        return jsonify({"error": f"frames × size² 超过上限 {MAX_RENDER_PIXELS}，请减少帧数或缩小尺寸。"}), 400
+    if len(voxels['coords']) == 0:
+        return jsonify({"error": "没有可渲染的体素。"}), 400
+
+    atlas = None
+    try:
+        texture_atlas = _current_texture_atlas()
+        if texture_atlas:
+            _, png, uv_table = texture_atlas
+            atlas = (Image.open(png), uv_table["textures"])
+    except Exception as e:
+        logging.warning(f"构建材质图集失败，改用纯色渲染: {e}")
+
+    try:
+        context = prepare_render_context(voxels['coords'], voxels['block_ids'], voxels['meta_data'],
+                                         None if effect == 'none' else effect, duration, size, view, atlas)
+    except GridTooLargeError as e:
+        return jsonify({"error": str(e)}), 400
+    if effect == 'none':
+        frames = [render_frame(context)]
+    else:
+        frames = render_animation(context, frame_count, duration)
+    logging.info(f"无界面渲染完成: {len(voxels['coords'])} 个体素, {len(frames)} 帧, {size}px。")
+
+    if output_format == 'zip':
+        response = Response(encode_png_zip(frames), mimetype='application/zip')
+        response.headers['Content-Disposition'] = 'attachment; filename="render_frames.zip"'
+    else:
+        response = Response(encode_gif(frames, fps), mimetype='image/gif')
+    response.headers['X-Frame-Count'] = str(len(frames))
+    return response
+
+def _chat_cache_lookup_key(data, model, message):
+    """聊天缓存启用且请求未设置 "cache": false 时返回缓存键，否则返回 None。"""
+    if CHAT_CACHE is None or data.get('cache') is False:
+        return None
+    return chat_cache_key(model, message)
+
+class GeminiError(Exception):
+    """Gemini 请求失败；status 为上游的 HTTP 状态码（网络错误时为 None）。"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class GeminiReplyError(GeminiError):
+    """上游返回了 200，但回复中没有可用的文本（例如被安全过滤拦截）。"""
+
+def _retry_after_seconds(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def _rate_limited_response(error):
+    response = jsonify({"error": str(error), "retryAfter": round(error.retry_after, 1)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(error.retry_after + 0.999))
+    return response
+
+def call_gemini(api_key, model, prompt, generation_config=None, client=None):
+    """发送单轮 generateContent 请求并返回回复文本，失败时抛出 GeminiError。
+
+    请求经过 GEMINI_LIMITER：按 client 公平排队（超时抛出 RateLimitExceeded），相同的并发请求只发送一次。"""
+    api_url = f"{GEMINI_API_BASE}/models/{model}:generateContent?key={api_key}"
+    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    reserved = estimate_tokens(prompt) + GEMINI_OUTPUT_TOKEN_RESERVE
+    request_key = hashlib.sha256(json.dumps([api_key, model, payload], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def send():
+        GEMINI_LIMITER.acquire(api_key, reserved, client)
+        # 网络错误和非 200 回复不消耗 token：退还全部预留
+        actual = 0
+        try:
+            try:
+                response = http_post(api_url, json=payload, timeout=CHAT_TIMEOUT, kind="limited")
+                response_data = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                raise GeminiError(f"Network error: {e}") from e
+            if response.status_code != 200:
+                if response.status_code == 429:
+                    GEMINI_LIMITER.backoff(api_key, _retry_after_seconds(response))
+                raise GeminiError(response_data.get("error", {}).get("message", "Unknown API error."),
+                                  response.status_code)
+            actual = response_data.get("usageMetadata", {}).get("totalTokenCount")
+            try:
+                return response_data['candidates'][0]['content']['parts'][0]['text']
+            except (KeyError, IndexError) as e:
+                raise GeminiReplyError(f"Could not parse AI response: {e}") from e
+        finally:
+            GEMINI_LIMITER.settle(api_key, reserved, actual)
+    return GEMINI_LIMITER.coalesce(request_key, send)
 
 @app.route('/api/chat', methods=['POST'])
 def handle_chat():
@@ -1028,37 +1867,225 @@ def handle_chat():
     if not api_key or not message:
         return jsonify({"error": "Missing API key or message."}), 400
 
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
+    cache_key = _chat_cache_lookup_key(data, model, message)
+    if cache_key:
+        cached_reply = CHAT_CACHE.get(cache_key)
+        if cached_reply is not None:
+            response = jsonify({"reply": cached_reply, "cached": True})
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+    try:
+        reply = call_gemini(api_key, model, message, client=current_session_id())
+    except RateLimitExceeded as e:
+        logging.warning(f"Chat request rate limited: {e}")
+        return _rate_limited_response(e)
+    except GeminiError as e:
+        logging.error(f"Gemini API error. Status: {e.status}, Message: {e}")
+        return jsonify({"error": str(e)}), e.status or 500
+    except Exception as e:
+        logging.error(f"An unexpected error occurred in chat handler: {e}")
+        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+    response = jsonify({"reply": reply})
+    if cache_key:
+        CHAT_CACHE.set(cache_key, reply)
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+def _sse_event(data, event=None, event_id=None):
+    """把数据编码为一条 Server-Sent Events 消息。"""
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    prefix += f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _iter_gemini_sse_text(response, usage=None):
+    """逐条解析 streamGenerateContent?alt=sse 的响应，产出每个分块中的文本。
+
+    usage 不为 None 时写入最近一个分块的 usageMetadata（累计值，最后一块为总数）。"""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        chunk = json.loads(line[5:].strip())
+        if usage is not None and chunk.get('usageMetadata'):
+            usage.update(chunk['usageMetadata'])
+        for candidate in chunk.get('candidates', []):
+            for part in candidate.get('content', {}).get('parts', []):
+                if part.get('text'):
+                    yield part['text']
+
+@app.route('/api/chat/stream', methods=['POST'])
+def handle_chat_stream():
+    """API 端点，流式聊天：代理 Gemini streamGenerateContent，并以 SSE 逐块转发文本。
+
+    事件格式: data: {"text": "..."}；结束时 event: done，data: {"reply": 完整回复}；
+    出错时 event: error，data: {"error": "..."}。客户端断开连接时立即关闭上游请求。
+    """
+    data = request.get_json()
+    api_key = data.get('apiKey')
+    message = data.get('message')
+    model = data.get('model', 'gemini-pro')
+
+    if not api_key or not message:
+        return jsonify({"error": "Missing API key or message."}), 400
 
-    headers = {'Content-Type': 'application/json'}
+    cache_key = _chat_cache_lookup_key(data, model, message)
+    if cache_key:
+        cached_reply = CHAT_CACHE.get(cache_key)
+        if cached_reply is not None:
+            body = _sse_event({"text": cached_reply}) + _sse_event({"reply": cached_reply, "cached": True}, event="done")
+            response = Response(body, mimetype='text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+    api_url = f"{GEMINI_API_BASE}/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
     payload = {
         "contents": [{
             "parts": [{"text": message}]
         }]
     }
 
+    reserved = estimate_tokens(message) + GEMINI_OUTPUT_TOKEN_RESERVE
     try:
-        response = requests.post(api_url, headers=headers, json=payload, timeout=45)
-        response_data = response.json()
-
-        if response.status_code == 200:
-            try:
-                reply = response_data['candidates'][0]['content']['parts'][0]['text']
-                return jsonify({"reply": reply})
-            except (KeyError, IndexError) as e:
-                logging.error(f"Error parsing successful Gemini response: {e} | Response: {response_data}")
-                return jsonify({"error": "Could not parse AI response."}), 500
-        else:
-            error_message = response_data.get("error", {}).get("message", "Unknown API error.")
-            logging.error(f"Gemini API error. Status: {response.status_code}, Message: {error_message}")
-            return jsonify({"error": error_message}), response.status_code
+        GEMINI_LIMITER.acquire(api_key, reserved, current_session_id())
+    except RateLimitExceeded as e:
+        logging.warning(f"Streaming chat request rate limited: {e}")
+        return _rate_limited_response(e)
 
+    try:
+        upstream = http_post(api_url, json=payload, stream=True, timeout=CHAT_TIMEOUT, kind="limited")
     except requests.exceptions.RequestException as e:
-        logging.error(f"Network error during chat request: {e}")
+        GEMINI_LIMITER.settle(api_key, reserved, 0)
+        logging.error(f"Network error during streaming chat request: {e}")
         return jsonify({"error": f"Network error: {e}"}), 500
-    except Exception as e:
-        logging.error(f"An unexpected error occurred in chat handler: {e}")
-        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+    settled = []
+
+    def settle(actual):
+        """关闭上游连接并修正预留的 token（只执行一次）。"""
+        if not settled:
+            settled.append(actual)
+            upstream.close()
+            GEMINI_LIMITER.settle(api_key, reserved, actual)
+
+    if upstream.status_code != 200:
+        try:
+            error_message = upstream.json().get("error", {}).get("message", "Unknown API error.")
+        except ValueError:
+            error_message = "Unknown API error."
+        settle(0)
+        if upstream.status_code == 429:
+            GEMINI_LIMITER.backoff(api_key, _retry_after_seconds(upstream))
+        logging.error(f"Gemini API error. Status: {upstream.status_code}, Message: {error_message}")
+        return jsonify({"error": error_message}), upstream.status_code
+
+    def generate():
+        reply = []
+        usage = {}
+        try:
+            for text in _iter_gemini_sse_text(upstream, usage):
+                reply.append(text)
+                yield _sse_event({"text": text})
+            if cache_key:
+                CHAT_CACHE.set(cache_key, "".join(reply))
+            yield _sse_event({"reply": "".join(reply)}, event="done")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(f"Error while streaming Gemini response: {e}")
+            yield _sse_event({"error": f"Stream interrupted: {e}"}, event="error")
+        finally:
+            # 正常结束或客户端断开（GeneratorExit）时都关闭上游连接，并用实际用量修正预留；
+            # 上游没有报告（或中途断开）时按已收到的文本估算
+            settle(usage.get("totalTokenCount") or estimate_tokens(message) + estimate_tokens("".join(reply)))
+
+    response = Response(generate(), mimetype='text/event-stream')
+    # 客户端在响应开始前断开时生成器不会运行，此时退还全部预留
+    response.call_on_close(lambda: settle(0))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    if cache_key:
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+@app.route('/api/gemini/limits')
+def gemini_limit_stats():
+    """API 端点，返回出站 Gemini 请求的限流统计：排队深度、等待时间、合并次数等。"""
+    return jsonify(GEMINI_LIMITER.stats())
+
+def _is_admin_request():
+    """管理操作只接受来自本机的请求，除非以 --allow_remote_admin 启动。"""
+    return ALLOW_REMOTE_ADMIN or request.remote_addr in LOOPBACK_ADDRESSES
+
+@app.route('/api/chat/cache', methods=['GET', 'DELETE'])
+def chat_cache_stats():
+    """API 端点，返回聊天缓存的命中统计；DELETE 清空缓存（仅限本机请求）。"""
+    if CHAT_CACHE is None:
+        return jsonify({"enabled": False})
+    if request.method == 'DELETE':
+        if not _is_admin_request():
+            return jsonify({"success": False, "message": "只允许从本机清空缓存。"}), 403
+        CHAT_CACHE.clear()
+        logging.info("聊天回复缓存已清空。")
+    return jsonify(dict(CHAT_CACHE.stats(), enabled=True))
+
+def _fetch_key_validity(api_key, quick=False):
+    """向 Gemini 查询密钥是否有效：返回 True/False，上游暂时不可用时返回 None。
+
+    quick 为真时只请求一次（不重试）并使用较短的超时。"""
+    validation_url = f"{GEMINI_API_BASE}/models?key={api_key}"
+    try:
+        if quick:
+            response = http_get(validation_url, timeout=QUICK_VALIDATE_TIMEOUT, kind="once")
+        else:
+            response = http_get(validation_url, timeout=VALIDATE_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"验证 API 密钥时发生网络错误: {e}")
+        return None
+    if response.status_code == 200:
+        return True
+    if response.status_code in (400, 401, 403):
+        logging.warning(f"API 密钥验证失败。状态码: {response.status_code}")
+        return False
+    logging.warning(f"验证服务暂时不可用。状态码: {response.status_code}")
+    return None
+
+def _check_and_cache_key(api_key, key_hash, quick=False):
+    """查询密钥有效性并写入缓存（有效结果缓存较久，无效结果短期缓存），返回查询结果。"""
+    valid = _fetch_key_validity(api_key, quick)
+    if valid is not None:
+        ttl = KEY_VALID_TTL if valid else KEY_INVALID_TTL
+        KEY_VALIDATION_CACHE.set(key_hash, {"valid": valid, "checked": time.time()}, ttl=ttl)
+    return valid
+
+def _refresh_key_in_background(api_key, key_hash):
+    """在后台线程中重新验证密钥，同一密钥同时只有一个刷新任务。"""
+    with KEY_REFRESH_LOCK:
+        if key_hash in KEY_REFRESHING:
+            return
+        KEY_REFRESHING.add(key_hash)
+
+    def refresh():
+        try:
+            _check_and_cache_key(api_key, key_hash)
+        finally:
+            with KEY_REFRESH_LOCK:
+                KEY_REFRESHING.discard(key_hash)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+def validate_key_cached(api_key, quick=False):
+    """带缓存的密钥验证：返回 (结果, 是否命中缓存)，结果为 True/False，上游不可用时为 None。
+
+    缓存以密钥的 SHA-256 为键，不保存密钥本身。有效结果接近过期时返回缓存值并在后台刷新。
+    quick 见 _fetch_key_validity()。
+    """
+    key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+    entry = KEY_VALIDATION_CACHE.get(key_hash)
+    if entry is not None:
+        if entry["valid"] and time.time() - entry["checked"] > KEY_VALID_TTL * KEY_REFRESH_FRACTION:
+            _refresh_key_in_background(api_key, key_hash)
+        return entry["valid"], True
+    return _check_and_cache_key(api_key, key_hash, quick), False
 
 @app.route('/api/validate_key', methods=['POST'])
 def validate_api_key():
@@ -1069,64 +2096,221 @@ def validate_api_key():
     if not api_key:
         return jsonify({"success": False, "message": "未提供 API 密钥。"}), 400
 
-    validation_url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
-
-    try:
-        response = requests.get(validation_url)
-        if response.status_code == 200:
-            logging.info("API 密钥验证成功。")
-            return jsonify({"success": True})
-        else:
-            logging.warning(f"API 密钥验证失败。状态码: {response.status_code}, 响应: {response.text}")
-            return jsonify({"success": False, "message": "API 密钥无效或已过期。"}), 401
-    except requests.exceptions.RequestException as e:
-        logging.error(f"验证 API 密钥时发生网络错误: {e}")
-        return jsonify({"success": False, "message": f"无法连接到验证服务: {e}"}), 500
+    valid, cached = validate_key_cached(api_key)
+    if valid:
+        logging.info(f"API 密钥验证成功{'（缓存）' if cached else ''}。")
+        return jsonify({"success": True, "cached": cached})
+    if valid is False:
+        return jsonify({"success": False, "message": "API 密钥无效或已过期。", "cached": cached}), 401
+    return jsonify({"success": False, "message": "无法连接到验证服务，请稍后重试。"}), 503
 
 
 def _validate_key_on_server(api_key):
-    """在服务器端内部验证 API 密钥。"""
+    """在服务器端内部验证 API 密钥（启动时调用：不重试、短超时，上游不可用时不阻塞启动）。"""
     if not api_key:
         return False
 
-    validation_url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
+    valid, cached = validate_key_cached(api_key, quick=True)
+    if valid:
+        logging.info(f"服务器端 API 密钥自动验证成功{'（缓存）' if cached else ''}。")
+        return True
+    logging.warning("服务器端 API 密钥自动验证失败。")
+    return False
+
+# --- 智能体任务API路由 ---
+
+def get_agent_runner():
+    """返回智能体任务执行器（首次调用时创建）。"""
+    global AGENT_RUNNER
+    with AGENT_RUNNER_LOCK:
+        if AGENT_RUNNER is None:
+            store = JobStore(os.path.join(SAVE_DIR, AGENT_JOBS_FILENAME))
+            AGENT_RUNNER = AgentJobRunner(AGENT_WORKERS, on_progress=_persist_agent_progress, store=store)
+        return AGENT_RUNNER
+
+def _persist_agent_progress(job, results):
+    """把任务进度和部件材质写入提交任务的会话的智能体状态。"""
+    snapshot = job.snapshot()
+    progress = snapshot["progress"]
+
+    def apply(state):
+        agent_state = dict(state["agent_state"])
+        part_materials = dict(agent_state.get("part_materials") or {})
+        part_materials.update(results)
+        agent_state.update(
+            is_running=snapshot["status"] in ("running", "paused"),
+            is_paused=snapshot["status"] == "paused",
+            current_part_index=progress["completed"] + progress["failed"],
+            overall_analysis=job.overall_analysis,
+            model_name=job.model_name,
+            job_id=job.id,
+            job_status=snapshot["status"],
+            part_materials=part_materials,
+        )
+        return dict(state, agent_state=agent_state)
+    get_session_store().modify(job.session_id, apply)
+
+def _call_agent_model(api_key, model, prompt, schema, client):
+    """以结构化输出调用 Gemini；密钥或请求无效时抛出 AgentJobError（整个任务失败，不再重试），
+    回复中没有可用文本时抛出 ValueError（与无法解析的回复一样拆分批次），其他错误原样抛出（重试）。"""
+    generation_config = {"responseMimeType": "application/json", "responseSchema": schema}
+    try:
+        return call_gemini(api_key, model, prompt, generation_config, client)
+    except GeminiReplyError as e:
+        raise ValueError(str(e)) from e
+    except GeminiError as e:
+        if e.status in (400, 401, 403):
+            raise AgentJobError(str(e)) from e
+        raise
+
+def _make_part_assigner(api_key, model, overall_analysis, client):
+    """返回为单个部件调用 Gemini 选择方块的函数（供 AgentJobRunner 使用）。"""
+    schema = part_response_schema(AGENT_BLOCK_CHOICES)
+
+    def assign(part):
+        text = _call_agent_model(api_key, model, build_part_prompt(overall_analysis, part, AGENT_BLOCK_CHOICES), schema,
+                                 client)
+        return parse_part_assignment(text, AGENT_BLOCK_CHOICES)
+    return single_part_assigner(assign)
+
+def _make_batch_assigner(api_key, model, overall_analysis, client):
+    """返回在一个请求中为一批部件选择方块的函数，返回 {部件 id: 结果}。"""
+    def assign(parts):
+        part_ids = [str(part["id"]) for part in parts]
+        prompt = build_batch_prompt(overall_analysis, parts, AGENT_BLOCK_CHOICES)
+        text = _call_agent_model(api_key, model, prompt, batch_response_schema(AGENT_BLOCK_CHOICES, part_ids), client)
+        return parse_batch_assignment(text, AGENT_BLOCK_CHOICES, part_ids)
+    return assign
+
+def _session_agent_job(job_id):
+    """查找当前会话提交的任务，返回 (本进程中的 AgentJob 或 None, 任务快照)；
+    任务不存在或属于其他会话时返回 (None, None)。其他进程中的任务从 JobStore 读取快照。"""
+    runner = get_agent_runner()
+    job = runner.get(job_id)
+    if job is not None:
+        return (job, job.snapshot()) if job.session_id == current_session_id() else (None, None)
+    record = runner.store.get(job_id)
+    if record is None or record["sessionId"] != current_session_id():
+        return None, None
+    return None, record["snapshot"]
+
+@app.route('/api/agent/jobs', methods=['POST'])
+def submit_agent_job():
+    """提交材质分配任务: {"apiKey", "model", "overallAnalysis", "parts": [{"id", ...}], "concurrency",
+    "batch", "batchTokenBudget"}。batch 为真时把多个部件放进同一个请求（每个请求不超过 batchTokenBudget 个 token）。"""
+    data = request.get_json(silent=True) or {}
+    api_key = data.get('apiKey') or (API_KEY_FROM_FILE if API_KEY_VALIDATED else None)
+    if not api_key:
+        return jsonify({"success": False, "message": "未提供 API 密钥。"}), 400
+    parts = data.get('parts')
+    if not isinstance(parts, list) or not all(isinstance(part, dict) for part in parts):
+        return jsonify({"success": False, "message": "parts 必须是部件对象的列表。"}), 400
+    model = data.get('model') or DEFAULT_AGENT_STATE["model_name"]
+    overall_analysis = data.get('overallAnalysis', '')
+    # 同一会话的所有智能体请求在限流器中作为一个客户端排队，不会挤占其他会话的聊天
+    client = f"agent:{current_session_id()}"
     try:
-        response = requests.get(validation_url, timeout=5)
-        if response.status_code == 200:
-            logging.info("服务器端 API 密钥自动验证成功。")
-            return True
+        concurrency = int(data.get('concurrency', DEFAULT_JOB_CONCURRENCY))
+        token_budget = int(data.get('batchTokenBudget', DEFAULT_BATCH_TOKEN_BUDGET))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "concurrency 和 batchTokenBudget 必须是整数。"}), 400
+    try:
+        if data.get('batch'):
+            for part in parts:
+                part['id'] = str(part.get('id', ''))
+            assign = _make_batch_assigner(api_key, model, overall_analysis, client)
+            batches = pack_batches(parts, overall_analysis, AGENT_BLOCK_CHOICES, token_budget)
         else:
-            logging.warning(f"服务器端 API 密钥自动验证失败。状态码: {response.status_code}")
-            return False
-    except requests.exceptions.RequestException as e:
-        logging.error(f"服务器端验证 API 密钥时发生网络错误: {e}")
-        return False
+            assign, batches = _make_part_assigner(api_key, model, overall_analysis, client), None
+        job = get_agent_runner().submit(current_session_id(), parts, overall_analysis, model, assign,
+                                        concurrency, batches)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, "job": job.snapshot()}), 202
+
+@app.route('/api/agent/jobs/<job_id>')
+def get_agent_job(job_id):
+    _, snapshot = _session_agent_job(job_id)
+    if snapshot is None:
+        return jsonify({"success": False, "message": "任务不存在。"}), 404
+    return jsonify({"success": True, "job": snapshot})
+
+# 各操作要求的任务状态
+AGENT_CONTROL_STATES = {"pause": ("running",), "resume": ("paused",), "cancel": RUNNING_STATES}
+
+@app.route('/api/agent/jobs/<job_id>/<action>', methods=['POST'])
+def control_agent_job(job_id, action):
+    """暂停 (pause)、恢复 (resume) 或取消 (cancel) 任务。任务在其他工作进程中运行时提交控制请求并返回 202，
+    由该进程在一秒内执行。"""
+    job, snapshot = _session_agent_job(job_id)
+    if snapshot is None:
+        return jsonify({"success": False, "message": "任务不存在。"}), 404
+    if action not in AGENT_CONTROL_STATES:
+        return jsonify({"success": False, "message": f"未知的操作: {action}"}), 400
+    if snapshot["status"] not in AGENT_CONTROL_STATES[action]:
+        return jsonify({"success": False, "message": f"任务当前状态为 {snapshot['status']}，无法 {action}。",
+                        "job": snapshot}), 409
+    runner = get_agent_runner()
+    if job is None:
+        runner.store.request_control(job_id, action)
+        return jsonify({"success": True, "pending": True, "job": snapshot}), 202
+    if not getattr(runner, action)(job):
+        return jsonify({"success": False, "message": f"任务当前状态为 {job.status}，无法 {action}。",
+                        "job": job.snapshot()}), 409
+    return jsonify({"success": True, "job": job.snapshot()})
+
+@app.route('/api/agent/jobs/<job_id>/events')
+def agent_job_events(job_id):
+    """以 SSE 推送任务事件，直到任务结束。断线重连时根据 Last-Event-ID（或 ?after=）继续。"""
+    job, snapshot = _session_agent_job(job_id)
+    if snapshot is None:
+        return jsonify({"success": False, "message": "任务不存在。"}), 404
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after', 0))
+    except ValueError:
+        after = 0
+    events = job.iter_events(after) if job is not None else get_agent_runner().store.iter_events(job_id, after)
+
+    def generate():
+        for event in events:
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield _sse_event(event, event=event["type"], event_id=event["seq"])
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 # --- 存档相关API路由 ---
 
+@app.route('/api/session')
+def get_session_state():
+    """API端点，返回当前会话的聊天记录和智能体状态。"""
+    state = get_session_store().get(current_session_id())
+    return jsonify({"chatHistory": state["chat_history"], "agentState": state["agent_state"]})
+
 @app.route('/api/save/export', methods=['POST'])
 def export_save():
     """导出存档文件API"""
     try:
-        global CHAT_HISTORY, AGENT_STATE
-        
         data = request.get_json()
         voxel_data = data.get('voxelData', {})
         chat_history = data.get('chatHistory', [])
-        agent_state = data.get('agentState', AGENT_STATE)
+        agent_state = data.get('agentState') or get_agent_state()
         
-        CHAT_HISTORY = chat_history
-        AGENT_STATE.update(agent_state)
+        record_session_state(chat_history, agent_state)
         
         save_data = create_save_data(voxel_data, chat_history, agent_state)
-        
-        zip_path = export_save_file(save_data)
-        
-        if zip_path and os.path.exists(zip_path):
-            logging.info(f"存档导出成功: {zip_path}")
-            return send_file(zip_path, as_attachment=True, download_name=os.path.basename(zip_path))
-        else:
-            return jsonify({"success": False, "message": "导出存档失败"}), 500
+
+        # 存档直接流式写入响应；keepCopy 为 true（默认）时同时在 SAVE_DIR 中保留一份
+        zip_path = new_save_path()
+        tee_path = zip_path if data.get('keepCopy', True) else None
+        logging.info(f"开始流式导出存档{': ' + zip_path if tee_path else ''}")
+        response = Response(stream_with_context(iter_save_zip(save_data, tee_path)), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(zip_path)}"'
+        return response
             
     except Exception as e:
         logging.error(f"导出存档时发生错误: {e}")
@@ -1134,29 +2318,35 @@ def export_save():
 
 @app.route('/api/save/import', methods=['POST'])
 def import_save():
-    """导入存档文件API"""
+    """导入存档文件API；?parts=voxels,agent 只读取列出的部分（默认全部）"""
+    temp_file_path = None
     try:
+        data = request.get_json(silent=True) or {}
+        try:
+            parts = parse_save_parts(request.args.get('parts') or data.get('parts'))
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+
         if 'file' in request.files:
             file = request.files['file']
             if file.filename == '':
                 return jsonify({"success": False, "message": "未选择文件"}), 400
             
             temp_path = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-            file.save(temp_path.name)
-            zip_path = temp_path.name
+            temp_path.close()
+            temp_file_path = temp_path.name
+            file.save(temp_file_path)
+            zip_path = temp_file_path
         else:
-            data = request.get_json()
-            url = data.get('url') if data else None
+            url = data.get('url')
             if not url:
                 return jsonify({"success": False, "message": "未提供文件或URL"}), 400
             zip_path = url
-        
-        save_data = import_save_file(zip_path)
-        
+
+        save_data = import_save_file(zip_path, parts)
+
         if save_data:
-            global CHAT_HISTORY, AGENT_STATE
-            CHAT_HISTORY = save_data.get('chat_history', [])
-            AGENT_STATE.update(save_data.get('agent_state', {}))
+            record_session_state(save_data.get('chat_history'), save_data.get('agent_state'))
             
             logging.info("存档导入成功")
             return jsonify({
@@ -1169,63 +2359,277 @@ def import_save():
     except Exception as e:
         logging.error(f"导入存档时发生错误: {e}")
         return jsonify({"success": False, "message": f"导入失败: {str(e)}"}), 500
+    finally:
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+
+# --- 存档库API路由 ---
+
+def get_save_catalog():
+    """返回 SAVE_DIR 的存档目录（首次调用时创建）。"""
+    global SAVE_CATALOG
+    with SAVE_CATALOG_LOCK:
+        if SAVE_CATALOG is None:
+            SAVE_CATALOG = SaveCatalog(SAVE_DIR)
+        return SAVE_CATALOG
+
+def _optional_int(name):
+    value = request.args.get(name)
+    return int(value) if value not in (None, '') else None
+
+@app.route('/api/saves')
+def list_saves():
+    """分页列出 SAVE_DIR 中的存档及其元数据。
+
+    参数: page、pageSize、sort (timestamp|name|size|voxelCount)、order (asc|desc)、
+    q（文件名包含）、minVoxels、maxVoxels、since、until（ISO 时间）、block（包含该方块 ID）。
+    """
+    catalog = get_save_catalog()
+    try:
+        page = max(1, _optional_int('page') or 1)
+        page_size = min(MAX_PAGE_SIZE, max(1, _optional_int('pageSize') or DEFAULT_PAGE_SIZE))
+        filters = {
+            "name_contains": request.args.get('q'),
+            "min_voxels": _optional_int('minVoxels'),
+            "max_voxels": _optional_int('maxVoxels'),
+            "since": request.args.get('since'),
+            "until": request.args.get('until'),
+            "block_id": _optional_int('block'),
+        }
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"参数无效: {e}"}), 400
+
+    pending = catalog.sync()
+    total, saves = catalog.query(offset=(page - 1) * page_size, limit=page_size,
+                                 sort=request.args.get('sort', 'timestamp'),
+                                 descending=request.args.get('order', 'desc') != 'asc', **filters)
+    for save in saves:
+        save["thumbnailUrl"] = f"/api/saves/{save['name']}/thumbnail.png" if save["hasThumbnail"] else None
+        save["downloadUrl"] = f"/api/saves/{save['name']}/download"
+    return jsonify({"success": True, "total": total, "page": page, "pageSize": page_size,
+                    "indexing": pending, "saves": saves})
+
+def _catalog_save_name(name):
+    """只接受 SAVE_DIR 中直接存在的 .zip 文件名。"""
+    if os.path.basename(name) != name or not name.lower().endswith('.zip'):
+        return None
+    return name if os.path.isfile(os.path.join(SAVE_DIR, name)) else None
+
+@app.route('/api/saves/<name>')
+def get_save_metadata(name):
+    """返回单个存档的元数据（必要时立即索引）。"""
+    if not _catalog_save_name(name):
+        return jsonify({"success": False, "message": "存档不存在。"}), 404
+    catalog = get_save_catalog()
+    save = catalog.get(name)
+    if save is None:
+        catalog.index_save(name)
+        save = catalog.get(name)
+    return jsonify({"success": True, "save": save})
+
+@app.route('/api/saves/<name>/thumbnail.png')
+def get_save_thumbnail(name):
+    """返回存档的缩略图 (PNG)。"""
+    if not _catalog_save_name(name):
+        return jsonify({"success": False, "message": "存档不存在。"}), 404
+    png, mtime = get_save_catalog().thumbnail(name)
+    if png is None:
+        return jsonify({"success": False, "message": "缩略图尚未生成。"}), 404
+    response = Response(png, mimetype='image/png')
+    response.set_etag(f"{name}:{mtime}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/saves/<name>/download')
+def download_save(name):
+    """下载存档 zip。"""
+    if not _catalog_save_name(name):
+        return jsonify({"success": False, "message": "存档不存在。"}), 404
+    return send_file(os.path.abspath(os.path.join(SAVE_DIR, name)), as_attachment=True, download_name=name,
+                     conditional=True)
+
+# --- 增量快照API路由 ---
+
+def get_snapshot_store():
+    """返回 SAVE_DIR 下的快照仓库（首次调用时创建）。"""
+    global SNAPSHOT_STORE
+    with SNAPSHOT_STORE_LOCK:
+        if SNAPSHOT_STORE is None:
+            SNAPSHOT_STORE = SnapshotStore(os.path.join(SAVE_DIR, SNAPSHOT_SUBDIR))
+        return SNAPSHOT_STORE
+
+@app.route('/api/snapshots', methods=['GET', 'POST'])
+def snapshots():
+    """GET 列出当前会话的快照；POST 为当前会话保存一个增量快照（请求体与 /api/save/export 相同）。"""
+    store = get_snapshot_store()
+    session_id = current_session_id()
+    if request.method == 'GET':
+        return jsonify({"snapshots": store.list(session_id), "stats": store.stats(session_id)})
+
+    data = request.get_json(silent=True) or {}
+    chat_history = data.get('chatHistory', [])
+    agent_state = data.get('agentState') or get_agent_state()
+    record_session_state(chat_history, agent_state)
+    try:
+        record = store.save(session_id, data.get('voxelData', {}), chat_history, agent_state)
+    except Exception as e:
+        logging.error(f"保存快照失败: {e}")
+        return jsonify({"success": False, "message": f"保存快照失败: {e}"}), 500
+    kind = "基础快照" if "base" in record["voxels"] else "增量快照"
+    logging.info(f"已保存{kind} #{record['id']}: 新写入 {record['bytesWritten']} 字节。")
+    return jsonify({"success": True, "id": record["id"], "kind": "base" if "base" in record["voxels"] else "delta",
+                    "bytesWritten": record["bytesWritten"], "changedVoxels": record.get("changedVoxels")})
+
+@app.route('/api/snapshots/<snapshot_id>')
+def get_snapshot(snapshot_id):
+    """重建并返回当前会话的快照（snapshot_id 为数字或 latest）；?format=zip 以存档 zip 形式流式下载。"""
+    try:
+        save_data = get_snapshot_store().load(current_session_id(),
+                                              None if snapshot_id == 'latest' else int(snapshot_id))
+    except (KeyError, ValueError) as e:
+        return jsonify({"success": False, "message": f"快照不存在: {e}"}), 404
+
+    if request.args.get('format') == 'zip':
+        response = Response(stream_with_context(iter_save_zip(save_data)), mimetype='application/zip')
+        filename = f"mine_builder_snapshot_{save_data['snapshot_id']}.zip"
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    return jsonify({"success": True, "data": save_data})
+
+@app.route('/api/snapshots/compact', methods=['POST'])
+def compact_snapshots():
+    """压缩当前会话的快照：只保留最近 keep 个快照，并删除不再引用的对象（仅限本机请求）。"""
+    if not _is_admin_request():
+        return jsonify({"success": False, "message": "只允许从本机压缩快照仓库。"}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        keep = int(data['keep']) if data.get('keep') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "keep 必须是整数。"}), 400
+    result = get_snapshot_store().compact(current_session_id(), keep)
+    logging.info(f"快照仓库压缩完成: 保留 {result['snapshots']} 个快照，释放 {result['freedBytes']} 字节。")
+    return jsonify(dict(result, success=True))
 
 # --- 主程序入口 ---
 def main():
     """主函数，用于设置并运行Web服务器。"""
+    global PORT
     parser = argparse.ArgumentParser(description="Minecraft 动画制作器 - 支持AI助手")
     parser.add_argument('--input_model', type=str, help='要加载的3D模型URL或本地路径。')
     parser.add_argument('--input_data', type=str, help='要导入的存档文件URL或本地路径。')
+    parser.add_argument('--gemini_api_base', type=str, help='Gemini API 基础地址（例如本地桩服务器 http://127.0.0.1:5001/v1beta）。')
+    parser.add_argument('--download_workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS, help='大文件并行分段下载的连接数。')
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_CACHE_MAX_BYTES / 1024 ** 2,
+                        help=f"'{CACHE_DIR}/' 目录的大小上限（MB），超出时按最近使用时间淘汰；0 表示不限制。")
+    parser.add_argument('--chat_cache', action='store_true', help='缓存相同模型和消息的聊天回复。')
+    parser.add_argument('--chat_cache_size', type=int, default=DEFAULT_CACHE_ENTRIES, help='聊天缓存在内存中的最大条目数。')
+    parser.add_argument('--chat_cache_ttl', type=float, default=DEFAULT_CACHE_TTL, help='聊天缓存的有效期（秒）。')
+    parser.add_argument('--chat_cache_disk', action='store_true', help=f"同时把聊天缓存保存到 '{CACHE_DIR}/{CHAT_CACHE_SUBDIR}/'。")
+    parser.add_argument('--chat_cache_disk_entries', type=int, default=DEFAULT_DISK_ENTRIES,
+                        help='聊天缓存磁盘层的最大条目数，超出时删除最久未使用的条目。')
+    parser.add_argument('--allow_remote_admin', action='store_true',
+                        help='允许非本机请求执行管理操作（清空聊天缓存）。位于同机反向代理之后时所有请求都来自本机，请在代理层限制。')
+    parser.add_argument('--serve', choices=['development', 'production'], default='development',
+                        help='development 使用 Flask 开发服务器并自动打开浏览器；production 使用 gunicorn 或 waitress。')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='监听地址。')
+    parser.add_argument('--port', type=int, default=PORT, help='监听端口。')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='生产模式的工作进程数（需要 gunicorn）。')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help='生产模式下每个工作进程的线程数。')
+    parser.add_argument('--max_sessions', type=int, default=DEFAULT_MAX_SESSIONS, help='内存中保留的会话数上限。')
+    parser.add_argument('--session_idle_timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='空闲超过该秒数的会话从内存中淘汰。')
+    parser.add_argument('--session_spill', action='store_true',
+                        help=f"把淘汰的会话保存到 '{SAVE_DIR}/{SESSION_SPILL_FILENAME}'，下次访问时恢复。")
+    parser.add_argument('--keep_sessions', action='store_true',
+                        help=f"启动时保留 '{SAVE_DIR}/{SESSION_SPILL_FILENAME}' 中上一次运行的会话（默认清空）。")
+    parser.add_argument('--agent_workers', type=int, default=DEFAULT_AGENT_WORKERS,
+                        help='服务器端智能体同时处理的部件数上限（所有任务共享）。')
+    parser.add_argument('--gemini_rpm', type=int, default=0,
+                        help='每个 API 密钥每分钟的 Gemini 请求数上限（0 表示不限制；多个工作进程时平均分摊）。')
+    parser.add_argument('--gemini_tpm', type=int, default=0,
+                        help='每个 API 密钥每分钟的 token 数上限（估算值，0 表示不限制）。')
+    parser.add_argument('--gemini_max_wait', type=float, default=DEFAULT_MAX_WAIT,
+                        help='请求在限流队列中等待的最长秒数，超过时返回 429。')
     args = parser.parse_args()
-
-    global CHAT_HISTORY, AGENT_STATE, INITIAL_SAVE_DATA
+    PORT = args.port
+    global AGENT_WORKERS
+    AGENT_WORKERS = args.agent_workers
+
+    global CHAT_CACHE, ALLOW_REMOTE_ADMIN
+    ALLOW_REMOTE_ADMIN = args.allow_remote_admin
+    if args.chat_cache:
+        disk_dir = os.path.join(CACHE_DIR, CHAT_CACHE_SUBDIR) if args.chat_cache_disk else None
+        CHAT_CACHE = LruTtlCache(args.chat_cache_size, args.chat_cache_ttl, disk_dir, args.chat_cache_disk_entries)
+        logging.info(f"已启用聊天回复缓存: 最多 {args.chat_cache_size} 条, 有效期 {args.chat_cache_ttl:g} 秒"
+                     f"{', 磁盘层 ' + disk_dir if disk_dir else ''}。")
+
+    global GEMINI_LIMITER
+    # 限流器在每个进程内生效：多个工作进程时把配额平均分给各进程
+    processes = args.workers if args.serve == 'production' else 1
+    rpm = max(1, args.gemini_rpm // processes) if args.gemini_rpm > 0 else 0
+    tpm = max(1, args.gemini_tpm // processes) if args.gemini_tpm > 0 else 0
+    GEMINI_LIMITER = GeminiRateLimiter(rpm, tpm, args.gemini_max_wait)
+    if GEMINI_LIMITER.enabled:
+        logging.info(f"已启用 Gemini 限流: 每个进程每分钟 {rpm or '不限'} 个请求, {tpm or '不限'} 个 token, "
+                     f"最长排队 {args.gemini_max_wait:g} 秒。")
+
+    global GEMINI_API_BASE
+    if args.gemini_api_base:
+        GEMINI_API_BASE = args.gemini_api_base.rstrip('/')
+        logging.info(f"使用自定义 Gemini API 地址: {GEMINI_API_BASE}")
+
+    state = get_shared_state()
+    state.reset(DEFAULT_SHARED_STATE)
+
+    global SESSION_STORE
+    # 多个工作进程不共享内存：会话直接保存在 SQLite 中
+    shared_sessions = args.serve == 'production' and args.workers > 1
+    spill = None
+    if args.session_spill or shared_sessions:
+        spill = SharedState(os.path.join(SAVE_DIR, SESSION_SPILL_FILENAME))
+    SESSION_STORE = SessionStore(DEFAULT_AGENT_STATE, args.max_sessions, args.session_idle_timeout, spill,
+                                 shared=shared_sessions)
+    if spill is not None and not args.keep_sessions:
+        discarded = SESSION_STORE.discard_spilled()
+        if discarded:
+            logging.info(f"已清空上一次运行保存的 {discarded} 个会话（--keep_sessions 可保留）。")
     if args.input_data:
         logging.info(f"检测到存档数据参数: {args.input_data}")
         save_data = import_save_file(args.input_data)
         if save_data:
-            INITIAL_SAVE_DATA = save_data
+            state.set("initial_save_data", save_data)
             logging.info("启动时成功加载存档数据，将传递给前端。")
         else:
             logging.warning("启动时导入存档数据失败")
 
-    global DOWNLOADED_MODEL_PATH
+    downloaded_model_path = None
     if args.input_model:
         if args.input_model.startswith(('http://', 'https://')):
             url = args.input_model
             logging.info(f"检测到模型 URL: {url}")
-            if not os.path.exists(CACHE_DIR):
-                os.makedirs(CACHE_DIR)
-                logging.info(f"创建缓存目录: '{CACHE_DIR}'")
-
             try:
-                parsed_url = urlparse(url)
-                filename = os.path.basename(parsed_url.path)
-                if not filename:
-                    filename = "cached_model.glb"
-
-                cached_path = os.path.join(CACHE_DIR, filename)
-
-                logging.info(f"正在从URL下载模型到 '{cached_path}'...")
-                response = requests.get(url, stream=True)
-                response.raise_for_status()
-
-                with open(cached_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
-                DOWNLOADED_MODEL_PATH = cached_path
-                logging.info(f"模型成功下载并缓存。")
-
-            except requests.exceptions.RequestException as e:
+                downloaded_model_path = fetch_cached(url, CACHE_DIR, default_extension='.glb',
+                                                     workers=args.download_workers)
+                logging.info(f"模型已缓存: '{downloaded_model_path}'")
+            except (requests.exceptions.RequestException, DownloadChangedError) as e:
                 logging.error(f"从URL下载模型失败: {e}")
         else:
             if os.path.exists(args.input_model):
-                DOWNLOADED_MODEL_PATH = args.input_model
-                logging.info(f"从本地路径加载模型: '{DOWNLOADED_MODEL_PATH}'")
+                downloaded_model_path = args.input_model
+                logging.info(f"从本地路径加载模型: '{downloaded_model_path}'")
             else:
                 logging.warning(f"提供的本地模型路径不存在: '{args.input_model}'")
 
-    global API_KEY_FROM_FILE, API_KEY_VALIDATED
+    state.set("downloaded_model_path", downloaded_model_path)
+
+    if args.cache_max_mb > 0 and os.path.isdir(CACHE_DIR):
+        protect = [downloaded_model_path] if downloaded_model_path else []
+        evict_cache(CACHE_DIR, int(args.cache_max_mb * 1024 * 1024), protect)
+
+    global API_KEY_FROM_FILE, API_KEY_VALIDATED, KEY_VALIDATION_CACHE
+    # 磁盘层让重启后的启动验证也能直接命中缓存
+    KEY_VALIDATION_CACHE = LruTtlCache(max_entries=64, ttl=KEY_VALID_TTL,
+                                       disk_dir=os.path.join(CACHE_DIR, KEY_CACHE_SUBDIR))
     if os.path.exists('key.txt'):
         with open('key.txt', 'r') as f:
             API_KEY_FROM_FILE = f.read().strip()
@@ -1252,14 +2656,23 @@ def main():
     print(f"   或使用 `--input_model <URL或路径>` 命令行参数直接加载。")
     print(f"2. 将你的 .png/.jpg 参考图片放入 '{INPUT_DIR}/' 文件夹中。")
     print(f"3. 将你的 .zip 材质包放入与此脚本相同的文件夹中。")
-    print("4. 程序已自动在浏览器中打开页面。")
+    print("4. 程序已自动在浏览器中打开页面（生产模式下不会自动打开）。")
     print("5. 使用动画制作器功能，选择建筑动画和魔法主题！")
     print("="*70 + "\n")
 
+    if args.serve == 'production':
+        try:
+            serve_production(app, args.host, PORT, workers=args.workers, threads=args.threads,
+                             post_fork=_reset_after_fork)
+        except RuntimeError as e:
+            logging.error(str(e))
+            raise SystemExit(1)
+        return
+
     url = f"http://127.0.0.1:{PORT}"
     threading.Timer(1.25, lambda: webbrowser.open(url)).start()
 
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    app.run(host=args.host, port=PORT, debug=False, threaded=True)
 
 if __name__ == '__main__':
     main()
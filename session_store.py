@@ -0,0 +1,273 @@
+"""按会话隔离的聊天记录和智能体状态。
+
+每个浏览器会话（由 cookie 标识）有自己的状态 {"chat_history": [...], "agent_state": {...}}，
+并有自己的锁：不同会话的读写互不阻塞，仓库级的锁只在查找和淘汰时短暂持有。
+
+内存中最多保留 max_sessions 个会话，超出或空闲超过 idle_timeout 秒的会话按最近使用顺序淘汰；
+提供 spill（SharedState）时，被淘汰的会话写入磁盘，下次访问时再读回，否则直接丢弃。
+spill 文件本身不随进程结束而清空：服务器启动时默认调用 discard_spilled() 丢弃上一次运行留下的会话
+（与 SharedState 在启动时重置一致），以 --keep_sessions 启动时保留，直到超过 spill_ttl 未写入。
+
+shared=True 时不使用内存缓存，每次读写都在 spill 的事务中完成，供多个工作进程共享会话。
+
+用法（并发自检）:
+    python session_store.py --threads 32 --sessions 8 --rounds 200
+"""
+import argparse
+import collections
+import contextlib
+import copy
+import logging
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_MAX_SESSIONS = 256
+DEFAULT_IDLE_TIMEOUT = 3600.0
+DEFAULT_SPILL_TTL = 7 * 24 * 3600.0
+SPILL_PREFIX = "session:"
+# 每隔这么多次访问清理一次 spill 中过期的会话
+EXPIRE_EVERY = 1000
+
+
+class _Session:
+    __slots__ = ("lock", "state", "users")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+        self.users = 0
+
+
+class SessionStore:
+    """会话状态仓库（线程安全）。"""
+
+    def __init__(self, default_agent_state, max_sessions=DEFAULT_MAX_SESSIONS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 spill=None, shared=False, spill_ttl=DEFAULT_SPILL_TTL):
+        if shared and spill is None:
+            raise ValueError("shared 模式需要提供 spill。")
+        self.default_agent_state = dict(default_agent_state)
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.spill = spill
+        self.shared = shared
+        self.spill_ttl = spill_ttl
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._sessions = collections.OrderedDict()  # 会话 id → _Session，按最近使用排序
+        self._last_used = {}
+        self._spilling = {}  # 正在写入 spill 的会话 id → 状态
+        self._accesses = 0
+        self._counters = {"created": 0, "evicted": 0, "spilled": 0, "restored": 0}
+
+    def _new_state(self):
+        return {"chat_history": [], "agent_state": dict(self.default_agent_state)}
+
+    # --- 内存会话 ---
+
+    def _acquire(self, session_id):
+        """取得会话对象（不存在时创建占位），并淘汰多余或空闲的会话。"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session()
+            else:
+                self._sessions.move_to_end(session_id)
+            session.users += 1
+            self._last_used[session_id] = now
+            evicted = self._select_evictions(now)
+        self._spill_evicted(evicted)
+        return session
+
+    def _release(self, session):
+        with self._lock:
+            session.users -= 1
+
+    def _select_evictions(self, now):
+        """在持有仓库锁时选出要淘汰的会话（跳过正在使用的），返回 [(id, 状态)]。"""
+        evicted = []
+        excess = len(self._sessions) - self.max_sessions
+        for session_id, session in list(self._sessions.items()):
+            idle = now - self._last_used[session_id] > self.idle_timeout
+            if excess <= 0 and not idle:
+                break
+            if session.users:
+                continue
+            del self._sessions[session_id]
+            del self._last_used[session_id]
+            excess -= 1
+            self._counters["evicted"] += 1
+            if session.state is not None and self.spill is not None:
+                self._spilling[session_id] = session.state
+                evicted.append((session_id, session.state))
+        return evicted
+
+    def _spill_evicted(self, evicted):
+        for session_id, state in evicted:
+            # 写入按顺序进行；同一会话在写入前再次被淘汰时，旧状态已被新状态取代，不再写入
+            with self._spill_lock:
+                with self._lock:
+                    if self._spilling.get(session_id) is not state:
+                        continue
+                spilled = False
+                try:
+                    self.spill.set(SPILL_PREFIX + session_id, state)
+                    spilled = True
+                except Exception as e:
+                    logging.warning(f"无法把会话写入磁盘，会话状态已丢弃: {e}")
+                finally:
+                    with self._lock:
+                        self._counters["spilled"] += spilled
+                        if self._spilling.get(session_id) is state:
+                            del self._spilling[session_id]
+
+    def _load(self, session_id, session):
+        """在持有会话锁时初始化占位会话的状态：优先读取正在写入或已写入 spill 的状态。"""
+        if session.state is not None:
+            return
+        with self._lock:
+            pending = self._spilling.get(session_id)
+        state = pending
+        if state is None and self.spill is not None:
+            state = self.spill.get(SPILL_PREFIX + session_id)
+        with self._lock:
+            self._counters["created" if state is None else "restored"] += 1
+        session.state = state if state is not None else self._new_state()
+
+    @contextlib.contextmanager
+    def _locked(self, session_id):
+        session = self._acquire(session_id)
+        try:
+            with session.lock:
+                self._load(session_id, session)
+                yield session
+        finally:
+            self._release(session)
+
+    def _maybe_expire_spill(self):
+        self._accesses += 1
+        if self.spill is not None and self._accesses % EXPIRE_EVERY == 0:
+            try:
+                self.spill.expire(SPILL_PREFIX, self.spill_ttl)
+            except Exception as e:
+                logging.warning(f"清理过期会话失败: {e}")
+
+    # --- 公共接口 ---
+
+    def get(self, session_id):
+        """返回会话状态的副本。"""
+        self._maybe_expire_spill()
+        if self.shared:
+            return self.spill.get(SPILL_PREFIX + session_id) or self._new_state()
+        with self._locked(session_id) as session:
+            return copy.deepcopy(session.state)
+
+    def modify(self, session_id, function):
+        """在会话锁内调用 function(状态)，用其返回值替换会话状态，返回新状态的副本。"""
+        self._maybe_expire_spill()
+        if self.shared:
+            return self.spill.modify(SPILL_PREFIX + session_id, lambda state: function(state or self._new_state()))
+        with self._locked(session_id) as session:
+            session.state = function(session.state)
+            return copy.deepcopy(session.state)
+
+    def update(self, session_id, chat_history=None, agent_state=None):
+        """替换聊天记录（为 None 时不变）并合并智能体状态，返回新状态的副本。"""
+        def apply(state):
+            state = dict(state)
+            if chat_history is not None:
+                state["chat_history"] = list(chat_history)
+            if agent_state:
+                state["agent_state"] = {**state["agent_state"], **agent_state}
+            return state
+        return self.modify(session_id, apply)
+
+    def discard_spilled(self):
+        """删除 spill 中保存的全部会话（服务器启动时调用），返回删除的条数。"""
+        if self.spill is None:
+            return 0
+        return self.spill.expire(SPILL_PREFIX, 0)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "maxSessions": self.max_sessions, "shared": self.shared,
+                    **self._counters}
+
+
+# --- 并发自检 ---
+
+def _hammer(store, threads, sessions, rounds):
+    """多个线程并发地对若干会话交替执行"导出"（更新）和"导入"（整体替换），检查会话之间互不干扰且没有丢失更新。"""
+    errors = []
+
+    def worker(worker_id):
+        session_id = f"s{worker_id % sessions}"
+        for i in range(rounds):
+            if i % 2 == 0:
+                # 导出：追加一条消息并递增计数
+                store.modify(session_id, lambda state: {
+                    **state,
+                    "chat_history": state["chat_history"] + [{"session": session_id, "worker": worker_id}],
+                    "agent_state": {**state["agent_state"],
+                                    "current_part_index": state["agent_state"]["current_part_index"] + 1},
+                })
+            else:
+                # 导入：读取后整体写回（不应丢失其他线程的更新）
+                state = store.get(session_id)
+                if any(message["session"] != session_id for message in state["chat_history"]):
+                    errors.append(f"会话 {session_id} 中出现了其他会话的消息")
+                store.modify(session_id, lambda current: {**current, "agent_state": {**current["agent_state"]}})
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    per_session = collections.Counter(f"s{i % sessions}" for i in range(threads))
+    expected_updates = (rounds + 1) // 2
+    for session_id, workers in per_session.items():
+        state = store.get(session_id)
+        expected = workers * expected_updates
+        if len(state["chat_history"]) != expected or state["agent_state"]["current_part_index"] != expected:
+            errors.append(f"会话 {session_id}: 期望 {expected} 次更新, 实际 {len(state['chat_history'])} 条消息, "
+                          f"计数 {state['agent_state']['current_part_index']}")
+    return errors, threads * rounds / elapsed
+
+
+def main():
+    from shared_state import SharedState
+
+    parser = argparse.ArgumentParser(description="会话状态仓库并发自检")
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        default_agent_state = {"current_part_index": 0}
+        spill = SharedState(os.path.join(directory, "sessions.sqlite3"))
+        configurations = [
+            ("内存", SessionStore(default_agent_state)),
+            # 会话数上限小于并发会话数：不断淘汰并从磁盘读回
+            ("内存+淘汰到磁盘", SessionStore(default_agent_state, max_sessions=max(1, args.sessions // 4), spill=spill)),
+            ("共享 (SQLite)", SessionStore(default_agent_state, spill=SharedState(os.path.join(directory, "shared.sqlite3")),
+                                         shared=True)),
+        ]
+        for name, store in configurations:
+            errors, rate = _hammer(store, args.threads, args.sessions, args.rounds)
+            failed = failed or bool(errors)
+            print(f"{name}: {rate:.0f} 次操作/秒, {'通过' if not errors else '失败'} {store.stats()}")
+            for error in errors[:5]:
+                print(f"  {error}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""跨线程、跨进程共享的服务器状态：保存在 SQLite 中的键值对，值以 JSON 保存。
+
+生产模式下多个工作进程各自持有模块全局变量的副本，运行时修改的状态（聊天记录、智能体状态等）
+必须放在这里才能被所有进程看到。数据库连接按调用创建（与 save_catalog 相同），fork 之后也可以安全使用。
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+@contextlib.contextmanager
+def transaction(path, write=True):
+    """打开 path 的数据库连接并开始事务，退出时提交（出错时回滚）并关闭。
+
+    写事务使用 BEGIN IMMEDIATE，读取使用延迟事务：WAL 模式下读取不等待其他进程的写入。"""
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.execute("PRAGMA synchronous=NORMAL")
+    try:
+        db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+
+class SharedState:
+    """键值状态仓库。modify()/merge() 在一个写事务中完成读取和写入，并发更新不会互相覆盖。"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            columns = {row[1] for row in db.execute("PRAGMA table_info(state)")}
+            if "updated" not in columns:
+                db.execute("ALTER TABLE state ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+        finally:
+            db.close()
+
+    def _connect(self, write=True):
+        return transaction(self.path, write)
+
+    @staticmethod
+    def _read(db, name, default):
+        row = db.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    @staticmethod
+    def _write(db, name, value):
+        db.execute("INSERT OR REPLACE INTO state (name, value, updated) VALUES (?, ?, ?)",
+                   (name, json.dumps(value, ensure_ascii=False, separators=(',', ':')), time.time()))
+
+    def get(self, name, default=None):
+        with self._connect(write=False) as db:
+            return self._read(db, name, default)
+
+    def set(self, name, value):
+        with self._connect() as db:
+            self._write(db, name, value)
+
+    def delete(self, name):
+        with self._connect() as db:
+            db.execute("DELETE FROM state WHERE name = ?", (name,))
+
+    def modify(self, name, function, default=None):
+        """在一个写事务中读取 name（不存在时为 default），写入 function(旧值) 的返回值并返回它。"""
+        with self._connect() as db:
+            value = function(self._read(db, name, default))
+            self._write(db, name, value)
+            return value
+
+    def merge(self, name, changes, default=None):
+        """把 changes 合并进字典状态 name（不存在时以 default 为初始值），返回合并后的字典。"""
+        return self.modify(name, lambda value: {**value, **changes}, default or {})
+
+    def expire(self, prefix, max_age):
+        """删除名称以 prefix 开头、超过 max_age 秒未写入的状态，返回删除的条数。"""
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        with self._connect() as db:
+            return db.execute("DELETE FROM state WHERE name LIKE ? ESCAPE '\\' AND updated < ?",
+                              (escaped + '%', time.time() - max_age)).rowcount
+
+    def reset(self, values):
+        """清空全部状态并写入 values（服务器启动时调用，使状态不跨越重启）。"""
+        with self._connect() as db:
+            db.execute("DELETE FROM state")
+            for name, value in values.items():
+                self._write(db, name, value)
@@ -0,0 +1,335 @@
+"""增量存档：内容寻址的快照仓库，保存基础快照和之后每次的体素增量。
+
+目录布局（位于 SAVE_DIR/snapshots 下）:
+    objects/<sha256>    内容寻址对象：体素基础快照、体素增量、单条聊天消息、智能体状态
+    index.sqlite3       快照记录列表（旧版本的 index.json 在首次打开时导入）
+
+快照按会话分开：每个会话有自己的快照链（基础快照和增量只引用同一会话的快照），列表、读取、保存和压缩
+都只作用于指定会话；快照 id 在整个仓库中唯一。对象仍在所有会话间共享，只删除任何会话都不再引用的对象。
+旧版本没有会话的快照记录在会话 '' 下，不属于任何浏览器会话。
+
+所有读写都在 index.sqlite3 的写事务 (BEGIN IMMEDIATE) 中完成，多个工作进程共用同一个目录时互斥。
+
+每条快照记录:
+    voxels  {"base": 哈希} 完整体素，或 {"delta": 哈希} 相对上一个快照的增量
+    chat    {"keep": k, "append": [消息哈希...]}：保留上一个快照的前 k 条消息，再追加新消息；
+            基础快照的 keep 为 0，append 为全部消息
+    agentState  智能体状态对象的哈希
+
+体素以 MBVX 保存；MBVX 无法无损表示的数据（非 "x,y,z" 键、额外属性、尺寸超出 uint16 等）
+以 JSON 保存，与存档 zip 中的 voxels.json 相同。体素增量对象为 b'MBVD' + <II>(upserts 长度,
+removed 长度) + 两段体素数据：新增或改变的体素，以及被删除的坐标。相同内容的对象只保存一次，
+因此重复的聊天消息和未变的智能体状态不占空间。
+"""
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+
+from voxel_format import VOXEL_FORMAT_MAGIC, arrays_to_voxel_dict, decode_voxels, encode_voxel_data
+
+SNAPSHOT_SUBDIR = "snapshots"
+DELTA_MAGIC = b'MBVD'
+# 距离上一个基础快照超过这么多个增量，或增量总大小超过基础快照的一半时，写入新的基础快照
+COMPACT_EVERY = 32
+COMPACT_DELTA_RATIO = 0.5
+DEFAULT_MAX_SNAPSHOTS = 200  # 每个会话
+# 内存中缓存最近这么多个会话的最新快照内容
+LATEST_CACHE_SESSIONS = 16
+
+_DELTA_HEADER = struct.Struct('<4sII')
+
+
+def _canonical_json(value):
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _encode_voxel_dict(voxel_data):
+    """编码为 MBVX，无法无损编码时使用 JSON。"""
+    blob = encode_voxel_data(voxel_data) if voxel_data else None
+    return blob if blob is not None else _canonical_json(voxel_data)
+
+
+def _decode_voxel_dict(blob):
+    if not blob.startswith(VOXEL_FORMAT_MAGIC):
+        return json.loads(blob)
+    decoded = decode_voxels(blob)
+    return arrays_to_voxel_dict(decoded) if len(decoded['coords']) else {}
+
+
+def encode_voxel_delta(old, new):
+    """计算两个 voxel_data 字典之间的增量，返回 (增量字节串, 改变的体素数)。"""
+    upserts = {key: value for key, value in new.items() if old.get(key) != value}
+    removed = {key: {"blockId": 0} for key in old.keys() - new.keys()}
+    upsert_blob = _encode_voxel_dict(upserts) if upserts else b''
+    removed_blob = _encode_voxel_dict(removed) if removed else b''
+    header = _DELTA_HEADER.pack(DELTA_MAGIC, len(upsert_blob), len(removed_blob))
+    return header + upsert_blob + removed_blob, len(upserts) + len(removed)
+
+
+def apply_voxel_delta(voxel_data, delta):
+    """把 encode_voxel_delta() 的结果原地应用到 voxel_data 字典上。"""
+    magic, upsert_size, removed_size = _DELTA_HEADER.unpack_from(delta)
+    if magic != DELTA_MAGIC:
+        raise ValueError("不是体素增量数据。")
+    offset = _DELTA_HEADER.size
+    if removed_size:
+        for key in _decode_voxel_dict(delta[offset + upsert_size:offset + upsert_size + removed_size]):
+            voxel_data.pop(key, None)
+    if upsert_size:
+        voxel_data.update(_decode_voxel_dict(delta[offset:offset + upsert_size]))
+    return voxel_data
+
+
+class SnapshotStore:
+    """增量快照仓库（线程安全）。最近一次快照的内容缓存在内存中，用于计算下一个增量。"""
+
+    def __init__(self, root, compact_every=COMPACT_EVERY, max_snapshots=DEFAULT_MAX_SNAPSHOTS):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.db_path = os.path.join(root, "index.sqlite3")
+        self.compact_every = compact_every
+        self.max_snapshots = max_snapshots
+        self._lock = threading.Lock()
+        self._latest = {}  # 会话 → ((快照 id, 时间戳), voxel_data, 聊天消息哈希列表)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS snapshots "
+                       "(id INTEGER PRIMARY KEY, session TEXT NOT NULL DEFAULT '', record TEXT NOT NULL)")
+            if "session" not in [row[1] for row in db.execute("PRAGMA table_info(snapshots)")]:
+                db.execute("ALTER TABLE snapshots ADD COLUMN session TEXT NOT NULL DEFAULT ''")
+            db.execute("CREATE INDEX IF NOT EXISTS snapshots_session ON snapshots (session, id)")
+            db.commit()
+        finally:
+            db.close()
+        self._migrate_json_index(os.path.join(root, "index.json"))
+
+    def _migrate_json_index(self, json_path):
+        """导入旧版本的 index.json（只在数据库为空时），导入后改名为 index.json.migrated。"""
+        if not os.path.exists(json_path):
+            return
+        with self._transaction() as db:
+            if db.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0] == 0:
+                try:
+                    with open(json_path, 'r', encoding='utf-8') as f:
+                        self._save_index(db, '', json.load(f))
+                except (OSError, ValueError):
+                    return
+            os.replace(json_path, json_path + '.migrated')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """持有线程锁并在 index.sqlite3 的写事务中执行（跨进程互斥），退出时提交（出错时回滚）。"""
+        with self._lock:
+            db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    yield db
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+                db.execute("COMMIT")
+            finally:
+                db.close()
+
+    # --- 对象与索引 ---
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def _put(self, data):
+        """写入内容寻址对象，返回 (哈希, 新写入的字节数)。"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        return digest, len(data)
+
+    def _get(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _load_index(db, session):
+        return [json.loads(row[0]) for row in
+                db.execute("SELECT record FROM snapshots WHERE session = ? ORDER BY id", (session,))]
+
+    @staticmethod
+    def _save_index(db, session, index):
+        db.execute("DELETE FROM snapshots WHERE session = ?", (session,))
+        db.executemany("INSERT INTO snapshots (id, session, record) VALUES (?, ?, ?)",
+                       [(record["id"], session, json.dumps(record, ensure_ascii=False)) for record in index])
+
+    def _remember_latest(self, session, record, voxel_data, chat):
+        self._latest.pop(session, None)
+        self._latest[session] = ((record["id"], record["timestamp"]), dict(voxel_data), chat)
+        while len(self._latest) > LATEST_CACHE_SESSIONS:
+            del self._latest[next(iter(self._latest))]
+
+    # --- 重建 ---
+
+    def _rebuild(self, session, index, position):
+        """重建会话的 index[position] 的 (voxel_data, 聊天消息哈希列表)。"""
+        latest = self._latest.get(session)
+        if latest and latest[0] == (index[position]["id"], index[position]["timestamp"]):
+            return dict(latest[1]), list(latest[2])
+        start = position
+        while "base" not in index[start]["voxels"]:
+            start -= 1
+        voxel_data = _decode_voxel_dict(self._get(index[start]["voxels"]["base"]))
+        chat = list(index[start]["chat"]["append"])
+        for record in index[start + 1:position + 1]:
+            apply_voxel_delta(voxel_data, self._get(record["voxels"]["delta"]))
+            chat = chat[:record["chat"]["keep"]] + record["chat"]["append"]
+        return voxel_data, chat
+
+    def _position(self, index, snapshot_id):
+        if not index:
+            raise KeyError("没有任何快照。")
+        if snapshot_id is None:
+            return len(index) - 1
+        for position, record in enumerate(index):
+            if record["id"] == snapshot_id:
+                return position
+        raise KeyError(f"快照不存在: {snapshot_id}")
+
+    def load(self, session, snapshot_id=None):
+        """重建会话的快照（默认最新），返回与 create_save_data() 相同结构的存档数据。"""
+        with self._transaction() as db:
+            index = self._load_index(db, session)
+            position = self._position(index, snapshot_id)
+            voxel_data, chat = self._rebuild(session, index, position)
+            record = index[position]
+            return {
+                "version": "1.0",
+                "timestamp": record["timestamp"],
+                "snapshot_id": record["id"],
+                "voxel_data": voxel_data,
+                "chat_history": [json.loads(self._get(digest)) for digest in chat],
+                "agent_state": json.loads(self._get(record["agentState"])),
+            }
+
+    # --- 保存 ---
+
+    def save(self, session, voxel_data, chat_history, agent_state):
+        """为会话保存一个新快照，返回其记录（含本次新写入的字节数 bytesWritten）。"""
+        voxel_data = voxel_data if isinstance(voxel_data, dict) else {}
+        with self._transaction() as db:
+            index = self._load_index(db, session)
+            written = 0
+            chat = []
+            for message in chat_history or []:
+                digest, size = self._put(_canonical_json(message))
+                chat.append(digest)
+                written += size
+            agent_digest, size = self._put(_canonical_json(agent_state or {}))
+            written += size
+
+            record = {
+                "id": db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM snapshots").fetchone()[0],
+                "timestamp": datetime.datetime.now().isoformat(),
+                "voxelCount": len(voxel_data),
+                "agentState": agent_digest,
+            }
+            delta = None
+            if index:
+                previous_voxels, previous_chat = self._rebuild(session, index, len(index) - 1)
+                base_position = len(index) - 1
+                while "base" not in index[base_position]["voxels"]:
+                    base_position -= 1
+                chain = index[base_position + 1:]
+                if len(chain) < self.compact_every:
+                    delta, changed = encode_voxel_delta(previous_voxels, voxel_data)
+                    base_size = os.path.getsize(self._object_path(index[base_position]["voxels"]["base"]))
+                    chain_size = sum(record["deltaSize"] for record in chain) + len(delta)
+                    if chain_size > base_size * COMPACT_DELTA_RATIO and chain_size > 4096:
+                        delta = None
+
+            if delta is not None:
+                digest, size = self._put(delta)
+                keep = 0
+                while keep < min(len(chat), len(previous_chat)) and chat[keep] == previous_chat[keep]:
+                    keep += 1
+                record.update(voxels={"delta": digest}, deltaSize=len(delta), changedVoxels=changed,
+                              chat={"keep": keep, "append": chat[keep:]})
+            else:
+                digest, size = self._put(_encode_voxel_dict(voxel_data))
+                record.update(voxels={"base": digest}, chat={"keep": 0, "append": chat})
+            written += size
+            record["bytesWritten"] = written
+
+            index.append(record)
+            self._save_index(db, session, index)
+            self._remember_latest(session, record, voxel_data, chat)
+            if len(index) > self.max_snapshots:
+                self._compact(db, session, index, self.max_snapshots)
+            return record
+
+    # --- 列表与压缩 ---
+
+    def list(self, session):
+        with self._transaction() as db:
+            return [{
+                "id": record["id"],
+                "timestamp": record["timestamp"],
+                "kind": "base" if "base" in record["voxels"] else "delta",
+                "voxelCount": record["voxelCount"],
+                "changedVoxels": record.get("changedVoxels"),
+                "bytesWritten": record["bytesWritten"],
+            } for record in self._load_index(db, session)]
+
+    def compact(self, session, keep=None):
+        """会话只保留最近 keep 个快照（默认全部保留），把最早保留的快照改写为基础快照，并删除无用对象。"""
+        with self._transaction() as db:
+            return self._compact(db, session, self._load_index(db, session), keep)
+
+    def _compact(self, db, session, index, keep):
+        if not index:
+            return {"snapshots": 0, "removedObjects": 0, "freedBytes": 0}
+        keep = len(index) if keep is None else max(1, keep)
+        first = len(index) - keep
+        if first > 0 and "base" not in index[first]["voxels"]:
+            voxel_data, chat = self._rebuild(session, index, first)
+            digest, _ = self._put(_encode_voxel_dict(voxel_data))
+            record = dict(index[first], voxels={"base": digest}, chat={"keep": 0, "append": chat})
+            record.pop("deltaSize", None)
+            index[first] = record
+        index = index[max(first, 0):]
+        self._save_index(db, session, index)
+
+        # 对象在会话间共享：只删除所有会话都不再引用的对象
+        referenced = set()
+        for record in (json.loads(row[0]) for row in db.execute("SELECT record FROM snapshots")):
+            referenced.update(record["voxels"].values())
+            referenced.update(record["chat"]["append"])
+            referenced.add(record["agentState"])
+        removed = freed = 0
+        for name in os.listdir(self.objects_dir):
+            if name not in referenced:
+                path = self._object_path(name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+        return {"snapshots": len(index), "removedObjects": removed, "freedBytes": freed}
+
+    def stats(self, session):
+        """会话的快照数和整个仓库的对象数、总字节数。"""
+        with self._transaction() as db:
+            index = self._load_index(db, session)
+            sizes = [os.path.getsize(os.path.join(self.objects_dir, name)) for name in os.listdir(self.objects_dir)]
+            return {
+                "snapshots": len(index),
+                "bases": sum(1 for record in index if "base" in record["voxels"]),
+                "objects": len(sizes),
+                "totalBytes": sum(sizes),
+            }
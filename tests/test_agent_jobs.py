@@ -0,0 +1,75 @@
+"""暂停会停止上游调用；JobStore 的写入不持有任务锁，只保存任务摘要，结果从事件重建。"""
+import json
+import sqlite3
+import threading
+import time
+
+import agent_jobs
+from agent_jobs import AgentJobRunner, JobStore
+
+PARTS = [{"id": f"p{i}", "name": f"部件 {i}"} for i in range(4)]
+RESULT = {"blockId": 1, "metaData": 0, "texture": "stone", "reason": ""}
+
+
+def _wait(job, timeout=10):
+    deadline = time.time() + timeout
+    while job.snapshot()["finished"] is None:
+        assert time.time() < deadline, "任务没有结束"
+        time.sleep(0.01)
+
+
+def test_pause_stops_retries_until_resumed(monkeypatch):
+    monkeypatch.setattr(agent_jobs, "RETRY_BACKOFF", 0.05)
+    calls = []
+
+    def assign_batch(parts):
+        calls.append(parts[0]["id"])
+        if len(calls) == 1:
+            raise RuntimeError("上游暂时不可用")
+        return {str(part["id"]): RESULT for part in parts}
+
+    runner = AgentJobRunner(max_workers=2)
+    job = runner.submit("s", PARTS[:1], "", "m", assign_batch, concurrency=1)
+    deadline = time.time() + 5
+    while not calls:
+        assert time.time() < deadline
+        time.sleep(0.005)
+    assert runner.pause(job)
+    time.sleep(0.3)
+    assert len(calls) == 1
+    assert runner.resume(job)
+    _wait(job)
+    assert job.snapshot()["status"] == "completed"
+    assert len(calls) == 2
+
+
+def test_store_writes_outside_lock_and_keeps_summary_only(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    runner = AgentJobRunner(max_workers=2, store=store)
+    lock_free = []
+    record_events = store.record_events
+
+    def checked_record_events(job_id, events, summary):
+        # 写入期间其他线程可以取得任务锁
+        cond = runner.get(job_id)._cond if runner.get(job_id) else None
+        if cond is not None:
+            probe = threading.Thread(target=lambda: lock_free.append(cond.acquire(timeout=1)) or cond.release())
+            probe.start()
+            probe.join()
+        return record_events(job_id, events, summary)
+
+    store.record_events = checked_record_events
+    job = runner.submit("s", PARTS, "", "m", lambda parts: {str(part["id"]): RESULT for part in parts},
+                        concurrency=2)
+    _wait(job)
+    job._flush()
+
+    assert lock_free and all(lock_free)
+    db = sqlite3.connect(store.path)
+    summary = json.loads(db.execute("SELECT snapshot FROM jobs WHERE id = ?", (job.id,)).fetchone()[0])
+    db.close()
+    assert "results" not in summary and summary["status"] == "completed"
+    snapshot = store.get(job.id)["snapshot"]
+    assert snapshot["results"] == job.snapshot()["results"]
+    assert snapshot["failures"] == job.snapshot()["failures"]
+    assert [event["seq"] for event in store.events(job.id)] == list(range(1, job.snapshot()["events"] + 1))
@@ -0,0 +1,24 @@
+"""MBVX 无法表示的体素在存档中改存为 voxels.json，zip 完整可读。"""
+import io
+import zipfile
+
+import pytest
+
+from save_archive import VOXEL_JSON_MEMBER, iter_save_zip, read_save
+
+COUNT = 70000
+
+
+@pytest.mark.parametrize("voxel_data", [
+    {"3000000000,0,0": {"blockId": 1, "metaData": 0}},
+    {f"{i % 300},{i // 300},0": {"blockId": i >> 16, "metaData": i & 0xFFFF} for i in range(COUNT)},
+    {f"{i % 300},{i // 300},0": {"blockId": 1, "metaData": 0, "partId": f"p{i}"} for i in range(COUNT)},
+], ids=["origin", "palette", "parts"])
+def test_unencodable_voxels_fall_back_to_json(tmp_path, voxel_data):
+    archive = b''.join(iter_save_zip({"voxel_data": voxel_data, "chat_history": [], "agent_state": {}}))
+    path = tmp_path / "save.zip"
+    path.write_bytes(archive)
+    with zipfile.ZipFile(io.BytesIO(archive)) as zipf:
+        assert zipf.testzip() is None
+        assert VOXEL_JSON_MEMBER in zipf.namelist()
+    assert read_save(str(path))["voxel_data"] == voxel_data
@@ -0,0 +1,79 @@
+"""并发导出/导入存档时，各会话的聊天记录和存档互不串扰。"""
+import io
+import os
+import threading
+import uuid
+import zipfile
+
+import pytest
+
+import server
+from session_store import SessionStore
+from shared_state import SharedState
+
+THREADS = 8
+ROUNDS = 4
+
+
+@pytest.fixture
+def save_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "SAVE_DIR", str(tmp_path))
+    monkeypatch.setattr(server, "SESSION_STORE", None)
+    return tmp_path
+
+
+def _round_trip(index, errors):
+    try:
+        client = server.app.test_client()
+        client.set_cookie(server.SESSION_COOKIE, uuid.uuid4().hex)
+        for round_index in range(ROUNDS):
+            voxel_data = {f"{index},{round_index},{k}": {"blockId": 1 + index, "metaData": k}
+                          for k in range(3)}
+            chat = [{"role": "user", "parts": [{"text": f"会话 {index} 第 {round_index} 轮"}]}]
+
+            response = client.post('/api/save/export', json={
+                "voxelData": voxel_data, "chatHistory": chat, "keepCopy": round_index % 2 == 0})
+            assert response.status_code == 200
+            archive = response.get_data()
+
+            response = client.post('/api/save/import', data={
+                "file": (io.BytesIO(archive), "save.zip")}, content_type='multipart/form-data')
+            assert response.status_code == 200
+            data = response.get_json()["data"]
+            assert data["chat_history"] == chat
+            assert data["voxel_data"] == voxel_data
+
+            assert client.get('/api/session').get_json()["chatHistory"] == chat
+    except Exception as e:
+        errors.append(e)
+
+
+def test_parallel_export_import_keeps_sessions_apart(save_dir):
+    errors = []
+    threads = [threading.Thread(target=_round_trip, args=(i, errors)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+    names = os.listdir(save_dir)
+    assert not [name for name in names if name.endswith('.part')]
+    saves = [name for name in names if name.endswith('.zip')]
+    # keepCopy 交替为 true/false，每个会话保留一半的导出
+    assert len(saves) == THREADS * ((ROUNDS + 1) // 2)
+    for name in saves:
+        with zipfile.ZipFile(save_dir / name) as zipf:
+            assert zipf.testzip() is None
+
+
+def test_discard_spilled_drops_previous_sessions(tmp_path):
+    spill = SharedState(str(tmp_path / "sessions.sqlite3"))
+    store = SessionStore(server.DEFAULT_AGENT_STATE, max_sessions=1, spill=spill)
+    first, second = uuid.uuid4().hex, uuid.uuid4().hex
+    store.update(first, [{"role": "user", "parts": [{"text": "旧会话"}]}], {})
+    store.update(second, [], {})  # 淘汰 first，写入 spill
+
+    restarted = SessionStore(server.DEFAULT_AGENT_STATE, spill=spill)
+    assert restarted.discard_spilled() == 1
+    assert restarted.get(first)["chat_history"] == []
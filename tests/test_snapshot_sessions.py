@@ -0,0 +1,51 @@
+"""快照按会话隔离：列表、读取和压缩只作用于当前会话，压缩只接受本机请求。"""
+import uuid
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def clients(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "SAVE_DIR", str(tmp_path))
+    monkeypatch.setattr(server, "SESSION_STORE", None)
+    monkeypatch.setattr(server, "SNAPSHOT_STORE", None)
+    result = []
+    for _ in range(2):
+        client = server.app.test_client()
+        client.set_cookie(server.SESSION_COOKIE, uuid.uuid4().hex)
+        result.append(client)
+    return result
+
+
+def _save(client, key, text):
+    response = client.post('/api/snapshots', json={
+        "voxelData": {key: {"blockId": 1, "metaData": 0}},
+        "chatHistory": [{"role": "user", "parts": [{"text": text}]}]})
+    assert response.status_code == 200
+    return response.get_json()["id"]
+
+
+def test_snapshots_are_scoped_to_session(clients):
+    first, second = clients
+    first_id = _save(first, "0,0,0", "第一个会话")
+    _save(first, "1,0,0", "第一个会话")
+    _save(second, "9,9,9", "第二个会话")
+
+    assert len(first.get('/api/snapshots').get_json()["snapshots"]) == 2
+    assert len(second.get('/api/snapshots').get_json()["snapshots"]) == 1
+    latest = second.get('/api/snapshots/latest').get_json()["data"]
+    assert latest["voxel_data"] == {"9,9,9": {"blockId": 1, "metaData": 0}}
+    assert second.get(f'/api/snapshots/{first_id}').status_code == 404
+
+    assert second.post('/api/snapshots/compact', json={"keep": 1}).status_code == 200
+    assert len(first.get('/api/snapshots').get_json()["snapshots"]) == 2
+    assert first.get('/api/snapshots/latest').get_json()["data"]["voxel_data"] == {
+        "1,0,0": {"blockId": 1, "metaData": 0}}
+
+
+def test_compact_requires_local_request(clients):
+    response = clients[0].post('/api/snapshots/compact', json={"keep": 1},
+                               environ_base={"REMOTE_ADDR": "192.0.2.10"})
+    assert response.status_code == 403
@@ -0,0 +1,31 @@
+"""超出 MBVX 头部和数组范围的体素数据在编码前被拒绝，而不是抛出 struct.error 或静默截断。"""
+import pytest
+
+from voxel_format import arrays_to_voxel_dict, decode_voxels, encode_voxel_data, encode_voxels
+
+COUNT = 70000
+
+
+def _row(i):
+    return f"{i % 300},{i // 300},0"
+
+
+@pytest.mark.parametrize("voxel_data", [
+    {"3000000000,0,0": {"blockId": 1, "metaData": 0}},
+    {_row(i): {"blockId": i >> 16, "metaData": i & 0xFFFF} for i in range(COUNT)},
+    {_row(i): {"blockId": 1, "metaData": 0, "partId": f"p{i}"} for i in range(COUNT)},
+], ids=["origin", "palette", "parts"])
+def test_out_of_range_returns_none(voxel_data):
+    assert encode_voxel_data(voxel_data) is None
+
+
+def test_out_of_range_raises_value_error():
+    with pytest.raises(ValueError):
+        encode_voxels([[0, 0, 0]], [1], [0], part_ids=[0x10000], part_names=[None])
+    with pytest.raises(ValueError):
+        encode_voxels([[2 ** 70, 0, 0]], [1], [0])
+
+
+def test_large_palette_within_limit_round_trips():
+    voxel_data = {_row(i): {"blockId": 1, "metaData": i % 60000} for i in range(COUNT)}
+    assert arrays_to_voxel_dict(decode_voxels(encode_voxel_data(voxel_data))) == voxel_data
@@ -0,0 +1,135 @@
+"""材质图集：把材质包中被方块定义引用的贴图打包成一张 PNG 与一张 UV 表。
+
+结果以材质包的内容哈希为键缓存在磁盘上，同一个材质包只会解压和打包一次；无法计算哈希时不使用缓存。
+"""
+import io
+import json
+import logging
+import math
+import os
+import threading
+import zipfile
+
+from PIL import Image
+
+from block_defs import iter_referenced_texture_keys
+
+ATLAS_SUBDIR = "atlas"
+ATLAS_FORMAT_VERSION = 1
+TEXTURE_DIR_MARKERS = ("textures/blocks/", "textures/block/")
+
+_BUILD_LOCK = threading.Lock()
+
+
+def find_pack_textures(zipf, texture_keys):
+    """在材质包中查找贴图文件，返回 {材质名: zip 成员名}。"""
+    wanted = set(texture_keys)
+    found = {}
+    for member in zipf.namelist():
+        lowered = member.lower()
+        if not lowered.endswith('.png') or not any(marker in lowered for marker in TEXTURE_DIR_MARKERS):
+            continue
+        key = os.path.splitext(os.path.basename(member))[0]
+        if key in wanted and key not in found:
+            found[key] = member
+    return found
+
+
+def _load_tile(zipf, member):
+    """读取单张贴图；动画贴图（高度为宽度整数倍）只取第一帧。"""
+    with zipf.open(member) as f:
+        image = Image.open(io.BytesIO(f.read())).convert('RGBA')
+    width, height = image.size
+    if height > width:
+        image = image.crop((0, 0, width, width))
+    return image
+
+
+def _atlas_paths(cache_dir, zip_hash):
+    atlas_dir = os.path.join(cache_dir, ATLAS_SUBDIR)
+    return (os.path.join(atlas_dir, f"{zip_hash}.png"),
+            os.path.join(atlas_dir, f"{zip_hash}.json"))
+
+
+def pack_atlas(tiles):
+    """把 {材质名: Image} 按统一尺寸排成网格，返回 (图集 Image, UV 表)。
+
+    UV 采用 Three.js 约定（原点在左下角，flipY=true），并向内收缩半个像素以避免相邻贴图渗色。
+    """
+    tile_size = max(max(image.size) for image in tiles.values())
+    columns = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / columns)
+    width = 1 << math.ceil(math.log2(columns * tile_size))
+    height = 1 << math.ceil(math.log2(rows * tile_size))
+
+    atlas = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    uv_table = {}
+    for index, key in enumerate(sorted(tiles)):
+        image = tiles[key]
+        if image.size != (tile_size, tile_size):
+            image = image.resize((tile_size, tile_size), Image.NEAREST)
+        left = (index % columns) * tile_size
+        top = (index // columns) * tile_size
+        atlas.paste(image, (left, top))
+        uv_table[key] = {
+            "u0": (left + 0.5) / width,
+            "v0": 1.0 - (top + tile_size - 0.5) / height,
+            "u1": (left + tile_size - 0.5) / width,
+            "v1": 1.0 - (top + 0.5) / height,
+        }
+    return atlas, {"width": width, "height": height, "tileSize": tile_size, "textures": uv_table}
+
+
+def _build_atlas(zip_path, zip_hash):
+    """解压并打包材质包中被引用的贴图，返回 (图集 Image, UV 表)。"""
+    texture_keys = list(iter_referenced_texture_keys())
+    logging.info(f"正在为材质包 '{zip_path}' 构建材质图集...")
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        members = find_pack_textures(zipf, texture_keys)
+        tiles = {}
+        for key, member in members.items():
+            try:
+                tiles[key] = _load_tile(zipf, member)
+            except Exception as e:
+                logging.warning(f"无法读取贴图 {member}: {e}")
+    if not tiles:
+        raise ValueError("材质包中没有找到任何被方块定义引用的贴图。")
+
+    atlas, uv_table = pack_atlas(tiles)
+    uv_table.update({
+        "version": ATLAS_FORMAT_VERSION,
+        "zipHash": zip_hash,
+        "missing": sorted(set(texture_keys) - set(tiles)),
+    })
+    logging.info(f"材质图集构建完成: {len(tiles)} 张贴图, 缺失 {len(uv_table['missing'])} 张。")
+    return atlas, uv_table
+
+
+def build_texture_atlas(zip_path, zip_hash, cache_dir):
+    """返回材质包的 (图集 PNG, UV 表)，优先使用磁盘缓存。
+
+    图集 PNG 通常是缓存文件的路径；zip_hash 为 None（无法计算内容哈希）时不读写缓存，
+    每次重新构建并返回内存中的 PNG (BytesIO)。"""
+    if zip_hash is None:
+        atlas, uv_table = _build_atlas(zip_path, None)
+        png = io.BytesIO()
+        atlas.save(png, format='PNG')
+        png.seek(0)
+        return png, uv_table
+
+    png_path, json_path = _atlas_paths(cache_dir, zip_hash)
+    with _BUILD_LOCK:
+        if os.path.exists(png_path) and os.path.exists(json_path):
+            with open(json_path, 'r', encoding='utf-8') as f:
+                uv_table = json.load(f)
+            if uv_table.get("version") == ATLAS_FORMAT_VERSION:
+                return png_path, uv_table
+
+        atlas, uv_table = _build_atlas(zip_path, zip_hash)
+        os.makedirs(os.path.dirname(png_path), exist_ok=True)
+        atlas.save(png_path + '.tmp', format='PNG', optimize=True)
+        os.replace(png_path + '.tmp', png_path)
+        with open(json_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(uv_table, f, ensure_ascii=False)
+        os.replace(json_path + '.tmp', json_path)
+        return png_path, uv_table
@@ -0,0 +1,321 @@
+"""紧凑的二进制体素场景格式 (MBVX)。
+
+文件布局（小端序）:
+    头部  <4sBBH iii HHH I H>  魔数 b'MBVX'、版本、标志位、保留字段、
+                               原点 (x, y, z)、尺寸 (x, y, z)、体素数、调色板大小
+    负载  zlib 压缩:
+        调色板          palette_size × (uint16 blockId, uint16 metaData)
+        坐标            FLAG_DENSE: 按 (y, z, x) 顺序的占用位图 (np.packbits)
+                        否则: 相对原点的 x 列、y 列、z 列 (uint8 或 uint16)
+        调色板索引      每个体素 uint8 或 uint16
+        部件 (可选)     FLAG_PARTS: uint32 部件名 JSON 长度 + JSON + 每个体素 uint16 部件索引
+
+体素始终按线性索引 (y, z, x) 排序，读取时全部通过 NumPy 数组完成，不创建逐体素的 Python 对象。
+"""
+import io
+import json
+import struct
+import sys
+import time
+import warnings
+import zlib
+
+import numpy as np
+
+VOXEL_FORMAT_MAGIC = b'MBVX'
+VOXEL_FORMAT_VERSION = 1
+VOXEL_FILE_EXTENSION = '.mbvx'
+
+FLAG_DENSE = 0x01
+FLAG_PARTS = 0x02
+
+_HEADER = struct.Struct('<4sBBHiiiHHHIH')
+# 无损转换时每个体素允许出现的属性
+_LOSSLESS_PROPS = frozenset(("blockId", "metaData", "partId"))
+_POWERS_OF_TEN = 10 ** np.arange(19, dtype=np.int64)
+
+
+def _linear_index(coords, dims):
+    """按 (y, z, x) 顺序计算相对坐标的线性索引。"""
+    return (coords[:, 1].astype(np.int64) * dims[2] + coords[:, 2]) * dims[0] + coords[:, 0]
+
+
+def check_voxel_arrays(coords, block_ids, meta_data, part_ids=None):
+    """检查体素数组的长度、取值、原点、尺寸和调色板大小能否用 MBVX 表示，不能时抛出 ValueError。
+
+    返回规范化后的 (coords, block_ids, meta_data, origin, dims)。
+    """
+    try:
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        block_ids = np.asarray(block_ids, dtype=np.int64)
+        meta_data = np.asarray(meta_data, dtype=np.int64)
+        if part_ids is not None:
+            part_ids = np.asarray(part_ids, dtype=np.int64)
+    except (OverflowError, TypeError) as e:
+        raise ValueError(f"体素数据不是 int64 范围内的整数: {e}") from e
+    count = len(coords)
+    if len(block_ids) != count or len(meta_data) != count:
+        raise ValueError("coords、block_ids 与 meta_data 的长度必须一致。")
+    if part_ids is not None and len(part_ids) != count:
+        raise ValueError("part_ids 与 coords 的长度必须一致。")
+    for name, values in (("blockId", block_ids), ("metaData", meta_data), ("partId", part_ids)):
+        if values is not None and count and (values.min() < 0 or values.max() > 0xFFFF):
+            raise ValueError(f"{name} 超出 uint16 范围。")
+    # 体素数超过调色板上限时才需要统计不同的 (blockId, metaData) 组合
+    if count > 0xFFFF and len(np.unique((block_ids << 16) | meta_data)) > 0xFFFF:
+        raise ValueError("不同的 (blockId, metaData) 组合超过 65535 种。")
+
+    if count:
+        origin = coords.min(axis=0)
+        dims = coords.max(axis=0) - origin + 1
+    else:
+        origin = np.zeros(3, dtype=np.int64)
+        dims = np.zeros(3, dtype=np.int64)
+    if dims.max(initial=0) > 0xFFFF:
+        raise ValueError("场景尺寸超出 uint16 范围。")
+    if origin.min() < -0x80000000 or origin.max() > 0x7FFFFFFF:
+        raise ValueError("场景原点超出 int32 范围。")
+    return coords, block_ids, meta_data, origin, dims
+
+
+def encode_voxels(coords, block_ids, meta_data, part_ids=None, part_names=None, level=6):
+    """把体素数组编码为 MBVX 字节串。
+
+    coords 为 (N, 3) 整数数组；block_ids、meta_data 为长度 N 的数组 (0..65535)；
+    part_ids 可选，为指向 part_names 的索引。
+    """
+    coords, block_ids, meta_data, origin, dims = check_voxel_arrays(coords, block_ids, meta_data, part_ids)
+    count = len(coords)
+    relative = coords - origin
+
+    linear = _linear_index(relative, dims)
+    order = np.argsort(linear, kind='stable')
+    linear, relative = linear[order], relative[order]
+    if count and np.any(np.diff(linear) == 0):
+        raise ValueError("存在重复的体素坐标。")
+
+    palette, palette_index = np.unique(
+        (block_ids[order] << 16) | meta_data[order], return_inverse=True)
+    palette_pairs = np.stack((palette >> 16, palette & 0xFFFF), axis=1).astype('<u2')
+    index_dtype = '<u1' if len(palette) <= 0x100 else '<u2'
+
+    coord_dtype = '<u1' if dims.max(initial=0) <= 0x100 else '<u2'
+    sparse_size = count * 3 * np.dtype(coord_dtype).itemsize
+    dense_size = (int(np.prod(dims)) + 7) // 8
+    flags = FLAG_DENSE if count and dense_size < sparse_size else 0
+
+    chunks = [palette_pairs.tobytes()]
+    if flags & FLAG_DENSE:
+        occupancy = np.zeros(int(np.prod(dims)), dtype=bool)
+        occupancy[linear] = True
+        chunks.append(np.packbits(occupancy).tobytes())
+    else:
+        chunks.append(np.ascontiguousarray(relative.T).astype(coord_dtype).tobytes())
+    chunks.append(palette_index.astype(index_dtype).tobytes())
+
+    if part_ids is not None:
+        flags |= FLAG_PARTS
+        names = json.dumps(list(part_names or []), ensure_ascii=False).encode('utf-8')
+        chunks.append(struct.pack('<I', len(names)) + names)
+        chunks.append(np.asarray(part_ids, dtype='<u2')[order].tobytes())
+
+    header = _HEADER.pack(VOXEL_FORMAT_MAGIC, VOXEL_FORMAT_VERSION, flags, 0,
+                          *(int(v) for v in origin), *(int(v) for v in dims), count, len(palette))
+    return header + zlib.compress(b''.join(chunks), level)
+
+
+def decode_voxels(data):
+    """解码 MBVX 字节串，返回包含 coords/block_ids/meta_data/part_ids/part_names 的字典。"""
+    if len(data) < _HEADER.size:
+        raise ValueError("体素数据过短。")
+    magic, version, flags, _, ox, oy, oz, dx, dy, dz, count, palette_size = _HEADER.unpack_from(data)
+    if magic != VOXEL_FORMAT_MAGIC:
+        raise ValueError("不是 MBVX 体素数据。")
+    if version > VOXEL_FORMAT_VERSION:
+        raise ValueError(f"不支持的体素格式版本: {version}")
+
+    payload = zlib.decompress(data[_HEADER.size:])
+    dims = np.array([dx, dy, dz], dtype=np.int64)
+    offset = 0
+
+    palette = np.frombuffer(payload, dtype='<u2', count=palette_size * 2, offset=offset).reshape(-1, 2)
+    offset += palette.nbytes
+
+    if flags & FLAG_DENSE:
+        volume = int(np.prod(dims))
+        packed = np.frombuffer(payload, dtype=np.uint8, count=(volume + 7) // 8, offset=offset)
+        offset += packed.nbytes
+        linear = np.flatnonzero(np.unpackbits(packed, count=volume))
+        x = linear % dims[0]
+        z = (linear // dims[0]) % dims[2]
+        y = linear // (dims[0] * dims[2])
+        relative = np.stack((x, y, z), axis=1)
+    else:
+        coord_dtype = '<u1' if dims.max(initial=0) <= 0x100 else '<u2'
+        columns = np.frombuffer(payload, dtype=coord_dtype, count=count * 3, offset=offset)
+        offset += columns.nbytes
+        relative = columns.reshape(3, count).T.astype(np.int64)
+    if len(relative) != count:
+        raise ValueError("体素数量与头部记录不一致。")
+    coords = relative + np.array([ox, oy, oz], dtype=np.int64)
+
+    index_dtype = '<u1' if palette_size <= 0x100 else '<u2'
+    palette_index = np.frombuffer(payload, dtype=index_dtype, count=count, offset=offset)
+    offset += palette_index.nbytes
+    block_meta = palette[palette_index]
+
+    part_ids, part_names = None, None
+    if flags & FLAG_PARTS:
+        (names_length,) = struct.unpack_from('<I', payload, offset)
+        offset += 4
+        part_names = json.loads(payload[offset:offset + names_length].decode('utf-8'))
+        offset += names_length
+        part_ids = np.frombuffer(payload, dtype='<u2', count=count, offset=offset)
+
+    return {
+        "coords": coords,
+        "block_ids": block_meta[:, 0],
+        "meta_data": block_meta[:, 1],
+        "part_ids": part_ids,
+        "part_names": part_names,
+    }
+
+
+def write_voxel_file(path, coords, block_ids, meta_data, part_ids=None, part_names=None):
+    """把体素写入 .mbvx 文件。"""
+    with open(path, 'wb') as f:
+        f.write(encode_voxels(coords, block_ids, meta_data, part_ids, part_names))
+
+
+def read_voxel_file(path):
+    """读取 .mbvx 文件，返回 decode_voxels() 的结果。"""
+    with open(path, 'rb') as f:
+        return decode_voxels(f.read())
+
+
+# --- 与存档中 JSON voxel_data 的互相转换 ---
+
+def _key_lengths(keys):
+    return np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+
+
+def _canonical_key_lengths(coords):
+    """f"{x},{y},{z}" 的长度。loadtxt 接受的其他写法（空格、+ 号、前导零、-0）都更长，长度相等即为规范写法。"""
+    digits = np.maximum(np.searchsorted(_POWERS_OF_TEN, np.abs(coords), side='right'), 1)
+    return digits.sum(axis=1) + (coords < 0).sum(axis=1) + 2
+
+
+def voxel_dict_to_arrays(voxel_data, lossless=False):
+    """把前端的 {"x,y,z": {"blockId", "metaData", "partId"}} 结构转换为数组。
+
+    无法识别的结构返回 None，调用方应保留原始 JSON。默认按前端的规则补全缺省值
+    (blockId 1, metaData 0)，适合渲染、统计等只读用途；lossless=True 时只接受
+    arrays_to_voxel_dict() 能原样还原的结构：键为规范的 "x,y,z" 整数，每个值只有整数
+    blockId、metaData 和可选的字符串 partId，否则返回 None，用于决定能否以 MBVX 存储。
+    """
+    if not isinstance(voxel_data, dict) or not voxel_data:
+        return None
+    try:
+        keys = list(voxel_data)
+        # 每个键作为一行交给 loadtxt 一次性解析，比逐个 split 快一个数量级；列数不对时形状不符
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            coords = np.loadtxt(io.StringIO('\n'.join(keys)), delimiter=',', dtype=np.int64, ndmin=2, comments=None)
+        if coords.shape != (len(keys), 3):
+            return None
+        if lossless and not np.array_equal(_key_lengths(keys), _canonical_key_lengths(coords)):
+            return None
+        props = list(voxel_data.values())
+        if lossless:
+            if not all(type(p) is dict and p.keys() <= _LOSSLESS_PROPS for p in props):
+                return None
+            raw_blocks = [p['blockId'] for p in props]
+            raw_meta = [p['metaData'] for p in props]
+            if set(map(type, raw_blocks)) | set(map(type, raw_meta)) != {int}:
+                return None
+            if not all(type(p['partId']) is str for p in props if 'partId' in p):
+                return None
+            block_ids = np.array(raw_blocks, dtype=np.int64)
+            meta_data = np.array(raw_meta, dtype=np.int64)
+        else:
+            block_ids = np.fromiter((p.get('blockId', 1) for p in props), dtype=np.int64, count=len(props))
+            meta_data = np.fromiter((p.get('metaData', 0) for p in props), dtype=np.int64, count=len(props))
+        raw_parts = [p.get('partId') for p in props]
+    except (AttributeError, KeyError, OverflowError, TypeError, ValueError):
+        return None
+
+    part_ids, part_names = None, None
+    if any(part is not None for part in raw_parts):
+        part_names = sorted({str(part) for part in raw_parts if part is not None})
+        lookup = {name: index + 1 for index, name in enumerate(part_names)}
+        # 索引 0 表示无部件
+        part_ids = np.fromiter((lookup.get(str(part), 0) if part is not None else 0 for part in raw_parts),
+                               dtype=np.int64, count=len(raw_parts))
+        part_names = [None] + part_names
+    return coords, block_ids, meta_data, part_ids, part_names
+
+
+def arrays_to_voxel_dict(decoded):
+    """把 decode_voxels() 的结果还原为前端使用的 voxel_data 字典。"""
+    keys = [f"{x},{y},{z}" for x, y, z in decoded['coords'].tolist()]
+    block_ids = decoded['block_ids'].tolist()
+    meta_data = decoded['meta_data'].tolist()
+    if decoded['part_ids'] is None:
+        return {key: {"blockId": b, "metaData": m} for key, b, m in zip(keys, block_ids, meta_data)}
+    names = decoded['part_names']
+    voxel_data = {}
+    for key, b, m, p in zip(keys, block_ids, meta_data, decoded['part_ids'].tolist()):
+        props = {"blockId": b, "metaData": m}
+        if names[p] is not None:
+            props["partId"] = names[p]
+        voxel_data[key] = props
+    return voxel_data
+
+
+def encode_voxel_data(voxel_data):
+    """把存档中的 voxel_data 字典编码为 MBVX；结构无法原样还原或超出 MBVX 的范围（原点、尺寸、取值、调色板）时返回 None。"""
+    arrays = voxel_dict_to_arrays(voxel_data, lossless=True)
+    if arrays is None:
+        return None
+    try:
+        return encode_voxels(*arrays)
+    except ValueError:
+        return None
+
+
+# --- 基准测试 ---
+
+def benchmark(txt_path, repeat=20):
+    """用 TXT 样例对比 MBVX、JSON (indent=2) 与 TXT 的体积和编解码耗时。"""
+    table = np.loadtxt(txt_path, dtype=np.int64, comments='#', ndmin=2)
+    coords, block_ids, meta_data = table[:, :3], table[:, 3], table[:, 4]
+    voxel_data = {f"{x},{y},{z}": {"blockId": b, "metaData": m}
+                  for (x, y, z, b, m) in table.tolist()}
+
+    with open(txt_path, 'rb') as f:
+        txt_size = len(f.read())
+    json_bytes = json.dumps(voxel_data, indent=2).encode('utf-8')
+    json_deflated = zlib.compress(json_bytes, 9)
+    blob = encode_voxels(coords, block_ids, meta_data)
+
+    def timed(func):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    encode_ms = timed(lambda: encode_voxels(coords, block_ids, meta_data))
+    decode_ms = timed(lambda: decode_voxels(blob))
+    json_load_ms = timed(lambda: json.loads(json_bytes))
+
+    print(f"样例: {txt_path} ({len(coords)} 个体素)")
+    print(f"  TXT                 {txt_size:>10,} 字节")
+    print(f"  JSON (indent=2)     {len(json_bytes):>10,} 字节   json.loads {json_load_ms:.2f} ms")
+    print(f"  JSON + deflate      {len(json_deflated):>10,} 字节")
+    print(f"  MBVX                {len(blob):>10,} 字节   编码 {encode_ms:.2f} ms / 解码 {decode_ms:.2f} ms")
+    print(f"  压缩比: 相对 JSON {len(json_bytes) / len(blob):.1f}x, 相对 JSON+deflate "
+          f"{len(json_deflated) / len(blob):.1f}x, 相对 TXT {txt_size / len(blob):.1f}x")
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'voxel_output17.txt')
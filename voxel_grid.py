@@ -0,0 +1,64 @@
+"""稠密体素网格工具：把稀疏的体素数组放进带一圈空白边界的三维数组，便于做邻接运算。
+
+网格大小由包围盒决定而不是体素数，几个相距很远的体素就能要求巨大的数组，
+所以格子数超过 MAX_GRID_VOLUME 时抛出 GridTooLargeError，而不是尝试分配。
+"""
+import numpy as np
+
+# 稠密网格的格子数上限（int32 网格约 256 MB）
+MAX_GRID_VOLUME = 64 * 1024 * 1024
+
+
+class GridTooLargeError(ValueError):
+    """场景包围盒过大，无法构建稠密网格。"""
+
+
+def grid_volume(coords, padding=1):
+    """返回 build_dense_grid() 将为 coords 分配的格子数。"""
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+    if len(coords) == 0:
+        return (2 * padding) ** 3
+    shape = coords.max(axis=0) - coords.min(axis=0) + 1 + 2 * padding
+    return int(np.prod(shape.astype(object)))
+
+
+def build_dense_grid(coords, values, padding=1, dtype=np.int32):
+    """返回 (grid, origin)：grid[x, y, z] 为 values 对应的值（空位为 0），
+
+    origin 是 grid[0, 0, 0] 对应的体素坐标。values 中不应出现 0。
+    格子数超过 MAX_GRID_VOLUME 时抛出 GridTooLargeError。
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+    if len(coords) == 0:
+        return np.zeros((2 * padding,) * 3, dtype=dtype), np.zeros(3, dtype=np.int64)
+    volume = grid_volume(coords, padding)
+    if volume > MAX_GRID_VOLUME:
+        raise GridTooLargeError(f"场景包围盒需要 {volume} 个网格单元，超过上限 {MAX_GRID_VOLUME}。")
+    origin = coords.min(axis=0) - padding
+    shape = coords.max(axis=0) - origin + 1 + padding
+    grid = np.zeros(tuple(int(v) for v in shape), dtype=dtype)
+    local = coords - origin
+    grid[local[:, 0], local[:, 1], local[:, 2]] = values
+    return grid, origin
+
+
+def block_palette(block_ids, meta_data):
+    """返回 (palette (P, 2), palette_index)：palette_index 从 1 开始，0 留给空位。"""
+    keys = (np.asarray(block_ids, dtype=np.int64) << 16) | np.asarray(meta_data, dtype=np.int64)
+    palette, inverse = np.unique(keys, return_inverse=True)
+    pairs = np.stack((palette >> 16, palette & 0xFFFF), axis=1)
+    return pairs, inverse.reshape(-1) + 1
+
+
+def exposed_mask(coords):
+    """六邻域遮挡测试：返回与 coords 等长的布尔数组，True 表示至少有一个面暴露在外。"""
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+    if len(coords) == 0:
+        return np.zeros(0, dtype=bool)
+    grid, origin = build_dense_grid(coords, 1, dtype=bool)
+    interior = np.ones(grid.shape, dtype=bool)
+    for axis in range(3):
+        for shift in (1, -1):
+            interior &= np.roll(grid, shift, axis=axis)
+    local = coords - origin
+    return ~interior[local[:, 0], local[:, 1], local[:, 2]]
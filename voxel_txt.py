@@ -0,0 +1,117 @@
+"""分块流式读写 "x y z blockId metaData" 文本体素格式。
+
+读取时按固定字节数分块解析为 NumPy 数组，写出时按固定体素数分块生成文本，
+内存占用只与块大小和最终数组有关，不会为每个体素创建 Python 元组。
+"""
+import io
+import warnings
+
+import numpy as np
+
+TXT_CHUNK_BYTES = 8 * 1024 * 1024
+TXT_WRITE_CHUNK_VOXELS = 262_144
+TXT_HEADER = "# Voxel Export Data\n# Format: x y z blockId metaData\n"
+
+# 坐标绝对值上限（21 位），便于把三维坐标打包成一个 int64 键去重
+COORD_LIMIT = 1 << 20
+VALUE_LIMIT = 0xFFFF
+
+_LINE_FORMAT = "%d %d %d %d %d\n"
+
+
+class VoxelTxtError(ValueError):
+    """TXT 体素数据格式或取值错误。"""
+
+
+def _parse_chunk(text, chunk_index):
+    """把一段完整行的文本解析为 (N, 5) int64 数组，并校验取值范围。"""
+    with warnings.catch_warnings():
+        # 只包含注释或空行的块会触发 "input contained no data" 警告
+        warnings.simplefilter('ignore', UserWarning)
+        try:
+            table = np.loadtxt(io.StringIO(text), dtype=np.int64, comments='#', ndmin=2)
+        except ValueError as e:
+            raise VoxelTxtError(f"第 {chunk_index + 1} 个数据块解析失败: {e}") from e
+    if table.size == 0:
+        return np.empty((0, 5), dtype=np.int64)
+    if table.shape[1] != 5:
+        raise VoxelTxtError(f"第 {chunk_index + 1} 个数据块每行应有 5 列，实际为 {table.shape[1]} 列。")
+
+    coords, values = table[:, :3], table[:, 3:]
+    if np.any(np.abs(coords) >= COORD_LIMIT):
+        raise VoxelTxtError(f"第 {chunk_index + 1} 个数据块中的坐标超出范围 (±{COORD_LIMIT - 1})。")
+    if np.any((values < 0) | (values > VALUE_LIMIT)):
+        raise VoxelTxtError(f"第 {chunk_index + 1} 个数据块中的 blockId/metaData 超出范围 (0..{VALUE_LIMIT})。")
+    return table
+
+
+def iter_txt_chunks(stream, chunk_bytes=TXT_CHUNK_BYTES):
+    """从二进制流中逐块读取体素，每次产出一个 (N, 5) int64 数组。"""
+    remainder = b''
+    chunk_index = 0
+    while True:
+        data = stream.read(chunk_bytes)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind(b'\n')
+        if cut < 0:
+            remainder = data
+            continue
+        remainder = data[cut + 1:]
+        yield _parse_chunk(data[:cut + 1].decode('utf-8'), chunk_index)
+        chunk_index += 1
+    if remainder.strip():
+        yield _parse_chunk(remainder.decode('utf-8'), chunk_index)
+
+
+def _coord_keys(coords):
+    """把坐标打包为 int64 键（每轴 21 位）。"""
+    shifted = coords.astype(np.int64) + COORD_LIMIT
+    return (shifted[:, 1] << 42) | (shifted[:, 2] << 21) | shifted[:, 0]
+
+
+def read_txt_voxels(stream, chunk_bytes=TXT_CHUNK_BYTES):
+    """读取整个 TXT 流，返回 (coords int32 (N, 3), block_ids uint16, meta_data uint16)。
+
+    重复坐标保留最后出现的那一行。
+    """
+    coords, block_ids, meta_data = [], [], []
+    for table in iter_txt_chunks(stream, chunk_bytes):
+        coords.append(table[:, :3].astype(np.int32))
+        block_ids.append(table[:, 3].astype(np.uint16))
+        meta_data.append(table[:, 4].astype(np.uint16))
+    if not coords:
+        return np.empty((0, 3), dtype=np.int32), np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.uint16)
+
+    coords = np.concatenate(coords)
+    block_ids = np.concatenate(block_ids)
+    meta_data = np.concatenate(meta_data)
+
+    keys = _coord_keys(coords)
+    _, last_from_end = np.unique(keys[::-1], return_index=True)
+    if len(last_from_end) != len(keys):
+        keep = np.sort(len(keys) - 1 - last_from_end)
+        coords, block_ids, meta_data = coords[keep], block_ids[keep], meta_data[keep]
+    return coords, block_ids, meta_data
+
+
+def iter_txt_lines(coords, block_ids, meta_data, chunk_voxels=TXT_WRITE_CHUNK_VOXELS, header=True):
+    """按块生成 TXT 文本（UTF-8 字节），适合直接作为流式 HTTP 响应体。"""
+    if header:
+        yield TXT_HEADER.encode('utf-8')
+    coords = np.asarray(coords)
+    block_ids = np.asarray(block_ids)
+    meta_data = np.asarray(meta_data)
+    for start in range(0, len(coords), chunk_voxels):
+        stop = start + chunk_voxels
+        table = np.column_stack((coords[start:stop], block_ids[start:stop], meta_data[start:stop]))
+        # 整块一次性格式化：一个模板字符串 + 一个扁平值列表
+        yield ((_LINE_FORMAT * len(table)) % tuple(table.ravel().tolist())).encode('utf-8')
+
+
+def write_txt_voxels(path, coords, block_ids, meta_data):
+    """把体素写入 TXT 文件。"""
+    with open(path, 'wb') as f:
+        for chunk in iter_txt_lines(coords, block_ids, meta_data):
+            f.write(chunk)
@@ -0,0 +1,322 @@
+"""服务器端体素化引擎：解析 GLB/glTF 模型并用 NumPy 向量化的三角形/立方体相交测试生成体素。
+
+体素坐标与前端一致：x、z 方向以网格中心对齐，y 方向从 0 开始，模型最长边映射为 resolution 个体素。
+结果按 (模型哈希, 分辨率) 缓存在磁盘上；缓存锁只在查找和写入时持有，不同的请求可以同时体素化。
+"""
+import base64
+import json
+import logging
+import os
+import struct
+import threading
+
+import numpy as np
+
+VOXEL_CACHE_SUBDIR = "voxels"
+MAX_VOXEL_RESOLUTION = 256
+# 每批参与相交测试的 (三角形, 候选体素) 对的上限，用来限制内存占用；
+# 包围盒超过上限的大三角形先切成若干小盒，因此任何一批都不会超过上限
+MAX_PAIRS_PER_BATCH = 500_000
+
+GLB_MAGIC = b'glTF'
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+COMPONENT_DTYPES = {
+    5120: np.int8,
+    5121: np.uint8,
+    5122: np.int16,
+    5123: np.uint16,
+    5125: np.uint32,
+    5126: np.float32,
+}
+TYPE_SIZES = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4, "MAT4": 16}
+
+_CACHE_LOCK = threading.Lock()
+
+
+# --- glTF 解析 ---
+
+def load_gltf(path):
+    """读取 .glb 或 .gltf 文件，返回 (gltf JSON, [buffer bytes])。"""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if data[:4] == GLB_MAGIC:
+        _, version, _ = struct.unpack_from('<4sII', data, 0)
+        if version != 2:
+            raise ValueError(f"不支持的 GLB 版本: {version}")
+        offset = 12
+        gltf, bin_chunk = None, None
+        while offset < len(data):
+            chunk_length, chunk_type = struct.unpack_from('<II', data, offset)
+            chunk = data[offset + 8:offset + 8 + chunk_length]
+            if chunk_type == GLB_CHUNK_JSON:
+                gltf = json.loads(chunk.decode('utf-8'))
+            elif chunk_type == GLB_CHUNK_BIN and bin_chunk is None:
+                bin_chunk = chunk
+            offset += 8 + chunk_length
+        if gltf is None:
+            raise ValueError("GLB 文件缺少 JSON 数据块。")
+    else:
+        gltf = json.loads(data.decode('utf-8'))
+        bin_chunk = None
+
+    buffers = []
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for buffer in gltf.get('buffers', []):
+        uri = buffer.get('uri')
+        if uri is None:
+            buffers.append(bin_chunk or b'')
+        elif uri.startswith('data:'):
+            buffers.append(base64.b64decode(uri.split(',', 1)[1]))
+        else:
+            with open(os.path.join(base_dir, uri), 'rb') as f:
+                buffers.append(f.read())
+    return gltf, buffers
+
+
+def read_accessor(gltf, buffers, accessor_index):
+    """把 accessor 读取为形状为 (count, components) 的 NumPy 数组。"""
+    accessor = gltf['accessors'][accessor_index]
+    if 'sparse' in accessor:
+        raise ValueError("暂不支持 sparse accessor。")
+    dtype = np.dtype(COMPONENT_DTYPES[accessor['componentType']])
+    components = TYPE_SIZES[accessor['type']]
+    count = accessor['count']
+    if 'bufferView' not in accessor:
+        return np.zeros((count, components), dtype=dtype)
+
+    view = gltf['bufferViews'][accessor['bufferView']]
+    buffer = buffers[view['buffer']]
+    offset = view.get('byteOffset', 0) + accessor.get('byteOffset', 0)
+    element_size = dtype.itemsize * components
+    stride = view.get('byteStride') or element_size
+
+    if stride == element_size:
+        array = np.frombuffer(buffer, dtype=dtype, count=count * components, offset=offset)
+        array = array.reshape(count, components)
+    else:
+        raw = np.frombuffer(buffer, dtype=np.uint8, count=stride * (count - 1) + element_size, offset=offset)
+        rows = np.lib.stride_tricks.as_strided(raw, shape=(count, element_size), strides=(stride, 1))
+        array = np.ascontiguousarray(rows).view(dtype).reshape(count, components)
+
+    if accessor.get('normalized') and dtype.kind in 'iu':
+        array = array.astype(np.float32) / np.iinfo(dtype).max
+    return array
+
+
+def _node_matrix(node):
+    """返回节点的局部变换矩阵（列向量约定）。"""
+    if 'matrix' in node:
+        return np.array(node['matrix'], dtype=np.float64).reshape(4, 4).T
+    tx, ty, tz = node.get('translation', (0.0, 0.0, 0.0))
+    qx, qy, qz, qw = node.get('rotation', (0.0, 0.0, 0.0, 1.0))
+    sx, sy, sz = node.get('scale', (1.0, 1.0, 1.0))
+    rotation = np.array([
+        [1 - 2 * (qy * qy + qz * qz), 2 * (qx * qy - qz * qw), 2 * (qx * qz + qy * qw)],
+        [2 * (qx * qy + qz * qw), 1 - 2 * (qx * qx + qz * qz), 2 * (qy * qz - qx * qw)],
+        [2 * (qx * qz - qy * qw), 2 * (qy * qz + qx * qw), 1 - 2 * (qx * qx + qy * qy)],
+    ])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation * np.array([sx, sy, sz])
+    matrix[:3, 3] = (tx, ty, tz)
+    return matrix
+
+
+def extract_mesh_parts(gltf, buffers):
+    """遍历场景图，返回 [(部件名, 世界坐标三角形数组 (T, 3, 3))]，每个网格节点一个部件。"""
+    nodes = gltf.get('nodes', [])
+    scenes = gltf.get('scenes', [])
+    if scenes:
+        roots = scenes[gltf.get('scene', 0)].get('nodes', [])
+    else:
+        children = {c for node in nodes for c in node.get('children', [])}
+        roots = [i for i in range(len(nodes)) if i not in children]
+
+    parts = []
+    stack = [(index, np.eye(4)) for index in reversed(roots)]
+    while stack:
+        node_index, parent_matrix = stack.pop()
+        node = nodes[node_index]
+        world = parent_matrix @ _node_matrix(node)
+        if 'mesh' in node:
+            mesh = gltf['meshes'][node['mesh']]
+            triangles = []
+            for primitive in mesh.get('primitives', []):
+                if primitive.get('mode', 4) != 4:
+                    logging.warning(f"跳过非三角形图元 (mode={primitive.get('mode')})。")
+                    continue
+                if 'KHR_draco_mesh_compression' in primitive.get('extensions', {}):
+                    raise ValueError("暂不支持 Draco 压缩的模型。")
+                positions = read_accessor(gltf, buffers, primitive['attributes']['POSITION']).astype(np.float64)
+                if 'indices' in primitive:
+                    indices = read_accessor(gltf, buffers, primitive['indices']).reshape(-1).astype(np.int64)
+                else:
+                    indices = np.arange(len(positions), dtype=np.int64)
+                indices = indices[:len(indices) - len(indices) % 3]
+                world_positions = positions @ world[:3, :3].T + world[:3, 3]
+                triangles.append(world_positions[indices].reshape(-1, 3, 3))
+            if triangles:
+                name = node.get('name') or mesh.get('name') or f"part_{len(parts)}"
+                parts.append((name, np.concatenate(triangles)))
+        for child in reversed(node.get('children', [])):
+            stack.append((child, world))
+    return parts
+
+
+# --- 体素化 ---
+
+def _triangle_box_overlap(v0, v1, v2, half):
+    """分离轴测试（Akenine-Möller）：三角形顶点已平移到体素中心为原点，返回每对是否相交。"""
+    edges = (v1 - v0, v2 - v1, v0 - v2)
+    overlap = np.ones(len(v0), dtype=bool)
+
+    # 体素自身的三个坐标轴
+    for axis in range(3):
+        p = np.stack((v0[:, axis], v1[:, axis], v2[:, axis]))
+        overlap &= (p.min(axis=0) <= half) & (p.max(axis=0) >= -half)
+
+    # 三角形所在平面
+    normal = np.cross(edges[0], edges[1])
+    distance = np.einsum('ij,ij->i', normal, v0)
+    overlap &= np.abs(distance) <= half * np.abs(normal).sum(axis=1)
+
+    # 体素坐标轴与三角形边的九个叉积
+    unit_axes = np.eye(3)
+    for edge in edges:
+        for unit in unit_axes:
+            axis = np.cross(unit, edge)
+            p0 = np.einsum('ij,ij->i', axis, v0)
+            p1 = np.einsum('ij,ij->i', axis, v1)
+            p2 = np.einsum('ij,ij->i', axis, v2)
+            radius = half * np.abs(axis).sum(axis=1)
+            low = np.minimum(np.minimum(p0, p1), p2)
+            high = np.maximum(np.maximum(p0, p1), p2)
+            overlap &= (low <= radius) & (high >= -radius)
+    return overlap
+
+
+def _split_boxes(low, extent, limit):
+    """把体素数超过 limit 的包围盒切成不超过 limit 个体素的小盒，返回 (所属三角形索引, 起点, 尺寸)。"""
+    oversized = extent.prod(axis=1) > limit
+    owners = [np.flatnonzero(~oversized)]
+    lows, extents = [low[~oversized]], [extent[~oversized]]
+    for index in np.flatnonzero(oversized):
+        ex, ey, ez = (int(v) for v in extent[index])
+        tx = min(ex, limit)
+        ty = min(ey, max(1, limit // tx))
+        tz = min(ez, max(1, limit // (tx * ty)))
+        starts = np.stack(np.meshgrid(np.arange(0, ex, tx), np.arange(0, ey, ty), np.arange(0, ez, tz),
+                                      indexing='ij'), axis=-1).reshape(-1, 3)
+        owners.append(np.full(len(starts), index, dtype=np.int64))
+        lows.append(low[index] + starts)
+        extents.append(np.minimum((tx, ty, tz), extent[index] - starts))
+    return np.concatenate(owners), np.concatenate(lows), np.concatenate(extents)
+
+
+def voxelize_triangles(triangles, resolution):
+    """返回与任一三角形相交的体素坐标 (N, 3) int64，坐标均在 [0, resolution) 内。"""
+    if len(triangles) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+
+    upper = resolution - 1
+    low = np.clip(np.floor(triangles.min(axis=1)).astype(np.int64), 0, upper)
+    high = np.clip(np.floor(triangles.max(axis=1)).astype(np.int64), 0, upper)
+    owner, box_low, box_extent = _split_boxes(low, high - low + 1, MAX_PAIRS_PER_BATCH)
+    counts = box_extent.prod(axis=1)
+
+    hits = []
+    start = 0
+    cumulative = np.cumsum(counts)
+    while start < len(owner):
+        base = cumulative[start - 1] if start else 0
+        stop = max(start + 1, int(np.searchsorted(cumulative, base + MAX_PAIRS_PER_BATCH, side='right')))
+        batch_counts = counts[start:stop]
+        box_index = np.repeat(np.arange(start, stop), batch_counts)
+        tri_index = owner[box_index]
+        local = np.arange(batch_counts.sum()) - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)
+
+        ext = box_extent[box_index]
+        dx = local % ext[:, 0]
+        dy = (local // ext[:, 0]) % ext[:, 1]
+        dz = local // (ext[:, 0] * ext[:, 1])
+        voxels = box_low[box_index] + np.stack((dx, dy, dz), axis=1)
+
+        centers = voxels + 0.5
+        tris = triangles[tri_index]
+        mask = _triangle_box_overlap(tris[:, 0] - centers, tris[:, 1] - centers, tris[:, 2] - centers, 0.5)
+        hits.append(voxels[mask])
+        start = stop
+
+    return np.unique(np.concatenate(hits), axis=0)
+
+
+def normalize_to_grid(parts, resolution):
+    """把所有部件缩放平移到体素网格：最长边占满 resolution，x/z 居中，底部贴在 y=0。"""
+    all_vertices = np.concatenate([triangles.reshape(-1, 3) for _, triangles in parts])
+    minimum = all_vertices.min(axis=0)
+    size = all_vertices.max(axis=0) - minimum
+    longest = size.max()
+    if longest <= 0:
+        raise ValueError("模型没有有效的几何尺寸。")
+    # 稍微缩小一点，避免最大边界恰好落在 resolution 上
+    scale = (resolution - 1e-6) / longest
+    offset = np.array([(resolution - size[0] * scale) / 2, 0.0, (resolution - size[2] * scale) / 2])
+    return [(name, (triangles - minimum) * scale + offset) for name, triangles in parts]
+
+
+def voxelize_model(model_path, resolution):
+    """体素化模型，返回 {"parts": [部件名], "coords": (N, 3) uint16, "part_ids": (N,) uint16}。"""
+    gltf, buffers = load_gltf(model_path)
+    parts = extract_mesh_parts(gltf, buffers)
+    if not parts:
+        raise ValueError("模型中没有可体素化的三角形网格。")
+    parts = normalize_to_grid(parts, resolution)
+
+    coords, part_ids = [], []
+    for part_id, (_, triangles) in enumerate(parts):
+        voxels = voxelize_triangles(triangles, resolution)
+        coords.append(voxels)
+        part_ids.append(np.full(len(voxels), part_id, dtype=np.uint16))
+    coords = np.concatenate(coords)
+    part_ids = np.concatenate(part_ids)
+
+    # 多个部件占据同一体素时保留先出现的部件
+    linear = (coords[:, 1] * resolution + coords[:, 2]) * resolution + coords[:, 0]
+    _, first = np.unique(linear, return_index=True)
+    return {
+        "parts": [name for name, _ in parts],
+        "coords": coords[first].astype(np.uint16),
+        "part_ids": part_ids[first],
+    }
+
+
+def voxelize_model_cached(model_path, model_hash, resolution, cache_dir):
+    """带磁盘缓存的 voxelize_model()，缓存键为 (模型哈希, 分辨率)。"""
+    cache_path = os.path.join(cache_dir, VOXEL_CACHE_SUBDIR, f"{model_hash}_{resolution}.npz")
+    with _CACHE_LOCK:
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                return {
+                    "parts": json.loads(cached['parts'].item()),
+                    "coords": cached['coords'],
+                    "part_ids": cached['part_ids'],
+                }
+
+    # 体素化不持有锁；同一模型被同时请求时各自计算，后写入的结果覆盖先写入的（内容相同）
+    logging.info(f"正在体素化模型 '{model_path}' (分辨率 {resolution})...")
+    result = voxelize_model(model_path, resolution)
+    with _CACHE_LOCK:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # 临时文件名带进程号：多个工作进程共用缓存目录
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            parts=np.array(json.dumps(result['parts'], ensure_ascii=False)),
+            coords=result['coords'],
+            part_ids=result['part_ids'],
+        )
+        os.replace(tmp_path, cache_path)
+    logging.info(f"体素化完成: {len(result['coords'])} 个体素, {len(result['parts'])} 个部件。")
+    return result
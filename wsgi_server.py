@@ -0,0 +1,60 @@
+"""生产模式的 WSGI 服务器：优先使用 gunicorn（多进程 × 每进程多线程），否则使用 waitress（单进程多线程）。
+
+两者都是可选依赖:
+    pip install gunicorn      # Linux / macOS，支持 --workers
+    pip install waitress      # 任意平台（包括 Windows），只支持 --threads
+
+多进程模式下应用在主进程中加载后再 fork，启动阶段完成的初始化（下载模型、验证密钥等）只执行一次；
+运行时修改的状态需要放在 shared_state 中才能被所有工作进程看到。主进程中创建的连接池、线程和锁
+不能在工作进程中继续使用，由 post_fork 回调在每个工作进程启动时重置。
+"""
+import importlib.util
+import logging
+import os
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_THREADS = 8
+# 流式接口（聊天 SSE、存档导出）可能持续较长时间，gthread 工作进程在主线程中发送心跳，不受此限制
+WORKER_TIMEOUT = 120
+KEEPALIVE_SECONDS = 5
+
+
+def _serve_gunicorn(app, host, port, workers, threads, post_fork):
+    from gunicorn.app.base import BaseApplication
+
+    class _Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{host}:{port}")
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', WORKER_TIMEOUT)
+            self.cfg.set('keepalive', KEEPALIVE_SECONDS)
+            if post_fork is not None:
+                self.cfg.set('post_fork', lambda server, worker: post_fork())
+
+        def load(self):
+            return app
+
+    logging.info(f"使用 gunicorn: {workers} 个工作进程 × {threads} 个线程, 监听 {host}:{port}")
+    _Application().run()
+
+
+def _serve_waitress(app, host, port, threads):
+    import waitress
+
+    logging.info(f"使用 waitress: {threads} 个线程, 监听 {host}:{port}")
+    waitress.serve(app, host=host, port=port, threads=threads, channel_timeout=WORKER_TIMEOUT)
+
+
+def serve(app, host, port, workers=DEFAULT_WORKERS, threads=DEFAULT_THREADS, post_fork=None):
+    """以生产模式运行 app，直到进程退出。post_fork() 在每个 gunicorn 工作进程 fork 后调用。
+    两种服务器都未安装时抛出 RuntimeError。"""
+    if importlib.util.find_spec('gunicorn') is not None:
+        _serve_gunicorn(app, host, port, workers, threads, post_fork)
+        return
+    if importlib.util.find_spec('waitress') is None:
+        raise RuntimeError("生产模式需要安装 gunicorn 或 waitress（pip install gunicorn / pip install waitress）。")
+    if workers > 1:
+        logging.warning(f"未安装 gunicorn，waitress 只使用单个进程（忽略 --workers {workers}）。")
+    _serve_waitress(app, host, port, threads)
@@ -0,0 +1,87 @@
+"""边生成边输出的 zip 流：把成员逐块写入 zipfile，并把产生的字节立即交给调用方。
+
+输出对象不可 seek，zipfile 会为每个成员写入数据描述符 (data descriptor)，
+因此不需要先知道成员大小，也不需要临时文件。内存占用只与单个数据块的大小有关。
+"""
+import io
+import os
+import time
+import zipfile
+
+STREAM_FLUSH_BYTES = 64 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class _StreamBuffer(io.RawIOBase):
+    """只能追加写入的缓冲区：记录位置供 zipfile 使用，可选地把字节同时写入文件。"""
+
+    def __init__(self, tee=None):
+        self._chunks = []
+        self._size = 0
+        self._position = 0
+        self._tee = tee
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._size += len(data)
+        self._position += len(data)
+        if self._tee is not None:
+            self._tee.write(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def pending(self):
+        return self._size
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        return data
+
+
+def iter_zip_stream(members, tee_path=None):
+    """逐块产出 zip 文件的字节。
+
+    members 为可迭代的 (成员名, 压缩方式, 数据块迭代器)，数据块迭代器按需生成 bytes，
+    因此可以在前面的成员已经发出后再计算后面的成员。
+    tee_path 不为空时同时把完整的 zip 写入该路径（先写临时文件，完成后改名；中途中断则删除）。
+    """
+    tee = open(tee_path + '.part', 'wb') if tee_path else None
+    completed = False
+    try:
+        buffer = _StreamBuffer(tee)
+        with zipfile.ZipFile(buffer, 'w') as zipf:
+            for name, compress_type, chunks in members:
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.compress_type = compress_type
+                # 大小事先未知：始终写入 zip64 扩展字段，允许成员超过 4 GB
+                with zipf.open(info, 'w', force_zip64=True) as member:
+                    for chunk in chunks:
+                        member.write(chunk)
+                        if buffer.pending() >= STREAM_FLUSH_BYTES:
+                            yield buffer.drain()
+                if buffer.pending():
+                    yield buffer.drain()
+        yield buffer.drain()
+        completed = True
+    finally:
+        if tee is not None:
+            tee.close()
+            if completed:
+                os.replace(tee_path + '.part', tee_path)
+            else:
+                os.remove(tee_path + '.part')
+
+
+def iter_bytes(data, chunk_size=STREAM_CHUNK_SIZE):
+    """把已经在内存中的字节串切成数据块。"""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]